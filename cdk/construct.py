@@ -57,7 +57,7 @@ class DockerLambdaWithoutLayer(Construct):
             function_name=function_name,
             environment=self.node.try_get_context(f"env_fn_{id}"),
             timeout=cdk.Duration.seconds(60),
-            memory_size=2048,
+            memory_size=self.node.try_get_context(f"memory_fn_{id}") or 2048,
         )
 
         loggroup_name = f"/aws/lambda/{self.fn.function_name}"
@@ -73,21 +73,71 @@ class LambdaToSqsToLambda(Construct):
         super().__init__(scope, id)
 
         queue_name = f"sqs-{id}-cdk"
-
+        dlq_name = f"sqs-{id}-dlq-cdk"
+        batch = self.node.try_get_context(f"env_sqs_{id}")
+
+        # 失敗したレコードだけが再配信されるので, 何度も失敗するものはDLQに逃がす
+        self.dlq = sqs.Queue(
+            self, dlq_name,
+            queue_name=dlq_name,
+            retention_period=Duration.days(1),
+        )
         self.queue = sqs.Queue(
             self, queue_name,
             queue_name=queue_name,
             visibility_timeout=Duration.seconds(60),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=batch["max_receive_count"],
+                queue=self.dlq,
+            ),
         )
 
         lambda_construct = PythonLambdaWithoutLayer(self, id)
         self.fn = lambda_construct.fn
 
-        target_fn.add_event_source(event_source.SqsEventSource(self.queue))
+        target_fn.add_event_source(event_source.SqsEventSource(
+            self.queue,
+            batch_size=batch["batch_size"],
+            max_batching_window=Duration.seconds(batch["max_batching_window_sec"]),
+            report_batch_item_failures=True,
+        ))
         self.fn.add_environment(f"{id.upper()}_URL", self.queue.queue_url)
         self.queue.grant_send_messages(self.fn)
 
 
+class SqsToLambda(Construct):
+
+    def __init__(self, scope: Construct, id: str, target_fn: lambda_.Function) -> None:
+        super().__init__(scope, id)
+
+        queue_name = f"sqs-{id}-cdk"
+        dlq_name = f"sqs-{id}-dlq-cdk"
+        batch = self.node.try_get_context(f"env_sqs_{id}")
+
+        # 失敗し続けるtickはDLQに逃がす(再配信されたtickは送信からやり直すので数回は再試行させる)
+        self.dlq = sqs.Queue(
+            self, dlq_name,
+            queue_name=dlq_name,
+            retention_period=Duration.days(1),
+        )
+        self.queue = sqs.Queue(
+            self, queue_name,
+            queue_name=queue_name,
+            visibility_timeout=Duration.seconds(60),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=batch["max_receive_count"],
+                queue=self.dlq,
+            ),
+        )
+
+        target_fn.add_event_source(event_source.SqsEventSource(
+            self.queue,
+            report_batch_item_failures=True,
+        ))
+        target_fn.add_environment(f"{id.upper()}_URL", self.queue.queue_url)
+        self.queue.grant_send_messages(target_fn)
+
+
 class CreateDbAndSetEnvToFn(Construct):
 
     def __init__(self, scope: Construct, id: str, fns: list[lambda_.Function] = []) -> None:
@@ -27,20 +27,27 @@ class RakugakiBattleOnLine(Stack):
         predict = DockerLambdaWithoutLayer(self, "predict")
         predict_queue = LambdaToSqsToLambda(self, "predict_queue", predict.fn)
         start_game = PythonLambdaWithoutLayer(self, "start_game")
+        round_queue = SqsToLambda(self, "round_queue", start_game.fn)
 
-        for construst in [on_connect, enter_room, dis_connect, predict, predict_queue, start_game]:
+        for construst in [on_connect, enter_room, dis_connect, predict, predict_queue, start_game, round_queue]:
             Tags.of(construst).add("Construct", construst.node.id)
 
-        user = CreateDbAndSetEnvToFn(self, "user", [on_connect.fn, enter_room.fn, dis_connect.fn, predict.fn])
+        user = CreateDbAndSetEnvToFn(self, "user", [on_connect.fn, enter_room.fn, dis_connect.fn, predict.fn, start_game.fn])
         user.db.grant_write_data(on_connect.fn.role)
         user.db.grant_read_write_data(enter_room.fn.role)
         user.db.grant_full_access(dis_connect.fn.role)
-        user.db.grant_write_data(predict.fn.role)
+        user.db.grant_read_write_data(predict.fn.role)
+        user.db.grant_write_data(start_game.fn.role)
 
         room = CreateDbAndSetEnvToFn(self, "room", [enter_room.fn, dis_connect.fn, start_game.fn])
         room.db.grant_read_write_data(enter_room.fn.role)
         room.db.grant_full_access(dis_connect.fn.role)
-        room.db.grant_read_data(start_game.fn.role)
+        room.db.grant_read_write_data(start_game.fn.role)
+
+        game = CreateDbAndSetEnvToFn(self, "game", [start_game.fn, predict.fn, enter_room.fn])
+        game.db.grant_read_write_data(start_game.fn.role)
+        game.db.grant_read_write_data(predict.fn.role)
+        game.db.grant_write_data(enter_room.fn.role)
 
         result = CreateBucketAndSetEnvToFn(self, "result", [predict.fn])
         result.bucket.grant_put(predict.fn.role)
@@ -1,12 +1,13 @@
 from __future__ import annotations
 
 import os
-import json
+import time
 import logging
 from typing import Any, NamedTuple
 
-import boto3
-from boto3.dynamodb.conditions import Key
+from broadcast import broadcast, client_config, prune_gone
+import log_util
+import runtime
 
 
 class EnvironParam(NamedTuple):
@@ -27,10 +28,13 @@ class EnvironParam(NamedTuple):
 ep = EnvironParam.from_env()
 logger = logging.getLogger()
 logger.setLevel(ep.LOG_LEVEL)
-dynamodb = boto3.resource("dynamodb")
-apigw = boto3.client("apigatewaymanagementapi", endpoint_url=ep.ENDPOINT_URL)
-user_table = dynamodb.Table(ep.USER_TABLE_NAME)
-room_table = dynamodb.Table(ep.ROOM_TABLE_NAME)
+dynamodb = runtime.resource("dynamodb")
+apigw = runtime.client("apigatewaymanagementapi", endpoint_url=ep.ENDPOINT_URL, config=client_config)
+user_table = runtime.table(ep.USER_TABLE_NAME)
+room_table = runtime.table(ep.ROOM_TABLE_NAME)
+# BatchWriteItemの1リクエストあたりの上限件数と, 未処理分のリトライ回数
+BATCH_WRITE_LIMIT = 25
+BATCH_WRITE_RETRY = 8
 
 
 class UDbInfoSchema(NamedTuple):
@@ -38,62 +42,61 @@ class UDbInfoSchema(NamedTuple):
     user_name: str
 
     @classmethod
-    def from_db(cls, response: dict[str, Any]) -> UDbInfoSchema:
-        return UDbInfoSchema(**{k: response["Item"][k] for k in UDbInfoSchema._fields})
+    def from_db(cls, item: dict[str, Any]) -> UDbInfoSchema:
+        return UDbInfoSchema(**{k: item[k] for k in UDbInfoSchema._fields})
 
 
 class DoNotRetryException(Exception):
     ...
 
 
-def all_delete_user_table(connection_id: str) -> None:
-    res = user_table.query(KeyConditionExpression=Key(ep.USER_TABLE_PKEY).eq(connection_id))
-    skeys = [item[ep.USER_TABLE_SKEY] for item in res["Items"]]
+def get_user_items(connection_id: str) -> list[dict[str, Any]]:
+    # login, info, 保存した絵の行をまとめて1回で取得する
+    from boto3.dynamodb.conditions import Key
     try:
-        for skey in skeys:
-            user_table.delete_item(
-                Key={
-                    ep.USER_TABLE_PKEY: connection_id,
-                    ep.USER_TABLE_SKEY: skey,
-                }
-            )
-    except Exception as e:
-        logger.exception("delete_item_error")
-        raise DoNotRetryException from e
-
-
-def get_info(connection_id: str) -> UDbInfoSchema | None:
-    try:
-        res_info = user_table.get_item(
-            Key={
-                ep.USER_TABLE_PKEY: connection_id,
-                ep.USER_TABLE_SKEY: "info",
-            }
-        )
-        logger.info(json.dumps(res_info, indent=2))
+        return user_table.query(
+            KeyConditionExpression=Key(ep.USER_TABLE_PKEY).eq(connection_id)
+        )["Items"]
     except Exception as e:
-        logger.exception("get_item_error")
+        logger.exception("query")
         raise DoNotRetryException from e
-    try:
-        return UDbInfoSchema.from_db(res_info)
-    except:
-        return None
 
 
-def delete_room_table(room_id: str, connection_id: str) -> None:
-    try:
-        room_table.delete_item(
-            Key={
-                ep.ROOM_TABLE_PKEY: room_id,
-                ep.ROOM_TABLE_SKEY: connection_id,
-            }
-        )
-    except Exception as e:
-        logger.exception("delete_item_error")
-        raise DoNotRetryException from e
+def get_info(items: list[dict[str, Any]]) -> UDbInfoSchema | None:
+    for item in items:
+        if item[ep.USER_TABLE_SKEY] == "info":
+            try:
+                return UDbInfoSchema.from_db(item)
+            except:
+                return None
+    return None
+
+
+def batch_delete(request_items: dict[str, list[dict[str, Any]]]) -> None:
+    # 1WCUのテーブルでスロットリングされても取りこぼさないよう, 未処理分は指数バックオフでリトライする
+    requests = [(table_name, {"DeleteRequest": {"Key": key}}) for table_name, keys in request_items.items() for key in keys]
+    for i in range(0, len(requests), BATCH_WRITE_LIMIT):
+        unprocessed: dict[str, list[dict[str, Any]]] = {}
+        for table_name, request in requests[i:i+BATCH_WRITE_LIMIT]:
+            unprocessed.setdefault(table_name, []).append(request)
+        for retry in range(BATCH_WRITE_RETRY):
+            try:
+                unprocessed = dynamodb.meta.client.batch_write_item(RequestItems=unprocessed)["UnprocessedItems"]
+            except dynamodb.meta.client.exceptions.ProvisionedThroughputExceededException:
+                logger.warning("batch_write_item: throttled")
+            except Exception as e:
+                logger.exception("batch_write_item")
+                raise DoNotRetryException from e
+            if not unprocessed:
+                break
+            time.sleep(min(0.05 * 2**retry, 1.0))
+        else:
+            logger.error(f"batch_write_item: unprocessed {unprocessed}")
+            raise DoNotRetryException("batch_write_item")
 
 
 def post_room(info: UDbInfoSchema) -> None:
+    from boto3.dynamodb.conditions import Key
     try:
         items = room_table.query(
             KeyConditionExpression=Key(ep.ROOM_TABLE_PKEY).eq(info.room_id)
@@ -102,31 +105,37 @@ def post_room(info: UDbInfoSchema) -> None:
     except Exception as e:
         logger.exception("query")
         raise DoNotRetryException from e
-    for connection_id in connection_ids:
-        try:
-            apigw.post_to_connection(
-                Data=json.dumps({"command": "dis_connect", "name": info.user_name}).encode(),
-                ConnectionId=connection_id,
-            )
-        except boto3.client.exceptions.GoneException:
-            # 何らかの事情でDBに残っていても接続が切れている場合があるのでSkip
-            logger.exception("warn")
-        except Exception as e:
-            logger.exception("delete_item_error")
-            raise DoNotRetryException from e
+    # 何らかの事情でDBに残っていても接続が切れている場合があるので, 失敗した接続があっても他の接続には送り
+    # 切断済みの接続はテーブルから削除する
+    results = broadcast(apigw, connection_ids, {"command": "dis_connect", "name": info.user_name})
+    prune_gone(
+        results, info.room_id, room_table, (ep.ROOM_TABLE_PKEY, ep.ROOM_TABLE_SKEY),
+        user_table, (ep.USER_TABLE_PKEY, ep.USER_TABLE_SKEY),
+    )
 
 
 def service(connection_id: str) -> None:
-    info = get_info(connection_id)
-    all_delete_user_table(connection_id)
+    items = get_user_items(connection_id)
+    info = get_info(items)
+    # userテーブルの行とroomテーブルの自分の行を1回のBatchWriteItemで削除する
+    request_items = {
+        ep.USER_TABLE_NAME: [
+            {ep.USER_TABLE_PKEY: connection_id, ep.USER_TABLE_SKEY: item[ep.USER_TABLE_SKEY]} for item in items
+        ],
+    }
+    if info is not None:
+        request_items[ep.ROOM_TABLE_NAME] = [
+            {ep.ROOM_TABLE_PKEY: info.room_id, ep.ROOM_TABLE_SKEY: connection_id},
+        ]
+    batch_delete(request_items)
     if info is None:
         return
-    delete_room_table(info.room_id, connection_id)
+    # start_gameのメンバーのキャッシュはここでは無効にしない(退室した接続には送るとGoneExceptionになり, そこで消える)
     post_room(info)
 
 
 def lambda_handler(event, context):
-    logger.info(json.dumps(event, indent=2))
+    log_util.debug(logger, "event", event, log_util.connection_id_of(event))
     try:
         service(event["requestContext"]["connectionId"])
         return {
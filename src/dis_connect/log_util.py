@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import os
+import json
+import zlib
+import logging
+from typing import Any
+
+# 丸ごと出すと大きすぎる項目(画像のbase64など)
+REDACT_KEYS = frozenset({"img_b64"})
+# これより長い文字列は切り詰める(API GatewayのbodyはJSON文字列なので中の画像もここで切れる)
+MAX_STR_LEN = 256
+# 接続ごとにDEBUGログを出す割合(0〜1). LOG_LEVELがINFOでも一部の接続だけ詳細を追える
+SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0"))
+
+
+def redact(obj: Any) -> Any:
+    if isinstance(obj, dict):
+        return {k: f"<{len(v)} chars>" if k in REDACT_KEYS and isinstance(v, str) else redact(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [redact(v) for v in obj]
+    if isinstance(obj, str) and len(obj) > MAX_STR_LEN:
+        return f"{obj[:MAX_STR_LEN]}...<{len(obj)} chars>"
+    return obj
+
+
+class Lazy:
+    # loggingは出力するときだけ%sを展開するので, レベルが無効ならシリアライズも伏せ字処理も走らない
+    def __init__(self, obj: Any) -> None:
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return json.dumps(redact(self.obj), ensure_ascii=False, default=str)
+
+
+def is_sampled(connection_id: str | None) -> bool:
+    # 同じ接続は毎回同じ判定になるよう接続IDのハッシュで決める
+    if not connection_id or SAMPLE_RATE <= 0:
+        return False
+    return zlib.crc32(connection_id.encode()) % 10000 < SAMPLE_RATE * 10000
+
+
+def connection_id_of(event: dict[str, Any]) -> str | None:
+    return event.get("requestContext", {}).get("connectionId")
+
+
+def info(logger: logging.Logger, msg: str, obj: Any) -> None:
+    logger.info("%s: %s", msg, Lazy(obj))
+
+
+def debug(logger: logging.Logger, msg: str, obj: Any, connection_id: str | None = None) -> None:
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s: %s", msg, Lazy(obj))
+    elif is_sampled(connection_id):
+        logger.info("%s(sampled): %s", msg, Lazy(obj))
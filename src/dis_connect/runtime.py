@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import json
+import threading
+from typing import Any, Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+# 1つのクライアントが同時に張れるコネクション数. broadcastのスレッド数以上にしておく
+MAX_POOL_CONNECTIONS = 16
+
+
+class LazySingleton(Generic[T]):
+    # 最初に使われたときに1回だけfactoryを呼ぶ. 複数のスレッドから同時に呼ばれても作るのは1回
+    def __init__(self, factory: Callable[[], T]) -> None:
+        self.factory = factory
+        self.value: T | None = None
+        self.lock = threading.Lock()
+
+    def get(self) -> T:
+        if self.value is None:
+            with self.lock:
+                if self.value is None:
+                    self.value = self.factory()
+        return self.value
+
+
+class Lazy:
+    # 属性に触れたときに初めて中身を作る代理オブジェクト. モジュール変数をそのまま置き換えられる
+    def __init__(self, factory: Callable[[], Any]) -> None:
+        object.__setattr__(self, "_singleton", LazySingleton(factory))
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._singleton.get(), name)
+
+
+class PerThread:
+    # Lazyと同じ代理オブジェクトだが, 中身をスレッドごとに作る(boto3のresourceはスレッドセーフではない)
+    def __init__(self, factory: Callable[[], Any]) -> None:
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_local", threading.local())
+
+    def __getattr__(self, name: str) -> Any:
+        if not hasattr(self._local, "value"):
+            self._local.value = self._factory()
+        return getattr(self._local.value, name)
+
+
+def _new_session() -> Any:
+    # boto3の読み込み自体も重いので, 最初にクライアントが要るときまで遅らせる
+    import boto3
+    return boto3.Session()
+
+
+session = LazySingleton(_new_session)
+# Sessionはスレッドセーフではないので, クライアントを作るときはロックを取る
+_lock = threading.Lock()
+# クライアントはスレッドセーフなので共有し, resourceはスレッドごとに持つ
+_clients: dict[tuple[str, str | None, str], Any] = {}
+_resources = threading.local()
+
+
+def _config(config: dict[str, Any] | None = None) -> Any:
+    # botocoreを読み込まずに済むよう, ハンドラーからはConfigの引数だけを受け取ってここで作る
+    from botocore.config import Config
+    return Config(**{"max_pool_connections": MAX_POOL_CONNECTIONS, "retries": {"mode": "standard"}, **(config or {})})
+
+
+def _client(service_name: str, endpoint_url: str | None, config: dict[str, Any] | None) -> Any:
+    # 同じサービスでもConfig(タイムアウトなど)が違えば別のクライアントにする. dictはそのままではキーにできないので文字列にする
+    key = (service_name, endpoint_url, json.dumps(config or {}, sort_keys=True))
+    with _lock:
+        if key not in _clients:
+            _clients[key] = session.get().client(service_name, endpoint_url=endpoint_url, config=_config(config))
+        return _clients[key]
+
+
+def _resource(service_name: str) -> Any:
+    resources = _resources.__dict__
+    if service_name not in resources:
+        with _lock:
+            resources[service_name] = session.get().resource(service_name, config=_config())
+    return resources[service_name]
+
+
+def client(service_name: str, endpoint_url: str | None = None, config: dict[str, Any] | None = None) -> Lazy:
+    # コンテナの中では同じサービス・エンドポイント・Configのクライアントを使い回す
+    return Lazy(lambda: _client(service_name, endpoint_url, config))
+
+
+def resource(service_name: str) -> PerThread:
+    return PerThread(lambda: _resource(service_name))
+
+
+def table(name: str) -> PerThread:
+    # 保存をバックグラウンドのスレッドで行うハンドラーもあるので, スレッドごとのresourceからTableを作る
+    return PerThread(lambda: _resource("dynamodb").Table(name))
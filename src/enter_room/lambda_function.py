@@ -5,8 +5,10 @@ import json
 import logging
 from typing import Any, NamedTuple
 
-import boto3
-from boto3.dynamodb.conditions import Key
+from broadcast import broadcast, client_config, prune_gone
+import log_util
+from room_cache import bump_version
+import runtime
 
 
 class EnvironParam(NamedTuple):
@@ -17,6 +19,9 @@ class EnvironParam(NamedTuple):
     ROOM_TABLE_NAME: str
     ROOM_TABLE_PKEY: str
     ROOM_TABLE_SKEY: str
+    GAME_TABLE_NAME: str
+    GAME_TABLE_PKEY: str
+    GAME_TABLE_SKEY: str
     ENDPOINT_URL: str
 
     @classmethod
@@ -27,10 +32,10 @@ class EnvironParam(NamedTuple):
 ep = EnvironParam.from_env()
 logger = logging.getLogger()
 logger.setLevel(ep.LOG_LEVEL)
-dynamodb = boto3.resource("dynamodb")
-apigw = boto3.client("apigatewaymanagementapi", endpoint_url=ep.ENDPOINT_URL)
-user_table = dynamodb.Table(ep.USER_TABLE_NAME)
-room_table = dynamodb.Table(ep.ROOM_TABLE_NAME)
+apigw = runtime.client("apigatewaymanagementapi", endpoint_url=ep.ENDPOINT_URL, config=client_config)
+user_table = runtime.table(ep.USER_TABLE_NAME)
+room_table = runtime.table(ep.ROOM_TABLE_NAME)
+game_table = runtime.table(ep.GAME_TABLE_NAME)
 
 
 class BodySchema(NamedTuple):
@@ -61,6 +66,8 @@ def put_item(connection_id: str, body: BodySchema) -> None:
             Item={
                 ep.ROOM_TABLE_PKEY: body.room_id,
                 ep.ROOM_TABLE_SKEY: connection_id,
+                # 入室時にメンバー一覧を作るためroomテーブルにも名前を持たせる
+                "user_name": body.user_name,
             }
         )
     except Exception as e:
@@ -68,34 +75,20 @@ def put_item(connection_id: str, body: BodySchema) -> None:
         raise DoNotRetryException from e
 
 
-def post_one_user(user_name: str, connection_id: str):
+def post_room_state(owner_connection_id: str, user_names: list[str]) -> None:
+    # 入室者にはメンバー全員の名前を1通でまとめて送る
     try:
         apigw.post_to_connection(
-            Data=json.dumps({"command": "enter_room", "name": user_name}).encode(),
-            ConnectionId=connection_id,
+            Data=json.dumps({"command": "room_state", "names": user_names}).encode(),
+            ConnectionId=owner_connection_id,
         )
     except Exception as e:
         logger.exception("post_to_connection")
         raise DoNotRetryException from e
 
 
-def post_all_user(owner_connection_id: str, connection_ids: list[str]) -> None:
-    for connection_id in connection_ids:
-        try:
-            res = user_table.get_item(
-                Key={
-                    ep.USER_TABLE_PKEY: connection_id,
-                    ep.USER_TABLE_SKEY: "info",
-                }
-            )
-            user_name = res["Item"]["user_name"]
-        except Exception as e:
-            logger.exception("get_item")
-            raise DoNotRetryException from e
-        post_one_user(user_name, owner_connection_id)
-
-
 def post_room(owner_connection_id: str, body: BodySchema) -> None:
+    from boto3.dynamodb.conditions import Key
     try:
         items = room_table.query(
             KeyConditionExpression=Key(ep.ROOM_TABLE_PKEY).eq(body.room_id)
@@ -104,20 +97,31 @@ def post_room(owner_connection_id: str, body: BodySchema) -> None:
     except Exception as e:
         logger.exception("query")
         raise DoNotRetryException from e
-    for connection_id in connection_ids:
-        if connection_id == owner_connection_id:
-            post_all_user(owner_connection_id, connection_ids)
-        else:
-            post_one_user(body.user_name, connection_id)
+    results = broadcast(
+        apigw,
+        [connection_id for connection_id in connection_ids if connection_id != owner_connection_id],
+        {"command": "enter_room", "name": body.user_name},
+    )
+    # 切断済みの接続はテーブルから削除し, 入室者に送るメンバー一覧からも除く
+    gone = prune_gone(
+        results, body.room_id, room_table, (ep.ROOM_TABLE_PKEY, ep.ROOM_TABLE_SKEY),
+        user_table, (ep.USER_TABLE_PKEY, ep.USER_TABLE_SKEY),
+    )
+    post_room_state(
+        owner_connection_id,
+        [item["user_name"] for item in items if "user_name" in item and item[ep.ROOM_TABLE_SKEY] not in gone],
+    )
 
 
 def service(connection_id: str, body: BodySchema) -> None:
     put_item(connection_id, body)
+    # start_gameのメンバーのキャッシュを無効にする(roomテーブルに書いた後に上げる)
+    bump_version(game_table, (ep.GAME_TABLE_PKEY, ep.GAME_TABLE_SKEY), body.room_id)
     post_room(connection_id, body)
 
 
 def lambda_handler(event, context):
-    logger.info(json.dumps(event, indent=2))
+    log_util.debug(logger, "event", event, log_util.connection_id_of(event))
     try:
         service(event["requestContext"]["connectionId"], BodySchema.from_event(event))
         return {
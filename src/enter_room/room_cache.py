@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+import logging
+from typing import Any
+
+logger = logging.getLogger()
+
+# start_gameがtickのたびに読むgameテーブルの行と, 部屋のメンバーが変わるたびに加算するバージョン
+ROUND_SKEY = "round"
+VERSION_ATTR = "members_version"
+
+
+def bump_version(game_table: Any, keys: tuple[str, str], room_id: str) -> None:
+    # roomテーブルを書き換えた後に呼ぶ(先に上げると, 書き換え前のメンバーが新しいバージョンでキャッシュされる)
+    # ゲームを始める前は行がなく, キャッシュもまだないので上げない
+    from boto3.dynamodb.conditions import Attr
+    try:
+        game_table.update_item(
+            Key={keys[0]: room_id, keys[1]: ROUND_SKEY},
+            UpdateExpression="ADD #version :one",
+            ExpressionAttributeNames={"#version": VERSION_ATTR},
+            ExpressionAttributeValues={":one": 1},
+            ConditionExpression=Attr(keys[0]).exists(),
+        )
+    except game_table.meta.client.exceptions.ConditionalCheckFailedException:
+        ...
+    except Exception:
+        # 上げ損ねてもTTLが切れれば読み直されるので処理は止めない
+        logger.exception("bump_version")
@@ -1,11 +1,11 @@
 from __future__ import annotations
 
 import os
-import json
 import logging
 from typing import NamedTuple
 
-import boto3
+import log_util
+import runtime
 
 
 class EnvironParam(NamedTuple):
@@ -22,12 +22,11 @@ class EnvironParam(NamedTuple):
 ep = EnvironParam.from_env()
 logger = logging.getLogger()
 logger.setLevel(ep.LOG_LEVEL)
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(ep.USER_TABLE_NAME)
+table = runtime.table(ep.USER_TABLE_NAME)
 
 
 def lambda_handler(event, context):
-    logger.info(json.dumps(event, indent=2))
+    log_util.debug(logger, "event", event, log_util.connection_id_of(event))
     try:
         table.put_item(
             Item={
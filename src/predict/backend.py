@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import os
+import logging
+import threading
+from typing import Any
+
+import numpy as np
+
+logger = logging.getLogger()
+
+# MODEL_PREWARM=0 なら初期化フェーズでモデルを読み込まない(importtimeの計測などで使う)
+PREWARM = os.environ.get("MODEL_PREWARM", "1") != "0"
+
+
+class KerasBackend:
+    # TensorFlow本体を読み込むので重いが, model.h5をそのまま使える
+    name = "keras"
+
+    def __init__(self, path: str = "model.h5") -> None:
+        from tensorflow.keras.models import load_model
+        self.model = load_model(path)
+
+    def predict(self, imgs: np.ndarray) -> np.ndarray:
+        return self.model.predict(imgs)
+
+
+class TFLiteBackend:
+    # export_model.pyで変換したmodel.tfliteをtflite_runtimeで直接実行する
+    name = "tflite"
+
+    def __init__(self, path: str = "model.tflite") -> None:
+        from tflite_runtime.interpreter import Interpreter
+        self.interpreter = Interpreter(model_path=path)
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.input_shape = None
+
+    def predict(self, imgs: np.ndarray) -> np.ndarray:
+        # バッチサイズが変わったときだけテンソルを確保し直す
+        if self.input_shape != imgs.shape:
+            self.interpreter.resize_tensor_input(self.input_index, imgs.shape)
+            self.interpreter.allocate_tensors()
+            self.input_shape = imgs.shape
+        self.interpreter.set_tensor(self.input_index, imgs.astype(np.float32, copy=False))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index).copy()
+
+
+BACKENDS = {
+    "tflite": TFLiteBackend,
+    "keras": KerasBackend,
+}
+
+
+def load_backend(name: str) -> KerasBackend | TFLiteBackend:
+    # 指定のバックエンドが使えなければKerasにフォールバックする
+    try:
+        return BACKENDS[name]()
+    except Exception:
+        if name == "keras":
+            raise
+        logger.exception(f"load_backend: {name} is unavailable, fall back to keras")
+        return KerasBackend()
+
+
+def prewarm(model: Any) -> threading.Thread | None:
+    # Lambdaの初期化フェーズ(CPUが多めに割り当てられる)のうちに別スレッドでmodel(runtime.LazySingleton)を作り始める
+    # 失敗してもここでは握りつぶし, 最初のget()でもう一度作る
+    if not PREWARM:
+        return None
+
+    def run() -> None:
+        try:
+            model.get()
+        except Exception:
+            logger.exception("prewarm")
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+import sys
+
+import numpy as np
+import tensorflow as tf
+
+# 変換後のモデルが元のモデルと同じ上位5件を返すことを確かめる入力の数と, 確率の差の許容値
+PARITY_SAMPLES = 64
+PARITY_ATOL = 1e-5
+
+
+def top5(scores: np.ndarray) -> np.ndarray:
+    return np.argsort(-scores, axis=1, kind="stable")[:, :5]
+
+
+def check_parity(model: tf.keras.Model, dst: str, samples: int = PARITY_SAMPLES) -> None:
+    # 28x28の入力を乱数で作り, Kerasとtfliteで上位5件と確率が一致しなければ失敗させる(イメージのビルドを止める)
+    imgs = np.random.default_rng(0).random((samples, 28, 28), dtype=np.float32)
+    expected = model.predict(imgs, verbose=0)
+    interpreter = tf.lite.Interpreter(model_path=dst)
+    input_index = interpreter.get_input_details()[0]["index"]
+    output_index = interpreter.get_output_details()[0]["index"]
+    interpreter.resize_tensor_input(input_index, imgs.shape)
+    interpreter.allocate_tensors()
+    interpreter.set_tensor(input_index, imgs)
+    interpreter.invoke()
+    actual = interpreter.get_tensor(output_index)
+    if not np.array_equal(top5(expected), top5(actual)):
+        raise ValueError(f"{dst}: top-5 labels differ from the keras model")
+    diff = float(np.abs(expected - actual).max())
+    if diff > PARITY_ATOL:
+        raise ValueError(f"{dst}: max abs diff {diff} > {PARITY_ATOL}")
+
+
+def export(src: str = "model.h5", dst: str = "model.tflite") -> None:
+    model = tf.keras.models.load_model(src)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    with open(dst, "wb") as f:
+        f.write(converter.convert())
+    check_parity(model, dst)
+
+
+if __name__ == "__main__":
+    export(*sys.argv[1:])
@@ -1,18 +1,26 @@
 from __future__ import annotations
 
 import os
-import csv
-import uuid
-import base64
+import io
+import time
+import binascii
 import json
 import logging
-from typing import Any, NamedTuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from decimal import Decimal
+from typing import TYPE_CHECKING, Any, Callable, NamedTuple
 
-import boto3
-import cv2
 import numpy as np
-from PIL import Image
-from tensorflow.keras.models import load_model
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+from backend import load_backend, prewarm
+import log_util
+from labels import LabelRegistry
+from metrics import StageTimer, emf_record, emit, queue_metrics
+import runtime
+from shedding import SheddingConfig, busy_targets, shed
 
 
 class EnvironParam(NamedTuple):
@@ -23,6 +31,13 @@ class EnvironParam(NamedTuple):
     RESULT_BUCKET_NAME: str
     RESULT_BUCKET_KEY: str
     ENDPOINT_URL: str
+    MODEL_BACKEND: str
+    GAME_TABLE_NAME: str
+    GAME_TABLE_PKEY: str
+    GAME_TABLE_SKEY: str
+    SHED_QUEUE_AGE_MS: str
+    SHED_FRAME_AGE_MS: str
+    SHED_MODE: str
 
     @classmethod
     def from_env(cls) -> EnvironParam:
@@ -32,11 +47,27 @@ class EnvironParam(NamedTuple):
 ep = EnvironParam.from_env()
 logger = logging.getLogger()
 logger.setLevel(ep.LOG_LEVEL)
-dynamodb = boto3.resource("dynamodb")
-apigw = boto3.client("apigatewaymanagementapi", endpoint_url=ep.ENDPOINT_URL)
-user_table = dynamodb.Table(ep.USER_TABLE_NAME)
-s3 = boto3.client("s3")
-reconstructed_model = load_model("model.h5")
+apigw = runtime.client("apigatewaymanagementapi", endpoint_url=ep.ENDPOINT_URL)
+user_table = runtime.table(ep.USER_TABLE_NAME)
+game_table = runtime.table(ep.GAME_TABLE_NAME)
+s3 = runtime.client("s3")
+# モデルは初期化フェーズのうちに別スレッドで読み込み始め, 推論するときに読み込みの完了を待つ
+reconstructed_model = runtime.LazySingleton(lambda: load_backend(ep.MODEL_BACKEND))
+prewarm(reconstructed_model)
+# コンテナ起動からの受信フレーム数と, 新しいフレームがあるため推論しなかったフレーム数, 処理済みのため推論しなかったフレーム数
+coalesce_counter = {"received": 0, "skipped": 0, "duplicated": 0, "shed": 0}
+shedding_config = SheddingConfig.from_env(ep.SHED_QUEUE_AGE_MS, ep.SHED_FRAME_AGE_MS, ep.SHED_MODE)
+# busyを返した接続と, 送ってくるのを再開する時刻(epoch ms)
+busy_until: dict[str, int] = {}
+# コンテナ起動後の最初の呼び出しだけTrue
+cold_start = True
+# 最終フレームの保存(S3, DynamoDB)は結果を返した後にバックグラウンドで行う
+persist_executor = ThreadPoolExecutor(max_workers=4)
+PERSIST_RETRY = 3
+labels = LabelRegistry.from_csv()
+label_names = np.array(labels.names)
+# クライアントでモデルの入力サイズ(28x28)まで切り抜き・縮小した筆跡の濃さ(uint8)を送る軽量フォーマット
+INK28_HEADER = "data:application/x-ink28;base64"
 
 
 class BodySchema(NamedTuple):
@@ -44,11 +75,28 @@ class BodySchema(NamedTuple):
     odai: str
     is_fin: bool
     img_id: str
+    n_top: int = 5
 
     @classmethod
     def from_event(cls, event: dict[str, Any]) -> BodySchema:
-        body = json.loads(event["body"])
-        return BodySchema(**{k: body[k] for k in BodySchema._fields})
+        return BodySchema.from_body(json.loads(event["body"]))
+
+    @classmethod
+    def from_body(cls, body: dict[str, Any]) -> BodySchema:
+        fields = {k: body[k] for k in BodySchema._fields if k in body}
+        # n_topはクライアントが決めるので, 数値でなければ不正なフレームとし, 範囲外なら丸める
+        if "n_top" in fields:
+            try:
+                n_top = int(fields["n_top"])
+            except (TypeError, ValueError) as e:
+                raise InvalidFrameException(f"n_top: {fields['n_top']!r}") from e
+            fields["n_top"] = max(1, min(n_top, len(labels.names)))
+        return BodySchema(**fields)
+
+
+class InvalidFrameException(Exception):
+    # 何度受け取り直しても処理できないフレーム. SQSに戻さずに捨てる
+    ...
 
 
 class UDbInfoSchema(NamedTuple):
@@ -60,42 +108,199 @@ class UDbInfoSchema(NamedTuple):
         return UDbInfoSchema(**{k: response["Item"][k] for k in UDbInfoSchema._fields})
 
 
+class Frame(NamedTuple):
+    message_id: str
+    connection_id: str
+    requested_at: int
+    body: BodySchema
+    timer: StageTimer
+    # SQSのSentTimestampとApproximateFirstReceiveTimestamp(epoch ms)
+    sent_at: int = 0
+    first_received_at: int = 0
+    # SQSのApproximateReceiveCount. 2以上なら再配信
+    receive_count: int = 1
+    image: FrameImage | None = None
+    img: numpy.array | None = None
+
+    @classmethod
+    def from_record(cls, record: dict[str, Any]) -> Frame:
+        message = json.loads(record["body"])
+        attributes = record.get("attributes", {})
+        common = {
+            "message_id": record["messageId"],
+            "timer": StageTimer(),
+            "sent_at": int(attributes.get("SentTimestamp", 0)),
+            "first_received_at": int(attributes.get("ApproximateFirstReceiveTimestamp", 0)),
+            "receive_count": int(attributes.get("ApproximateReceiveCount", 1)),
+        }
+        # predict_queueのエンベロープ(v1)なら画像を含めて1回のjson.loadsで済む
+        if message.get("v") == 1:
+            return Frame(
+                connection_id=message["connection_id"],
+                requested_at=message["requested_at"],
+                body=BodySchema.from_body({**message["frame"], "img_b64": message["img_b64"]}),
+                **common,
+            )
+        # 以前のAPI Gatewayのイベントをそのまま送っていた形式
+        event = message
+        return Frame(
+            connection_id=event["requestContext"]["connectionId"],
+            requested_at=event["requestContext"]["requestTimeEpoch"],
+            body=BodySchema.from_event(event),
+            **common,
+        )
+
+
+class FrameImage(NamedTuple):
+    # data-URLを1回だけデコードしたもの. 前処理とS3への保存で使い回す
+    header: str
+    raw: bytes
+
+    @classmethod
+    def from_data_url(cls, img_b64: str) -> FrameImage:
+        # split(",")のようにリストやヘッダー分の文字列を作らず, 画像部分を1回だけ切り出してデコードする
+        # (切り出しで base64 の文字列の大きさのコピーが1回できる. 詳しくはtools/bench_frames.py decode)
+        i = img_b64.find(",")
+        if i == -1:
+            raise InvalidFrameException(f"img_b64 is not a data-URL: {img_b64[:32]!r}")
+        try:
+            image = FrameImage(header=img_b64[:i], raw=binascii.a2b_base64(img_b64[i+1:]))
+        except (binascii.Error, ValueError) as e:
+            raise InvalidFrameException(f"img_b64: {img_b64[:i]!r}") from e
+        # 軽量フォーマットはそのまま28x28に並べ直すので, 大きさが違えば読めない
+        if image.is_ink28 and len(image.raw) != 28 * 28:
+            raise InvalidFrameException(f"img_b64: {INK28_HEADER} must be {28 * 28} bytes: {len(image.raw)}")
+        return image
+
+    @property
+    def is_ink28(self) -> bool:
+        return self.header == INK28_HEADER
+
+    def to_file(self) -> bytes:
+        # 軽量フォーマットは画像ファイルではないのでPNGにして保存する
+        if self.is_ink28:
+            import cv2
+            return cv2.imencode(".png", np.frombuffer(self.raw, np.uint8).reshape(28, 28))[1].tobytes()
+        return self.raw
+
+
 class DoNotRetryException(Exception):
     ...
 
 
-def upload_img(connection_id: str, img_b64: str) -> str:
-    key = f"{ep.RESULT_BUCKET_KEY}/{connection_id}/{uuid.uuid4()}.png"
+class RetryableException(Exception):
+    # 最終フレームの保存の各段階の一時的な失敗. with_retryで時間をおいてやり直す
+    ...
+
+
+def upload_img(connection_id: str, body: BodySchema, image: FrameImage) -> str:
+    # リトライや再配信で同じフレームを何度保存しても同じオブジェクトになるようimg_idからキーを決める
+    key = f"{ep.RESULT_BUCKET_KEY}/{connection_id}/{body.img_id}.png"
     try:
         s3.put_object(
-            Body=base64.b64decode(img_b64.split(",")[1]),
+            Body=image.to_file(),
             Bucket=ep.RESULT_BUCKET_NAME,
             Key=key,
         )
         return key
     except Exception as e:
         logger.exception("put_object")
-        raise DoNotRetryException from e
+        raise RetryableException from e
 
 
-def put_item(connection_id: str, body: BodySchema, label_score_map: dict[str, float], key: str) -> None:
+def put_item(connection_id: str, message_id: str, body: BodySchema, score: float, key: str) -> None:
+    # 保存の最後に書くので, この行に同じmessage_idがあれば(is_processed)そのメッセージの処理は完了している
+    # 同じメッセージの書き込みが重なった場合は先に書いた方を残す
+    from boto3.dynamodb.conditions import Attr
     try:
         user_table.put_item(
             Item={
                 ep.USER_TABLE_PKEY: connection_id,
                 ep.USER_TABLE_SKEY: str(body.img_id),
                 "key": key,
-                "score": str(label_score_map[body.odai]),
-            }
+                "score": str(score),
+                "message_id": message_id,
+            },
+            ConditionExpression=Attr("message_id").not_exists() | Attr("message_id").ne(message_id),
         )
+    except user_table.meta.client.exceptions.ConditionalCheckFailedException:
+        logger.info(f"put_item: {message_id} is already saved")
     except Exception as e:
         logger.exception("put_item")
-        raise DoNotRetryException from e
+        raise RetryableException from e
+
+
+def is_processed(frame: Frame) -> bool:
+    # SQSは同じメッセージを2回以上届けることがあるので, 保存まで終わった最終フレームは推論からやり直さない
+    try:
+        res = user_table.get_item(
+            Key={
+                ep.USER_TABLE_PKEY: frame.connection_id,
+                ep.USER_TABLE_SKEY: str(frame.body.img_id),
+            },
+            ConsistentRead=True,
+        )
+        return res.get("Item", {}).get("message_id") == frame.message_id
+    except Exception:
+        # 読めなければ処理済みでないとみなす(保存は条件付きなのでやり直しても二重にはならない)
+        logger.exception("get_item")
+        return False
+
+
+def get_info(connection_id: str) -> UDbInfoSchema:
+    try:
+        res = user_table.get_item(
+            Key={
+                ep.USER_TABLE_PKEY: connection_id,
+                ep.USER_TABLE_SKEY: "info",
+            }
+        )
+    except Exception as e:
+        logger.exception("get_item")
+        raise RetryableException from e
+    # 退室済みなどで行がなければ, やり直しても読めない
+    if "Item" not in res:
+        raise DoNotRetryException(f"get_info: {connection_id} is not in a room")
+    return UDbInfoSchema.from_db(res)
+
+
+def add_score(connection_id: str, info: UDbInfoSchema, body: BodySchema, score: float) -> None:
+    # 部屋ごとの合計点をUpdateItemのADDで加算していくので, 順位表は人数やお題数によらず1回のget_itemで読める
+    # 加算したimg_idをcounted#<接続ID>に記録し, 同じ最終フレームが再配信されても二重に加算しない
+    # (順位表はゲーム開始時に作り直されるので, img_id(ラウンド番号)はゲーム内で一意なら足りる)
+    from boto3.dynamodb.conditions import Attr
+    counted = f"counted#{connection_id}"
+    try:
+        game_table.update_item(
+            Key={
+                ep.GAME_TABLE_PKEY: info.room_id,
+                ep.GAME_TABLE_SKEY: "leaderboard",
+            },
+            UpdateExpression="ADD #score :score, #rounds :one, #counted :img_id SET #name = :name",
+            ConditionExpression=~Attr(counted).contains(str(body.img_id)),
+            ExpressionAttributeNames={
+                "#score": f"score#{connection_id}",
+                "#rounds": f"rounds#{connection_id}",
+                "#counted": counted,
+                "#name": f"name#{connection_id}",
+            },
+            ExpressionAttributeValues={
+                ":score": Decimal(str(score)),
+                ":one": 1,
+                ":img_id": {str(body.img_id)},
+                ":name": info.user_name,
+            },
+        )
+    except game_table.meta.client.exceptions.ConditionalCheckFailedException:
+        logger.info(f"add_score: {body.img_id} of {connection_id} is already counted")
+    except Exception as e:
+        logger.exception("update_item")
+        raise RetryableException from e
 
 
 def post_result(connection_id: str, scores: list[dict[str, float]], command: str) -> None:
-    data = {"command": command, "scores": scores[:5]}
-    logger.info(data)
+    data = {"command": command, "scores": scores}
+    log_util.debug(logger, "post_result", data, connection_id)
     data_bin = json.dumps(data).encode()
     try:
         apigw.post_to_connection(
@@ -103,81 +308,268 @@ def post_result(connection_id: str, scores: list[dict[str, float]], command: str
             ConnectionId=connection_id,
         )
     except Exception as e:
-        logger.exception("delete_item_error")
-        raise DoNotRetryException from e
+        # 切断済みの接続(GoneException)には何度受け取り直しても返せない. それ以外(スロットリングなど)はSQSに戻してやり直す
+        from botocore.exceptions import ClientError
+        if isinstance(e, ClientError) and e.response["Error"]["Code"] == "GoneException":
+            raise DoNotRetryException(f"post_result: {connection_id} is gone") from e
+        logger.exception("post_result")
+        raise
+
 
+def post_busy(connection_id: str, retry_after_ms: int) -> None:
+    # 返せなくても落とした途中経過の代わりなので処理は止めない
+    try:
+        apigw.post_to_connection(
+            Data=json.dumps({"command": "busy", "retry_after_ms": retry_after_ms}).encode(),
+            ConnectionId=connection_id,
+        )
+    except Exception:
+        logger.exception("post_busy")
 
-def preprocessing(img_b64: str) -> numpy.array:
-    # いったん保存する(それ以外の方法で画像を読み込むやり方が分からなかった)
-    path = f"/tmp/{uuid.uuid4()}.png"
-    with open(path, "wb") as f:
-        f.write(base64.b64decode(img_b64.split(",")[1]))
+
+def decode_img(image: FrameImage) -> Image.Image:
+    # data-URL(PNG/JPEG)をファイルを経由せずにメモリ上でデコードする
+    # PIL, cv2は途中経過(x-ink28)だけなら使わないので, 必要になったときに読み込む
+    from PIL import Image
+    # Image.openはヘッダーしか読まないので, 壊れた画像もここで読み切って何度受け取り直しても読めないフレームとして扱う
+    try:
+        img = Image.open(io.BytesIO(image.raw))
+        img.load()
+        return img
+    except (OSError, ValueError, SyntaxError) as e:
+        raise InvalidFrameException(f"decode_img: {image.header!r}") from e
+
+
+def to_ink(img: Image.Image) -> Image.Image:
+    # PNGは透過背景なのでアルファ値, JPEGは白背景なので輝度の反転を筆跡の濃さとする
+    from PIL import ImageOps
+    if img.mode == "RGBA":
+        return img
+    return ImageOps.invert(img.convert("L"))
+
+
+def preprocessing(image: FrameImage) -> numpy.array:
+    # 軽量フォーマットはクライアントで切り抜き・縮小済みなので正規化するだけ
+    if image.is_ink28:
+        return np.frombuffer(image.raw, np.uint8).reshape(28, 28) / np.float32(255.)
+    import cv2
     # 読み込み
-    img = Image.open(path)
+    img = to_ink(decode_img(image))
     # 画像の切り抜き
     img = img.crop(img.getbbox())
     # グレースケール化
-    img = np.array(img)[:,:,3]
+    img = np.array(img)
+    if img.ndim == 3:
+        img = img[:,:,3]
     # 画像のリサイズ
     x, y = img.shape
     if x < y:
         img = cv2.resize(img, (26, min(x*26//y+1, 26)))
     else:
         img = cv2.resize(img,(min(y*26//x+1, 26), 26))
-    # 28*28の背景にリサイズした画像を張り付け
-    img_back = np.zeros((28, 28), np.uint8)
+    # 28*28の背景の中央にリサイズした画像を張り付け
+    # (モデルへの入力はfloat32なので最初からfloat32で確保してその場で正規化する)
+    img_back = np.zeros((28, 28), np.float32)
     x, y = img.shape
-    for i in range(x):
-        for j in range(y):
-            img_back[i+(28-x)//2][j+(28-y)//2] += img[i][j]
-    img = img_back
+    top, left = (28-x)//2, (28-y)//2
+    img_back[top:top+x, left:left+y] = img
     # 正規化
-    img = img / 255.
-    return img
-
-
-def get_index_label_map() -> dict[int, str]:
-    with open("label.csv", "r", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        index_label_map = {int(l[1]): l[0] for i, l in enumerate(reader) if i != 0}
-    with open("en2jp.csv", "r", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        en2jp = {l[0]: l[1] for l in reader}
-    return {k: en2jp.get(v, v) for k, v in index_label_map.items()}
-
-
-def predict(img_b64: str) -> tuple(dict[str, float], list[dict[str, float]]):
-    img = preprocessing(img_b64)
-    result = reconstructed_model.predict(img.reshape(1, 28, 28))
-    index_score_map = dict(zip(range(len(result[0])), result[0]*10000))
-    index_label_map = get_index_label_map()
-    label_score_map = {index_label_map[k]: float(v) for k, v in index_score_map.items()}
-    scores = [{"key": x[0], "value": x[1]} for x in sorted(label_score_map.items(), key=lambda x: x[1], reverse=True)]
-    return (label_score_map, scores)
-
-
-def service(connection_id: str, body: BodySchema) -> None:
-    label_score_map, scores = predict(body.img_b64)
+    img_back /= 255.
+    return img_back
+
+
+def top_k(result: numpy.array, k: int) -> list[dict[str, float]]:
+    # 全クラスをソートせず上位k件だけを取り出してから並べる
+    k = min(k, len(result))
+    top = np.argpartition(-result, k-1)[:k]
+    # 同点の場合はindex順
+    top = top[np.lexsort((top, -result[top]))]
+    return [{"key": key, "value": value} for key, value in zip(label_names[top].tolist(), result[top].tolist())]
+
+
+def shed_load(frames: list[Frame], now: int) -> list[Frame]:
+    kept, dropped = shed(frames, now, shedding_config)
+    if not dropped:
+        return frames
+    coalesce_counter["shed"] += len(dropped)
+    log_util.info(logger, "shed", {"shed": len(dropped), "mode": shedding_config.mode, "total": coalesce_counter})
+    if shedding_config.mode == "busy":
+        # 推論の代わりに接続ごとに1回だけ混雑中であることを返す. クライアントは少しの間送るのを控える
+        for connection_id in busy_targets(dropped, now, busy_until, shedding_config.frame_age_ms):
+            post_busy(connection_id, shedding_config.frame_age_ms)
+    return kept
+
+
+def coalesce(frames: list[Frame]) -> list[Frame]:
+    # 同じ接続からより新しいフレームが届いている途中経過(is_fin: false)は推論しない
+    # SQS(標準キュー)は順序を保証しないのでAPI Gatewayの受信時刻で比較する
+    latest: dict[str, int] = {}
+    for frame in frames:
+        latest[frame.connection_id] = max(latest.get(frame.connection_id, 0), frame.requested_at)
+    coalesced = [frame for frame in frames if frame.body.is_fin or frame.requested_at >= latest[frame.connection_id]]
+    coalesce_counter["received"] += len(frames)
+    coalesce_counter["skipped"] += len(frames) - len(coalesced)
+    # 毎回出すと呼び出しごとにINFOが1行増えるので, 推論しないフレームがあったときだけ出す
+    if len(coalesced) < len(frames):
+        log_util.info(logger, "coalesce", {"received": len(frames), "skipped": len(frames) - len(coalesced), "total": coalesce_counter})
+    return coalesced
+
+
+def skip_processed(frames: list[Frame]) -> list[Frame]:
+    # 再配信された最終フレームのうち保存まで終わっているものは, 推論も返信もせず成功として扱う
+    # (途中経過は保存しないので, 再配信されても推論して返すだけ)
+    # 初めて受け取ったメッセージは処理済みのはずがないので, 最終フレームごとのget_item(強い整合性の読み込み)は再配信のときだけ行う
+    # 受信回数が1のまま重複して届いても, 加算と保存は条件付きなので二重にはならない
+    unprocessed = [frame for frame in frames if not (frame.body.is_fin and frame.receive_count > 1 and is_processed(frame))]
+    coalesce_counter["duplicated"] += len(frames) - len(unprocessed)
+    if len(unprocessed) < len(frames):
+        log_util.info(logger, "skip_processed", {"skipped": len(frames) - len(unprocessed), "total": coalesce_counter})
+    return unprocessed
+
+
+def predict(imgs: list[numpy.array]) -> numpy.array:
+    # SQSのバッチ内の画像をまとめて1回で推論する
+    return reconstructed_model.get().predict(np.stack(imgs)) * 10000
+
+
+def with_retry(fn: Callable[..., Any], *args: Any) -> Any:
+    for retry in range(PERSIST_RETRY):
+        try:
+            return fn(*args)
+        except RetryableException:
+            if retry == PERSIST_RETRY - 1:
+                raise
+            time.sleep(0.1 * 2**retry)
+
+
+def persist(connection_id: str, message_id: str, body: BodySchema, image: FrameImage, score: float, timer: StageTimer) -> None:
+    # どの段階も再実行して構わない(キーが決まっている, 条件付きで書く)ので, 途中で失敗したメッセージは最初からやり直す
+    # 処理済みの印になるPutItemは最後に行う
+    with timer.stage("UploadImg"):
+        key = with_retry(upload_img, connection_id, body, image)
+    with timer.stage("AddScore"):
+        info = with_retry(get_info, connection_id)
+        with_retry(add_score, connection_id, info, body, score)
+    with timer.stage("PutItem"):
+        with_retry(put_item, connection_id, message_id, body, score, key)
+
+
+def service(connection_id: str, message_id: str, body: BodySchema, image: FrameImage, result: numpy.array, timer: StageTimer) -> Future | None:
+    with timer.stage("TopK"):
+        scores = top_k(result, body.n_top)
     if body.is_fin:
-        key = upload_img(connection_id, body.img_b64)
-        put_item(connection_id, body, label_score_map, key)
-        post_result(connection_id, scores, "img_save")
-    else:
+        score = float(result[labels.label_index_map[body.odai]])
+        # 保存を待たずに先に結果を返す. 返せなくても(切断済みでも)得点と画像は保存する
+        # 保存が終わった最終フレームは再配信されても返し直さないので, 返信の失敗ではSQSに戻さない
+        try:
+            with timer.stage("PostResult"):
+                post_result(connection_id, scores, "img_save")
+        except Exception:
+            logger.warning(f"post_result: {message_id} is saved without reply", exc_info=True)
+        return persist_executor.submit(persist, connection_id, message_id, body, image, score, timer)
+    with timer.stage("PostResult"):
         post_result(connection_id, scores, "predict")
+    return None
+
+
+def emit_metrics(frame: Frame, batch_size: int, is_cold: bool) -> None:
+    # フレームごとの記録にはそのフレームだけにかかった時間を載せる(バッチ全体の段階はemit_batch_metricsで1回だけ出す)
+    now = int(time.time() * 1000)
+    emit(emf_record(
+        metrics={
+            **queue_metrics(frame.sent_at, frame.first_received_at, now),
+            **frame.timer.stages,
+        },
+        dimensions={"Service": "predict", "Command": "img_save" if frame.body.is_fin else "predict"},
+        # フォールバックしたときに気付けるよう, 実際に使っているバックエンドも記録する
+        properties={
+            "ColdStart": is_cold,
+            "BatchSize": batch_size,
+            "MessageId": frame.message_id,
+            "ModelBackend": reconstructed_model.get().name,
+        },
+        now_ms=now,
+    ))
+
+
+def emit_batch_metrics(batch_timer: StageTimer, n_records: int, batch_size: int, is_cold: bool) -> None:
+    # Parse/Shed/Dedup/Inferenceはバッチ全体で1回なので, フレームの数だけ重複して集計されないよう呼び出しごとに1回出す
+    now = int(time.time() * 1000)
+    emit(emf_record(
+        metrics=batch_timer.stages,
+        dimensions={"Service": "predict", "Command": "batch"},
+        properties={"ColdStart": is_cold, "Records": n_records, "BatchSize": batch_size},
+        now_ms=now,
+    ))
 
 
 def lambda_handler(event, context):
-    logger.info(json.dumps(event, indent=2))
-    for record in event["Records"]:
-        body = json.loads(record["body"])
+    global cold_start
+    is_cold, cold_start = cold_start, False
+    log_util.debug(logger, "event", event)
+    batch_timer = StageTimer()
+    received: list[Frame] = []
+    frames: list[Frame] = []
+    failures: list[str] = []
+    with batch_timer.stage("Parse"):
+        for record in event["Records"]:
+            try:
+                received.append(Frame.from_record(record))
+            except InvalidFrameException:
+                logger.warning(f"invalid frame: {record['messageId']}", exc_info=True)
+            except:
+                logger.exception("ERROR")
+                failures.append(record["messageId"])
+    with batch_timer.stage("Shed"):
+        received = shed_load(received, int(time.time() * 1000))
+    with batch_timer.stage("Dedup"):
+        received = skip_processed(coalesce(received))
+    for frame in received:
         try:
-            service(body["requestContext"]["connectionId"], BodySchema.from_event(body))
+            with frame.timer.stage("Decode"):
+                image = FrameImage.from_data_url(frame.body.img_b64)
+            with frame.timer.stage("Preprocessing"):
+                img = preprocessing(image)
+            # デコードした後はbase64の文字列を持ち続けない
+            frames.append(frame._replace(body=frame.body._replace(img_b64=""), image=image, img=img))
+        except InvalidFrameException:
+            # 画像が壊れているフレームは何度受け取り直しても読めないのでSQSに戻さずに捨てる
+            logger.warning(f"invalid frame: {frame.message_id}", exc_info=True)
         except:
             logger.exception("ERROR")
-            return {
-                "statusCode": 500,
-            }
+            failures.append(frame.message_id)
+    try:
+        with batch_timer.stage("Inference"):
+            results = predict([frame.img for frame in frames]) if frames else []
+    except:
+        logger.exception("ERROR")
+        failures.extend(frame.message_id for frame in frames)
+        results, frames = [], []
+    pending: list[tuple[Frame, Future]] = []
+    for frame, result in zip(frames, results):
+        try:
+            future = service(frame.connection_id, frame.message_id, frame.body, frame.image, result, frame.timer)
+            if future is not None:
+                pending.append((frame, future))
+        except DoNotRetryException:
+            # 切断済みなどやり直しても成功しないフレームはSQSに戻さずに捨てる(戻すとDLQに入るまで推論し直す)
+            logger.warning(f"dropped frame: {frame.message_id}", exc_info=True)
+        except:
+            logger.exception("ERROR")
+            failures.append(frame.message_id)
+    # 戻り値を返すとコンテナが止まるので, 保存が終わるまではこの呼び出しの中で待つ
+    for frame, future in pending:
+        try:
+            future.result()
+        except DoNotRetryException:
+            logger.warning(f"dropped frame: {frame.message_id}", exc_info=True)
+        except:
+            logger.exception("ERROR")
+            failures.append(frame.message_id)
+    emit_batch_metrics(batch_timer, len(event["Records"]), len(frames), is_cold)
+    for frame in frames:
+        emit_metrics(frame, len(frames), is_cold)
+    # 失敗したレコードだけをSQSに戻す(ReportBatchItemFailures)
     return {
-                "statusCode": 200,
-            }
-
+        "batchItemFailures": [{"itemIdentifier": message_id} for message_id in failures],
+    }
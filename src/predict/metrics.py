@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import sys
+import json
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, TextIO
+
+NAMESPACE = "RakugakiBattleOnLine"
+
+
+class StageTimer:
+    # 処理の段階ごとにかかった時間(ms)を積算する. テストでは偽の時計を渡せる
+    def __init__(self, clock: Callable[[], float] = time.perf_counter) -> None:
+        self.clock = clock
+        self.stages: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (self.clock() - start) * 1000
+
+
+def queue_metrics(sent_at: int, first_received_at: int, now_ms: int) -> dict[str, float]:
+    # SentTimestamp〜ApproximateFirstReceiveTimestampがSQSでの待ち時間, 現在までがキューに入ってからの経過時間
+    if not sent_at:
+        return {}
+    metrics = {"QueueAge": float(now_ms - sent_at)}
+    if first_received_at:
+        metrics["QueueWait"] = float(first_received_at - sent_at)
+    return metrics
+
+
+def emf_record(
+    metrics: dict[str, float],
+    dimensions: dict[str, str],
+    properties: dict[str, Any],
+    now_ms: int,
+) -> dict[str, Any]:
+    # CloudWatch Embedded Metric Format: ログに書くだけでメトリクスとして集計される
+    return {
+        "_aws": {
+            "Timestamp": now_ms,
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": [{"Name": k, "Unit": "Milliseconds"} for k in metrics],
+                },
+            ],
+        },
+        **dimensions,
+        **properties,
+        **metrics,
+    }
+
+
+def emit(record: dict[str, Any], stream: TextIO | None = None) -> None:
+    # EMFは1行がそのままJSONである必要があるので, 接頭辞を付けるloggerを通さず標準出力に書く
+    (stream or sys.stdout).write(json.dumps(record) + "\n")
@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+from typing import Any, NamedTuple
+
+# 負荷を落とすときの返し方
+SHED_MODES = ("skip", "busy")
+
+
+class SheddingConfig(NamedTuple):
+    # キューの遅れ(バッチ内で最も古いメッセージのSentTimestampからの経過時間)がこれを超えたら負荷を落とす
+    queue_age_ms: int
+    # 負荷を落としている間, API Gatewayが受けてからこれより経った途中経過は推論しない
+    # (キューに入ってからの時間より短いと, 遅れているときのバッチは途中経過がすべて落ちるのでqueue_age_ms以上にする)
+    frame_age_ms: int
+    # skip: 何も返さない, busy: 推論の代わりに混雑中であることを返す
+    mode: str
+
+    @classmethod
+    def from_env(cls, queue_age_ms: str, frame_age_ms: str, mode: str) -> SheddingConfig:
+        if mode not in SHED_MODES:
+            raise ValueError(f"SHED_MODE must be one of {SHED_MODES}: {mode}")
+        config = SheddingConfig(int(queue_age_ms), int(frame_age_ms), mode)
+        if config.frame_age_ms < config.queue_age_ms:
+            raise ValueError(f"SHED_FRAME_AGE_MS must be >= SHED_QUEUE_AGE_MS: {config.frame_age_ms} < {config.queue_age_ms}")
+        return config
+
+
+def queue_lag(frames: list[Any], now_ms: int) -> int:
+    # SentTimestampのないレコード(直接呼び出したときなど)は遅れなしとみなす
+    return max((now_ms - frame.sent_at for frame in frames if frame.sent_at), default=0)
+
+
+def shed(frames: list[Any], now_ms: int, config: SheddingConfig) -> tuple[list[Any], list[Any]]:
+    # キューが遅れているときは古い途中経過を捨てて, 推論するフレーム数を減らす
+    # 最終フレーム(is_fin)は得点になるので必ず推論する
+    if queue_lag(frames, now_ms) <= config.queue_age_ms:
+        return frames, []
+    kept, dropped = [], []
+    for frame in frames:
+        if frame.body.is_fin or now_ms - frame.requested_at <= config.frame_age_ms:
+            kept.append(frame)
+        else:
+            dropped.append(frame)
+    return kept, dropped
+
+
+def busy_targets(dropped: list[Any], now_ms: int, busy_until: dict[str, int], retry_after_ms: int) -> list[str]:
+    # busyを返した接続はretry_after_msの間は送ってこないので, キューに残っていた分を落としても返し直さない
+    # busy_untilは呼び出し側がコンテナの間持ち続ける(期限の過ぎた接続はここで消す)
+    for connection_id in [connection_id for connection_id, until in busy_until.items() if until <= now_ms]:
+        del busy_until[connection_id]
+    targets = sorted({frame.connection_id for frame in dropped} - busy_until.keys())
+    busy_until.update({connection_id: now_ms + retry_after_ms for connection_id in targets})
+    return targets
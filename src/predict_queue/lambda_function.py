@@ -3,9 +3,10 @@ from __future__ import annotations
 import os
 import json
 import logging
-from typing import NamedTuple
+from typing import Any, NamedTuple
 
-import boto3
+import log_util
+import runtime
 
 
 class EnvironParam(NamedTuple):
@@ -20,15 +21,36 @@ class EnvironParam(NamedTuple):
 ep = EnvironParam.from_env()
 logger = logging.getLogger()
 logger.setLevel(ep.LOG_LEVEL)
-sqs = boto3.client("sqs")
+sqs = runtime.client("sqs")
+# predictに渡すエンベロープの形式を変えたら上げる
+ENVELOPE_VERSION = 1
+FRAME_FIELDS = ("odai", "is_fin", "img_id", "n_top")
+
+
+def to_envelope(event: dict[str, Any]) -> dict[str, Any]:
+    # API Gatewayのイベント全体ではなく, predictに必要な項目だけを送る
+    body = json.loads(event["body"])
+    return {
+        "v": ENVELOPE_VERSION,
+        "connection_id": event["requestContext"]["connectionId"],
+        "requested_at": event["requestContext"]["requestTimeEpoch"],
+        "frame": {k: body[k] for k in FRAME_FIELDS if k in body},
+        "img_b64": body["img_b64"],
+    }
 
 
 def lambda_handler(event, context):
-    logger.info(json.dumps(event, indent=2))
     try:
+        envelope = to_envelope(event)
+        log_util.debug(logger, "envelope", envelope, envelope["connection_id"])
         sqs.send_message(
             QueueUrl=ep.PREDICT_QUEUE_URL,
-            MessageBody=json.dumps(event),
+            MessageBody=json.dumps(envelope),
+            MessageAttributes={
+                "version": {"DataType": "Number", "StringValue": str(ENVELOPE_VERSION)},
+                "is_fin": {"DataType": "String", "StringValue": str(bool(envelope["frame"].get("is_fin"))).lower()},
+                "connection_id": {"DataType": "String", "StringValue": envelope["connection_id"]},
+            },
         )
         return {
             "statusCode": 200,
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, NamedTuple
+
+logger = logging.getLogger()
+
+# 同時に投げるpost_to_connectionの上限(クライアントのコネクションプールも同じ数だけ確保する)
+MAX_WORKERS = 16
+client_config = {"max_pool_connections": MAX_WORKERS}
+# 呼び出しのたびにスレッドを作り直さないよう, コンテナの間使い回す(スレッドは必要になったときに作られる)
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+
+class PostResult(NamedTuple):
+    connection_id: str
+    error: Exception | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def gone(self) -> bool:
+        # 切断済みの接続(GoneException)はリトライしても成功しないので他の失敗と区別する
+        # (失敗したときにはbotocoreは読み込み済みなので, ここで読み込んでも初期化は遅くならない)
+        from botocore.exceptions import ClientError
+        return isinstance(self.error, ClientError) and self.error.response["Error"]["Code"] == "GoneException"
+
+
+def post(apigw: Any, connection_id: str, data_bin: bytes) -> PostResult:
+    try:
+        apigw.post_to_connection(
+            Data=data_bin,
+            ConnectionId=connection_id,
+        )
+        return PostResult(connection_id)
+    except Exception as e:
+        result = PostResult(connection_id, e)
+        if result.gone:
+            logger.warning(f"post_to_connection: {connection_id} is gone")
+        else:
+            logger.warning(f"post_to_connection: {connection_id}", exc_info=True)
+        return result
+
+
+def broadcast(apigw: Any, connection_ids: list[str], data: dict[str, Any]) -> list[PostResult]:
+    # ペイロードは1回だけシリアライズし, 1つの接続の失敗や遅延で他の接続を止めないよう並列に送る
+    data_bin = json.dumps(data).encode()
+    if len(connection_ids) <= 1:
+        return [post(apigw, connection_id, data_bin) for connection_id in connection_ids]
+    return list(executor.map(lambda connection_id: post(apigw, connection_id, data_bin), connection_ids))
+
+
+def prune_gone(
+    results: list[PostResult],
+    room_id: str,
+    room_table: Any,
+    room_keys: tuple[str, str],
+    user_table: Any,
+    user_keys: tuple[str, str],
+) -> list[str]:
+    # 切断済みの接続をroomテーブルとuserテーブルからまとめて削除し, 以降のブロードキャストで送らないようにする
+    gone = [result.connection_id for result in results if result.gone]
+    if not gone:
+        return gone
+    try:
+        with room_table.batch_writer() as batch:
+            for connection_id in gone:
+                batch.delete_item(Key={room_keys[0]: room_id, room_keys[1]: connection_id})
+        with user_table.batch_writer() as batch:
+            for connection_id in gone:
+                for skey in ("login", "info"):
+                    batch.delete_item(Key={user_keys[0]: connection_id, user_keys[1]: skey})
+    except Exception:
+        # 掃除に失敗しても次のブロードキャストで再度検出されるので握りつぶす
+        logger.exception("prune_gone")
+    return gone
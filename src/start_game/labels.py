@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import csv
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
+
+
+class LabelRegistry(NamedTuple):
+    # モデルの出力index順に並んだ表示名(日本語)
+    names: tuple[str, ...]
+    # 表示名 -> モデルの出力index
+    label_index_map: Mapping[str, int]
+
+    @classmethod
+    def from_csv(cls, label_path: str = "label.csv", en2jp_path: str = "en2jp.csv") -> LabelRegistry:
+        with open(label_path, "r", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            index_label_map = {int(l[1]): l[0] for i, l in enumerate(reader) if i != 0}
+        with open(en2jp_path, "r", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            en2jp = {l[0]: l[1] for l in reader}
+        # 英語名のまま返すと気付けないので, 2つのCSVが食い違っていれば起動時に落とす
+        if sorted(index_label_map) != list(range(len(index_label_map))):
+            raise ValueError(f"{label_path}: index is not contiguous")
+        missing = [v for v in index_label_map.values() if v not in en2jp]
+        if missing:
+            raise ValueError(f"{en2jp_path}: no translation for {missing}")
+        names = tuple(en2jp[index_label_map[i]] for i in range(len(index_label_map)))
+        if len(set(names)) != len(names):
+            raise ValueError(f"{en2jp_path}: duplicated translation")
+        return LabelRegistry(
+            names=names,
+            label_index_map=MappingProxyType({v: i for i, v in enumerate(names)}),
+        )
@@ -1,21 +1,40 @@
 from __future__ import annotations
 
 import os
-import csv
+import time
 import random
 import json
 import logging
 from typing import Any, NamedTuple
 
-import boto3
-from boto3.dynamodb.conditions import Key
+from broadcast import broadcast, client_config, prune_gone
+import log_util
+from labels import LabelRegistry
+from room_cache import RoomCache
+import runtime
+from round_engine import (
+    RoundState,
+    game_end_event,
+    game_start_event,
+    leaderboard_event,
+    round_end_event,
+    round_start_event,
+)
 
 
 class EnvironParam(NamedTuple):
     LOG_LEVEL: str
+    USER_TABLE_NAME: str
+    USER_TABLE_PKEY: str
+    USER_TABLE_SKEY: str
     ROOM_TABLE_NAME: str
     ROOM_TABLE_PKEY: str
     ROOM_TABLE_SKEY: str
+    GAME_TABLE_NAME: str
+    GAME_TABLE_PKEY: str
+    GAME_TABLE_SKEY: str
+    ROUND_QUEUE_URL: str
+    FIN_WINDOW_MS: str
     ENDPOINT_URL: str
 
     @classmethod
@@ -26,9 +45,13 @@ class EnvironParam(NamedTuple):
 ep = EnvironParam.from_env()
 logger = logging.getLogger()
 logger.setLevel(ep.LOG_LEVEL)
-apigw = boto3.client("apigatewaymanagementapi", endpoint_url=ep.ENDPOINT_URL)
-dynamodb = boto3.resource("dynamodb")
-room_table = dynamodb.Table(ep.ROOM_TABLE_NAME)
+apigw = runtime.client("apigatewaymanagementapi", endpoint_url=ep.ENDPOINT_URL, config=client_config)
+user_table = runtime.table(ep.USER_TABLE_NAME)
+room_table = runtime.table(ep.ROOM_TABLE_NAME)
+game_table = runtime.table(ep.GAME_TABLE_NAME)
+sqs = runtime.client("sqs")
+labels = LabelRegistry.from_csv()
+room_cache = RoomCache()
 
 
 class BodySchema(NamedTuple):
@@ -42,52 +65,241 @@ class BodySchema(NamedTuple):
         return BodySchema(**{k: body[k] for k in BodySchema._fields})
 
 
+class TickSchema(NamedTuple):
+    room_id: str
+    index: int
+    # round: お題の締め切り, leaderboard: 最終フレームの採点後の順位表の送信
+    command: str = "round"
+
+    @classmethod
+    def from_record(cls, record: dict[str, Any]) -> TickSchema:
+        body = json.loads(record["body"])
+        return TickSchema(**{k: body[k] for k in TickSchema._fields if k in body})
+
+
 class DoNotRetryException(Exception):
     ...
 
 
-def get_odai() -> dict[int, str]:
-    with open("label.csv", "r", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        index_label_map = {int(l[1]): l[0] for i, l in enumerate(reader) if i != 0}
-    with open("en2jp.csv", "r", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        en2jp = {l[0]: l[1] for l in reader}
-    return [en2jp.get(v, v) for v in index_label_map.values()]
+def now_ms() -> int:
+    return int(time.time() * 1000)
 
 
-def post_room(body: BodySchema) -> None:
-    odai = random.sample(get_odai(), body.n_odai)
+def get_connection_ids(room_id: str, version: int | None) -> list[str]:
+    # enter_roomが入室のたびにround行のバージョンを上げるので, tickで読んだバージョンが同じ間はキャッシュを使う
+    # (退室した接続は送るとGoneExceptionになるので, そこでキャッシュを捨てる)
+    # バージョンを読んでいないとき(ゲーム開始, 順位表)は毎回読む
+    from boto3.dynamodb.conditions import Key
     try:
-        items = room_table.query(
-            KeyConditionExpression=Key(ep.ROOM_TABLE_PKEY).eq(body.room_id)
-        )["Items"]
-        connection_ids = [item[ep.ROOM_TABLE_SKEY] for item in items]
+        connection_ids = room_cache.get(room_id, version) if version is not None else None
+        if connection_ids is None:
+            items = room_table.query(
+                KeyConditionExpression=Key(ep.ROOM_TABLE_PKEY).eq(room_id),
+                ConsistentRead=True,
+            )["Items"]
+            connection_ids = [item[ep.ROOM_TABLE_SKEY] for item in items]
+            if version is not None:
+                room_cache.put(room_id, version, connection_ids)
+        log_util.info(logger, "room_cache", room_cache.stats())
+        return connection_ids
     except Exception as e:
         logger.exception("query")
         raise DoNotRetryException from e
-    for connection_id in connection_ids:
-        try:
-            apigw.post_to_connection(
-                Data=json.dumps({"command": "game_start", "odai": odai, "n_time": body.n_time_sec}).encode(),
-                ConnectionId=connection_id,
-            )
-        except boto3.client.exceptions.GoneException:
-            # 何らかの事情でDBに残っていても接続が切れている場合があるのでSkip
-            logger.exception("warn")
-        except Exception as e:
-            logger.exception("post_to_connection")
-            raise DoNotRetryException from e
 
 
-def service(connection_id: str, body: BodySchema) -> None:
-    post_room(body)
+def post_room(room_id: str, data: dict[str, Any], version: int | None = None) -> None:
+    connection_ids = get_connection_ids(room_id, version)
+    # 何らかの事情でDBに残っていても接続が切れている場合があるので, 失敗した接続があっても他の接続には送り
+    # 切断済みの接続はテーブルから削除する
+    results = broadcast(apigw, connection_ids, data)
+    gone = prune_gone(
+        results, room_id, room_table, (ep.ROOM_TABLE_PKEY, ep.ROOM_TABLE_SKEY),
+        user_table, (ep.USER_TABLE_PKEY, ep.USER_TABLE_SKEY),
+    )
+    if gone:
+        room_cache.invalidate(room_id)
+
+
+def get_state(room_id: str) -> RoundState | None:
+    try:
+        res = game_table.get_item(
+            Key={
+                ep.GAME_TABLE_PKEY: room_id,
+                ep.GAME_TABLE_SKEY: "round",
+            },
+            ConsistentRead=True,
+        )
+    except Exception as e:
+        logger.exception("get_item")
+        raise DoNotRetryException from e
+    if "Item" not in res:
+        return None
+    return RoundState.from_db(res["Item"])
+
+
+def put_state(state: RoundState, prev_index: int | None = None) -> bool:
+    # 重複して届いたtickで二重に進めないよう, 読み込んだときのindexのままの場合だけ更新する
+    # enter_roomが同じ行に持つメンバーのバージョンを消さないよう, PutItemではなくUpdateItemで項目ごとに書く
+    from boto3.dynamodb.conditions import Attr
+    kwargs = {} if prev_index is None else {"ConditionExpression": Attr("index").eq(prev_index)}
+    # キー(room_id)はUpdateItemでは書けないので除く
+    item = {k: v for k, v in state.to_db().items() if k != ep.GAME_TABLE_PKEY}
+    try:
+        game_table.update_item(
+            Key={
+                ep.GAME_TABLE_PKEY: state.room_id,
+                ep.GAME_TABLE_SKEY: "round",
+            },
+            UpdateExpression="SET " + ", ".join(f"#{k} = :{k}" for k in item),
+            ExpressionAttributeNames={f"#{k}": k for k in item},
+            ExpressionAttributeValues={f":{k}": v for k, v in item.items()},
+            **kwargs,
+        )
+        return True
+    except game_table.meta.client.exceptions.ConditionalCheckFailedException:
+        logger.warning(f"put_state: {state.room_id} is already advanced")
+        return False
+    except Exception as e:
+        logger.exception("update_item")
+        raise DoNotRetryException from e
+
+
+def reset_leaderboard(room_id: str) -> None:
+    try:
+        game_table.put_item(
+            Item={
+                ep.GAME_TABLE_PKEY: room_id,
+                ep.GAME_TABLE_SKEY: "leaderboard",
+            }
+        )
+    except Exception as e:
+        logger.exception("put_item")
+        raise DoNotRetryException from e
+
+
+def get_leaderboard(room_id: str) -> dict[str, Any]:
+    # 合計点はpredictが加算済みなので, 人数やお題数によらず1件読むだけで済む
+    try:
+        return game_table.get_item(
+            Key={
+                ep.GAME_TABLE_PKEY: room_id,
+                ep.GAME_TABLE_SKEY: "leaderboard",
+            },
+            ConsistentRead=True,
+        ).get("Item", {})
+    except Exception as e:
+        logger.exception("get_item")
+        raise DoNotRetryException from e
+
+
+def send_tick(tick: TickSchema, delay_sec: int) -> None:
+    try:
+        sqs.send_message(
+            QueueUrl=ep.ROUND_QUEUE_URL,
+            MessageBody=json.dumps(tick._asdict()),
+            DelaySeconds=delay_sec,
+        )
+    except Exception as e:
+        logger.exception("send_message")
+        raise DoNotRetryException from e
+
+
+def schedule_tick(state: RoundState, now: int) -> None:
+    # 現在のお題の締め切りにstart_game自身を起こす
+    send_tick(TickSchema(state.room_id, state.index), state.delay_sec(now))
+
+
+def service(connection_id: str, body: BodySchema, now: int) -> None:
+    odai = random.sample(labels.names, body.n_odai)
+    state = RoundState.start(body.room_id, odai, body.n_time_sec, int(ep.FIN_WINDOW_MS), now)
+    put_state(state)
+    reset_leaderboard(body.room_id)
+    post_room(body.room_id, game_start_event(state))
+    schedule_tick(state, now)
+
+
+def mark_announced(state: RoundState) -> None:
+    # 送信を終えたことを記録する. 別のtickで先に進んでいたら何もしない
+    from boto3.dynamodb.conditions import Attr
+    try:
+        game_table.update_item(
+            Key={
+                ep.GAME_TABLE_PKEY: state.room_id,
+                ep.GAME_TABLE_SKEY: "round",
+            },
+            UpdateExpression="SET #announced = :true",
+            ExpressionAttributeNames={"#announced": "announced"},
+            ExpressionAttributeValues={":true": True},
+            ConditionExpression=Attr("index").eq(state.index),
+        )
+    except game_table.meta.client.exceptions.ConditionalCheckFailedException:
+        logger.warning(f"mark_announced: {state.room_id} is already advanced")
+    except Exception as e:
+        logger.exception("update_item")
+        raise DoNotRetryException from e
+
+
+def announce(state: RoundState, next_state: RoundState, now: int) -> None:
+    # stateのお題を締め切り, next_stateを始める. 途中で失敗しても再配信されたtickで最初からやり直す
+    version = next_state.members_version
+    post_room(state.room_id, round_end_event(state), version)
+    send_tick(TickSchema(state.room_id, state.index, "leaderboard"), state.leaderboard_delay_sec())
+    if next_state.finished:
+        post_room(state.room_id, game_end_event(next_state), version)
+    else:
+        post_room(state.room_id, round_start_event(next_state, now), version)
+        schedule_tick(next_state, now)
+    mark_announced(next_state)
+
+
+def tick(body: TickSchema, now: int) -> None:
+    if body.command == "leaderboard":
+        post_room(body.room_id, leaderboard_event(get_leaderboard(body.room_id), body.index))
+        return
+    state = get_state(body.room_id)
+    if state is None:
+        return
+    # 状態を進めた後の送信で失敗したtickが再配信された場合は, 送信だけやり直す
+    # 再配信は可視性タイムアウトの後なので, 次のお題の開始と締め切りを今から数え直してから送る
+    # (最初の時刻のままだと, 開始済みのお題がすぐに締め切られる)
+    if state.index == body.index + 1 and not state.announced:
+        rebased = state.previous().next(now)
+        if not put_state(rebased, state.index):
+            return
+        announce(state.previous(), rebased, now)
+        return
+    # ゲームが再スタートされた場合などの古いtickは無視する
+    if state.finished or state.index != body.index:
+        return
+    if not state.is_due(now):
+        schedule_tick(state, now)
+        return
+    next_state = state.next(now)
+    if not put_state(next_state, state.index):
+        return
+    announce(state, next_state, now)
+
+
+def tick_handler(event, context):
+    failures: list[str] = []
+    for record in event["Records"]:
+        try:
+            tick(TickSchema.from_record(record), now_ms())
+        except:
+            logger.exception("ERROR")
+            failures.append(record["messageId"])
+    return {
+        "batchItemFailures": [{"itemIdentifier": message_id} for message_id in failures],
+    }
 
 
 def lambda_handler(event, context):
-    logger.info(json.dumps(event, indent=2))
+    log_util.debug(logger, "event", event, log_util.connection_id_of(event))
+    # round_queueからのtick(SQS)とAPI Gatewayからのゲーム開始の両方を受ける
+    if "Records" in event:
+        return tick_handler(event, context)
     try:
-        service(event["requestContext"]["connectionId"], BodySchema.from_event(event))
+        service(event["requestContext"]["connectionId"], BodySchema.from_event(event), now_ms())
         return {
             "statusCode": 200,
         }
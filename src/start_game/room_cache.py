@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Any, Callable, NamedTuple
+
+
+class Entry(NamedTuple):
+    version: int
+    cached_at: float
+    connection_ids: list[str]
+
+
+class RoomCache:
+    # コンテナ内で部屋のメンバー(接続ID)を覚えておき, roomテーブルへのqueryを減らす
+    # バージョン(enter_roomが入室のたびにgameテーブルのround行で加算する)が変わっていればTTL内でも使わない
+    def __init__(self, ttl_sec: float = 60.0, max_rooms: int = 256, clock: Callable[[], float] = time.monotonic) -> None:
+        self.ttl_sec = ttl_sec
+        self.max_rooms = max_rooms
+        self.clock = clock
+        self.entries: OrderedDict[str, Entry] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, room_id: str, version: int) -> list[str] | None:
+        entry = self.entries.get(room_id)
+        if entry is None or entry.version != version or self.clock() - entry.cached_at >= self.ttl_sec:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(room_id)
+        self.hits += 1
+        return entry.connection_ids
+
+    def put(self, room_id: str, version: int, connection_ids: list[str]) -> None:
+        self.entries[room_id] = Entry(version, self.clock(), connection_ids)
+        self.entries.move_to_end(room_id)
+        # 一番長く使われていない部屋から捨てる
+        while len(self.entries) > self.max_rooms:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, room_id: str) -> None:
+        self.entries.pop(room_id, None)
+
+    def stats(self) -> dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "rooms": len(self.entries),
+        }
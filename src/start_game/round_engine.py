@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+from typing import Any, NamedTuple
+
+# SQSのDelaySecondsの上限
+MAX_DELAY_SEC = 900
+# 最終フレームの受付時間が終わってから, predictの採点が終わるのを待つ時間
+LEADERBOARD_MARGIN_MS = 2000
+
+
+class RoundState(NamedTuple):
+    room_id: str
+    odai: list[str]
+    n_time_sec: int
+    # お題の終了後, 各クライアントが最終フレームを送ってくる時間幅(ms)
+    fin_window_ms: int
+    # 現在のお題のindex(len(odai)になったらゲーム終了)
+    index: int
+    # 現在のお題の開始時刻と締め切り(epoch ms)
+    started_at: int
+    deadline: int
+    # indexに進めた後のround_end/round_startなどの送信を終えたか. tickが途中で失敗して再配信されたときに送信だけやり直す
+    announced: bool = True
+    # 部屋のメンバーのバージョン. enter_roomが同じ行で加算するので, 読むだけで書かない(to_dbに含めない)
+    members_version: int = 0
+
+    @classmethod
+    def start(cls, room_id: str, odai: list[str], n_time_sec: int, fin_window_ms: int, now: int) -> RoundState:
+        return RoundState(
+            room_id=room_id,
+            odai=odai,
+            n_time_sec=n_time_sec,
+            fin_window_ms=fin_window_ms,
+            index=0,
+            started_at=now,
+            deadline=now + n_time_sec * 1000,
+        )
+
+    @classmethod
+    def from_db(cls, item: dict[str, Any]) -> RoundState:
+        # DynamoDBの数値はDecimalで返ってくるのでintに戻す
+        return RoundState(
+            room_id=item["room_id"],
+            odai=list(item["odai"]),
+            n_time_sec=int(item["n_time_sec"]),
+            fin_window_ms=int(item["fin_window_ms"]),
+            index=int(item["index"]),
+            started_at=int(item["started_at"]),
+            deadline=int(item["deadline"]),
+            announced=bool(item.get("announced", True)),
+            members_version=int(item.get("members_version", 0)),
+        )
+
+    def to_db(self) -> dict[str, Any]:
+        return {k: v for k, v in self._asdict().items() if k != "members_version"}
+
+    @property
+    def finished(self) -> bool:
+        return self.index >= len(self.odai)
+
+    def is_due(self, now: int) -> bool:
+        return now >= self.deadline
+
+    def delay_sec(self, now: int) -> int:
+        # 締め切りまでの秒数(切り上げ). 上限を超える場合は途中で一度起きて再スケジュールする
+        return max(0, min(-(-(self.deadline - now) // 1000), MAX_DELAY_SEC))
+
+    def leaderboard_delay_sec(self) -> int:
+        # 最終フレームの受付時間とpredictの採点を待ってから順位表を送る
+        return min(-(-(self.fin_window_ms + LEADERBOARD_MARGIN_MS) // 1000), MAX_DELAY_SEC)
+
+    def next(self, now: int) -> RoundState:
+        # 最終フレームの受付時間が過ぎてから次のお題を始める
+        started_at = now + self.fin_window_ms
+        return self._replace(
+            index=self.index + 1,
+            started_at=started_at,
+            deadline=started_at + self.n_time_sec * 1000,
+            announced=False,
+        )
+
+    def previous(self) -> RoundState:
+        # 送信をやり直すときのround_endに使う, 1つ前のお題の状態(お題とindexだけが正しい)
+        return self._replace(index=self.index - 1)
+
+
+def game_start_event(state: RoundState) -> dict[str, Any]:
+    return {
+        "command": "game_start",
+        "odai": state.odai,
+        "n_time": state.n_time_sec,
+        "round": state.index,
+    }
+
+
+def round_end_event(state: RoundState) -> dict[str, Any]:
+    # 全員の最終フレームが同時にpredictへ届かないよう, クライアントはfin_window_ms内のランダムな時刻に送る
+    return {
+        "command": "round_end",
+        "round": state.index,
+        "odai": state.odai[state.index],
+        "fin_window_ms": state.fin_window_ms,
+    }
+
+
+def round_start_event(state: RoundState, now: int) -> dict[str, Any]:
+    # クライアントとの時計のずれの影響を受けないよう, 時刻ではなく相対時間で送る
+    return {
+        "command": "round_start",
+        "round": state.index,
+        "odai": state.odai[state.index],
+        "starts_in_ms": max(0, state.started_at - now),
+        "n_time": state.n_time_sec,
+    }
+
+
+def game_end_event(state: RoundState) -> dict[str, Any]:
+    return {
+        "command": "game_end",
+        "n_odai": len(state.odai),
+    }
+
+
+def leaderboard_event(item: dict[str, Any], round: int) -> dict[str, Any]:
+    # predictがUpdateItemのADDで加算している score#<接続ID>, rounds#<接続ID>, name#<接続ID> から順位表を作る
+    standings = [
+        {
+            "name": item.get(f"name#{k[len('score#'):]}", ""),
+            "score": float(v),
+            "rounds": int(item.get(f"rounds#{k[len('score#'):]}", 0)),
+        }
+        for k, v in item.items() if k.startswith("score#")
+    ]
+    standings.sort(key=lambda x: x["score"], reverse=True)
+    return {
+        "command": "leaderboard",
+        "round": round,
+        "standings": standings,
+    }
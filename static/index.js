@@ -14,6 +14,11 @@ window.onload = function () {
     let crnt_odai = ""
     let odai_list = undefined
     let img_id = 0
+    // 最後に受け付けたround_end/round_startのお題. 再配信されたtickが同じ通知をもう一度送ってきても無視する
+    let ended_round = -1
+    let started_round = 0
+    // サーバーが混雑中(busy)の間は途中経過を送らない
+    let busy_until = 0
 
 
     sock.onmessage = function (event) {
@@ -23,11 +28,31 @@ window.onload = function () {
             case "enter_room":
                 add_user(data["name"])
                 break
+            case "room_state":
+                for (const name of data["names"]) {
+                    add_user(name)
+                }
+                break
             case "game_start":
                 document.getElementById("room_area").style.display = "none"
                 document.getElementById("canvas_area").style.display = "block"
                 first_game_start(data)
                 break
+            case "round_end":
+                round_end(data)
+                break
+            case "round_start":
+                round_start(data)
+                break
+            case "game_end":
+                alert("ゲーム終了")
+                break
+            case "leaderboard":
+                show_leaderboard(data["standings"])
+                break
+            case "busy":
+                busy_until = Date.now() + data["retry_after_ms"]
+                break
             case "predict":
                 let element = document.getElementById('list')
                 while (element.lastChild) {
@@ -74,50 +99,103 @@ window.onload = function () {
     })
 
     function post_img() {
+        if (Date.now() < busy_until) {
+            return
+        }
         let msg = {
             "action": "predict",
             "odai": "木",
             "is_fin": false,
             "img_id": "hoge",
-            "img_b64": canvas.toDataURL("image/jpeg")
+            "img_b64": to_ink28() || canvas.toDataURL("image/jpeg")
         }
         sock.send(JSON.stringify(msg));
     }
 
-    function post_img_fin() {
+    // 途中経過はサーバーの前処理と同じ切り抜き・縮小(ink28.js)をしてから28x28の筆跡の濃さだけを送る
+    function to_ink28() {
+        const src = canvas.lowerCanvasEl
+        const data = src.getContext("2d").getImageData(0, 0, src.width, src.height).data
+        const alpha = new Uint8Array(src.width * src.height)
+        for (let p = 0; p < alpha.length; p++) {
+            alpha[p] = data[p * 4 + 3]
+        }
+        const ink = ink28(alpha, src.width, src.height)
+        if (ink === null) {
+            return null
+        }
+        let bin = ""
+        for (let i = 0; i < ink.length; i++) {
+            bin += String.fromCharCode(ink[i])
+        }
+        return "data:application/x-ink28;base64," + btoa(bin)
+    }
+
+    function post_img_fin(round, odai) {
         let msg = {
             "action": "predict",
-            "odai": crnt_odai,
+            "odai": odai,
             "is_fin": true,
-            "img_id": img_id,
+            "img_id": round,
             "img_b64": canvas.toDataURL("image/jpeg")
         }
         sock.send(JSON.stringify(msg));
-        canvas.clear();
-        alert("このお題は終了です OKを押して次へ進んでください")
-        next_game_start()
     }
 
-    function first_game_start(data) {
+    function show_leaderboard(standings) {
+        let element = document.getElementById('leaderboard')
+        while (element.lastChild) {
+            element.removeChild(element.lastChild);
+        }
+        for (const standing of standings) {
+            const liLast = document.createElement('li')
+            liLast.textContent = standing["name"] + ": " + Math.round(standing["score"])
+            element.appendChild(liLast)
+        }
+    }
+
+    function show_odai(round, odai) {
         let odai_view = document.getElementById("odai")
-        odai_view.textContent = "お題: " + data["odai"][0]
-        crnt_odai = data["odai"][0]
+        odai_view.textContent = "お題: " + odai
+        crnt_odai = odai
+        img_id = round
+    }
+
+    // お題の切り替えはサーバーから通知されるround_end/round_startに従う
+    function first_game_start(data) {
+        ended_round = -1
+        started_round = data["round"]
+        show_odai(data["round"], data["odai"][0])
         odai_list = data["odai"]
         n_time = data["n_time"] * 1000
-        setTimeout(post_img_fin, n_time)
+        canvas.isDrawingMode = true
     }
 
-    function next_game_start() {
-        img_id += 1
-        if (img_id == odai_list.length) {
-            alert("ゲーム終了")
+    function round_end(data) {
+        // 描いているお題以外(古いお題の通知が遅れて届いた場合など)や, 受付済みのお題の通知は無視する
+        if (data["round"] != img_id || data["round"] == ended_round) {
+            return
         }
-        else {
-            crnt_odai = odai_list[img_id]
-            let odai_view = document.getElementById("odai")
-            odai_view.textContent = "お題: " + crnt_odai
-            setTimeout(post_img_fin, n_time)
+        ended_round = data["round"]
+        // 全員の最終フレームが同時に届かないよう, 受付時間内のランダムなタイミングで送る
+        canvas.isDrawingMode = false
+        const delay = Math.floor(Math.random() * data["fin_window_ms"])
+        setTimeout(function () {
+            post_img_fin(data["round"], data["odai"])
+        }, delay)
+    }
+
+    function round_start(data) {
+        // 描いているお題の次のお題以外や, 開始を待っているお題の通知は無視する
+        if (data["round"] != img_id + 1 || data["round"] == started_round) {
+            return
         }
+        started_round = data["round"]
+        setTimeout(function () {
+            canvas.clear()
+            canvas.isDrawingMode = true
+            show_odai(data["round"], data["odai"])
+        }, data["starts_in_ms"])
     }
 }
 
@@ -0,0 +1,98 @@
+// 途中経過の軽量フォーマット(x-ink28)を作る. サーバーの前処理(predictのpreprocessing)と同じ切り抜き・縮小をする
+// Node.jsからも読み込めるようにして, tests/test_ink28.pyでcv2.resizeと比べている
+
+// cv2.resizeのINTER_LINEAR(uint8)と同じく, 係数を11bitの固定小数点にして計算する
+const INTER_RESIZE_COEF_BITS = 11
+const INTER_RESIZE_COEF_SCALE = 1 << INTER_RESIZE_COEF_BITS
+
+function round_half_even(v) {
+    // cv2の係数の丸め(cvRound)と同じく, ちょうど半分のときは偶数に丸める
+    const r = Math.round(v)
+    return r - v == 0.5 && r % 2 != 0 ? r - 1 : r
+}
+
+function linear_coefs(src_size, dst_size) {
+    // 画素の中心を合わせて縮小元の位置を求め(cv2と同じくfloatで計算する), 端でははみ出さないよう最後の画素を使う
+    const scale = 1 / (dst_size / src_size)
+    const ofs = new Int32Array(dst_size)
+    const coef = new Int32Array(dst_size)
+    for (let d = 0; d < dst_size; d++) {
+        const f = Math.fround((d + 0.5) * scale - 0.5)
+        let s = Math.floor(f)
+        let a = Math.fround(f - s)
+        if (s < 0) {
+            s = 0
+            a = 0
+        }
+        if (s >= src_size - 1) {
+            s = src_size - 1
+            a = 0
+        }
+        ofs[d] = s
+        coef[d] = round_half_even(Math.fround(1 - a) * INTER_RESIZE_COEF_SCALE)
+    }
+    return [ofs, coef]
+}
+
+function resize_linear(src, src_width, src_height, dst_width, dst_height) {
+    // 横方向に補間した行を縦方向に補間する(cv2と同じ順番・丸め)
+    const [xofs, alpha] = linear_coefs(src_width, dst_width)
+    const [yofs, beta] = linear_coefs(src_height, dst_height)
+    const rows = []
+    for (let y = 0; y < src_height; y++) {
+        const row = new Int32Array(dst_width)
+        for (let x = 0; x < dst_width; x++) {
+            const s = y * src_width + xofs[x]
+            const s1 = Math.min(xofs[x] + 1, src_width - 1) - xofs[x]
+            row[x] = src[s] * alpha[x] + src[s + s1] * (INTER_RESIZE_COEF_SCALE - alpha[x])
+        }
+        rows.push(row)
+    }
+    // 縦方向はcv2のSIMD版と同じく, 係数を掛ける前に4bit, 掛けた後に16bit落としてから丸める
+    const dst = new Uint8Array(dst_width * dst_height)
+    for (let y = 0; y < dst_height; y++) {
+        const r0 = rows[yofs[y]], r1 = rows[Math.min(yofs[y] + 1, src_height - 1)]
+        const b0 = beta[y], b1 = INTER_RESIZE_COEF_SCALE - beta[y]
+        for (let x = 0; x < dst_width; x++) {
+            const v = (Math.floor(b0 * (r0[x] >> 4) / 65536) + Math.floor(b1 * (r1[x] >> 4) / 65536) + 2) >> 2
+            dst[y * dst_width + x] = Math.min(Math.max(v, 0), 255)
+        }
+    }
+    return dst
+}
+
+function ink28(alpha, width, height) {
+    // 筆跡の濃さ(アルファ値)の外接矩形を切り抜き, 長い辺を26画素に縮小して28x28の中央に置く. 何も描いていなければnull
+    let top = height, left = width, bottom = -1, right = -1
+    for (let p = 0; p < alpha.length; p++) {
+        if (alpha[p] == 0) {
+            continue
+        }
+        const y = Math.floor(p / width), x = p % width
+        top = Math.min(top, y)
+        bottom = Math.max(bottom, y)
+        left = Math.min(left, x)
+        right = Math.max(right, x)
+    }
+    if (bottom < 0) {
+        return null
+    }
+    const h = bottom - top + 1, w = right - left + 1
+    const crop = new Uint8Array(w * h)
+    for (let y = 0; y < h; y++) {
+        crop.set(alpha.subarray((top + y) * width + left, (top + y) * width + left + w), y * w)
+    }
+    const rh = h < w ? Math.min(Math.floor(h * 26 / w) + 1, 26) : 26
+    const rw = h < w ? 26 : Math.min(Math.floor(w * 26 / h) + 1, 26)
+    const resized = resize_linear(crop, w, h, rw, rh)
+    const ink = new Uint8Array(28 * 28)
+    const oy = Math.floor((28 - rh) / 2), ox = Math.floor((28 - rw) / 2)
+    for (let y = 0; y < rh; y++) {
+        ink.set(resized.subarray(y * rw, (y + 1) * rw), (oy + y) * 28 + ox)
+    }
+    return ink
+}
+
+if (typeof module !== "undefined") {
+    module.exports = { resize_linear, ink28 }
+}
@@ -0,0 +1,65 @@
+"""最適化前のpredictの前処理と推論後のスコアの整形(baselineのsrc/predict/lambda_function.pyからそのまま写したもの)
+
+前処理を書き換えてもモデルへの入力が1ビットも変わらないことを確かめるための基準と,
+tools/bench_frames.pyで比べる基準として使う.
+"""
+from __future__ import annotations
+
+import os
+import csv
+import uuid
+import base64
+import tempfile
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def preprocessing(img_b64: str) -> np.ndarray:
+    # いったん保存する(それ以外の方法で画像を読み込むやり方が分からなかった)
+    path = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}.png")
+    with open(path, "wb") as f:
+        f.write(base64.b64decode(img_b64.split(",")[1]))
+    # 読み込み
+    img = Image.open(path)
+    # 画像の切り抜き
+    img = img.crop(img.getbbox())
+    # グレースケール化
+    img = np.array(img)[:,:,3]
+    # 画像のリサイズ
+    x, y = img.shape
+    if x < y:
+        img = cv2.resize(img, (26, min(x*26//y+1, 26)))
+    else:
+        img = cv2.resize(img,(min(y*26//x+1, 26), 26))
+    # 28*28の背景にリサイズした画像を張り付け
+    img_back = np.zeros((28, 28), np.uint8)
+    x, y = img.shape
+    for i in range(x):
+        for j in range(y):
+            img_back[i+(28-x)//2][j+(28-y)//2] += img[i][j]
+    img = img_back
+    # 正規化
+    img = img / 255.
+    os.remove(path)
+    return img
+
+
+def get_index_label_map() -> dict[int, str]:
+    with open("label.csv", "r", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        index_label_map = {int(l[1]): l[0] for i, l in enumerate(reader) if i != 0}
+    with open("en2jp.csv", "r", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        en2jp = {l[0]: l[1] for l in reader}
+    return {k: en2jp.get(v, v) for k, v in index_label_map.items()}
+
+
+def scores(result: np.ndarray) -> tuple[dict[str, float], list[dict[str, float]]]:
+    # 推論の結果(1, 270)から全クラスの得点の辞書と, 得点順に並べた全クラスのリストを作る(label.csvはフレームごとに読む)
+    index_score_map = dict(zip(range(len(result[0])), result[0]*10000))
+    index_label_map = get_index_label_map()
+    label_score_map = {index_label_map[k]: float(v) for k, v in index_score_map.items()}
+    scores = [{"key": x[0], "value": x[1]} for x in sorted(label_score_map.items(), key=lambda x: x[1], reverse=True)]
+    return (label_score_map, scores)
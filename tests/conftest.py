@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import os
+import sys
+import base64
+import glob
+import importlib.util
+from typing import Any
+from unittest import mock
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from local_aws import SRC_DIR, FakeModel, LocalSession, load_handler  # noqa: E402
+
+STATIC_DIR = os.path.join(ROOT, "static")
+
+
+def load_module(handler: str, name: str) -> Any:
+    # 依存のないモジュールはハンドラーごとに別名で読み込む(同名のコピーがディレクトリごとにあるため)
+    spec = importlib.util.spec_from_file_location(f"{handler}_{name}", os.path.join(SRC_DIR, handler, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def drawings() -> list[str]:
+    # static/*.pngをクライアントが送る描画(data-URL)として使う
+    urls = []
+    for path in sorted(glob.glob(os.path.join(STATIC_DIR, "*.png"))):
+        with open(path, "rb") as f:
+            urls.append("data:image/png;base64," + base64.b64encode(f.read()).decode())
+    return urls
+
+
+@pytest.fixture(scope="session")
+def predict() -> Any:
+    return load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+
+
+@pytest.fixture
+def aws() -> Any:
+    # ハンドラーのboto3をメモリ上の代替に差し替える. runtime.pyはクライアントを使い回すので, ハンドラーはテストごとに読み込み直す
+    session = LocalSession()
+    with mock.patch("boto3.Session", return_value=session):
+        yield session
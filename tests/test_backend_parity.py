@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import os
+
+import numpy as np
+import pytest
+
+from conftest import SRC_DIR, drawings, load_module
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("tflite_runtime")
+
+
+@pytest.fixture(scope="module")
+def models(tmp_path_factory):
+    # src/predict/model.h5があればそれを, なければ同じ入出力の代わりのモデルを変換する
+    from bench_backend import build_stand_in_model
+    export_model = load_module("predict", "export_model")
+    directory = tmp_path_factory.mktemp("model")
+    h5 = os.path.join(SRC_DIR, "predict", "model.h5")
+    if not os.path.exists(h5):
+        h5 = str(directory / "model.h5")
+        build_stand_in_model(h5)
+    tflite = str(directory / "model.tflite")
+    # 変換後に乱数の入力で上位5件が一致しなければexportが例外を投げる
+    export_model.export(h5, tflite)
+    backend = load_module("predict", "backend")
+    return backend.KerasBackend(h5), backend.TFLiteBackend(tflite)
+
+
+def test_top5_parity_on_drawings(predict, models):
+    keras, tflite = models
+    imgs = np.stack([predict.preprocessing(predict.FrameImage.from_data_url(url)) for url in drawings()])
+    expected, actual = keras.predict(imgs), tflite.predict(imgs)
+    assert np.array_equal(np.argsort(-expected, axis=1, kind="stable")[:, :5], np.argsort(-actual, axis=1, kind="stable")[:, :5])
+    assert np.allclose(expected, actual, atol=1e-5)
+
+
+def test_tflite_resizes_for_each_batch_size(predict, models):
+    _, tflite = models
+    imgs = np.stack([predict.preprocessing(predict.FrameImage.from_data_url(url)) for url in drawings()])
+    batched = tflite.predict(imgs)
+    for i, img in enumerate(imgs):
+        assert np.allclose(tflite.predict(img[np.newaxis]), batched[i:i+1], atol=1e-6)
+
+
+def test_fallback_is_reported(predict, tmp_path, monkeypatch):
+    # model.tfliteがなければKerasに切り替わり, メトリクスのModelBackendで分かる
+    backend = load_module("predict", "backend")
+    monkeypatch.setattr(backend, "KerasBackend", lambda: type("Keras", (), {"name": "keras"})())
+    monkeypatch.chdir(tmp_path)
+    assert backend.load_backend("tflite").name == "keras"
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import json
+from typing import Any
+
+import pytest
+
+from conftest import load_module
+from local_aws import LocalDynamoDB, RecordingApiGateway, load_handler
+
+ROOM_KEYS = ("room_id", "user_id")
+USER_KEYS = ("user_id", "skey")
+HANDLERS = ["enter_room", "dis_connect", "start_game"]
+
+
+def tables(room_id: str, connection_ids: list[str]) -> tuple[Any, Any]:
+    dynamodb = LocalDynamoDB({"room": ROOM_KEYS, "user": USER_KEYS})
+    room_table, user_table = dynamodb.Table("room"), dynamodb.Table("user")
+    for connection_id in connection_ids:
+        room_table.put_item(Item={"room_id": room_id, "user_id": connection_id})
+        for skey in ("login", "info"):
+            user_table.put_item(Item={"user_id": connection_id, "skey": skey})
+    return room_table, user_table
+
+
+@pytest.mark.parametrize("handler", HANDLERS)
+def test_prune_gone(handler: str) -> None:
+    broadcast = load_module(handler, "broadcast")
+    room_table, user_table = tables("room", ["a", "b", "c", "d"])
+    apigw = RecordingApiGateway(gone={"b", "d"})
+
+    results = broadcast.broadcast(apigw, ["a", "b", "c", "d"], {"command": "hoge"})
+    gone = broadcast.prune_gone(results, "room", room_table, ROOM_KEYS, user_table, USER_KEYS)
+
+    assert gone == ["b", "d"]
+    assert apigw.sent == {"a": [{"command": "hoge"}], "c": [{"command": "hoge"}]}
+    assert sorted(key[1] for key in room_table.items) == ["a", "c"]
+    assert sorted(user_table.items) == [("a", "info"), ("a", "login"), ("c", "info"), ("c", "login")]
+
+
+@pytest.mark.parametrize("handler", HANDLERS)
+def test_prune_gone_keeps_table_on_other_errors(handler: str) -> None:
+    # GoneException以外の失敗は一時的なものかもしれないので削除しない
+    broadcast = load_module(handler, "broadcast")
+    room_table, user_table = tables("room", ["a", "b"])
+
+    class FailingApiGateway:
+        def post_to_connection(self, **kwargs) -> None:
+            raise RuntimeError("throttled")
+
+    results = broadcast.broadcast(FailingApiGateway(), ["a", "b"], {"command": "hoge"})
+    gone = broadcast.prune_gone(results, "room", room_table, ROOM_KEYS, user_table, USER_KEYS)
+
+    assert gone == []
+    assert not any(result.ok for result in results)
+    assert len(room_table.items) == 2 and len(user_table.items) == 4
+
+
+def test_enter_room_prunes_gone_members(aws: Any) -> None:
+    enter_room = load_handler("enter_room")
+    for connection_id in ("alive", "gone"):
+        aws.dynamodb.Table("dyn-room-cdk").put_item(Item={"room_id": "room", "user_id": connection_id, "user_name": connection_id})
+        aws.dynamodb.Table("dyn-user-cdk").put_item(Item={"user_id": connection_id, "skey": "info", "room_id": "room"})
+    aws.apigw.gone.add("gone")
+
+    res = enter_room.lambda_handler({
+        "requestContext": {"connectionId": "new"},
+        "body": json.dumps({"action": "enter_room", "room_id": "room", "user_name": "new"}),
+    }, None)
+
+    assert res["statusCode"] == 200
+    assert sorted(key[1] for key in aws.dynamodb.Table("dyn-room-cdk").items) == ["alive", "new"]
+    assert ("gone", "info") not in aws.dynamodb.Table("dyn-user-cdk").items
+    assert aws.apigw.sent["alive"] == [{"command": "enter_room", "name": "new"}]
+    # 入室者に送るメンバー一覧にも切断済みの接続は含めない
+    assert aws.apigw.sent["new"] == [{"command": "room_state", "names": ["alive", "new"]}]
+
+
+@pytest.mark.parametrize("handler", HANDLERS)
+def test_broadcast_reuses_module_executor(handler: str) -> None:
+    # 呼び出しのたびにスレッドを作り直さず, コンテナの間MAX_WORKERSまでのスレッドを使い回す
+    broadcast = load_module(handler, "broadcast")
+    apigw = RecordingApiGateway()
+    connection_ids = [f"c-{i}" for i in range(broadcast.MAX_WORKERS * 2)]
+    for _ in range(3):
+        assert all(result.ok for result in broadcast.broadcast(apigw, connection_ids, {"command": "hoge"}))
+    assert 0 < len(broadcast.executor._threads) <= broadcast.MAX_WORKERS
+    assert all(len(sent) == 3 for sent in apigw.sent.values())
@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import json
+import logging
+import time
+from typing import Any
+
+import pytest
+
+from conftest import drawings
+from local_aws import FakeModel, load_handler
+
+
+def record(message_id: str, connection_id: str, requested_at: int, is_fin: bool = False) -> dict[str, Any]:
+    return {
+        "messageId": message_id,
+        "body": json.dumps({
+            "v": 1, "connection_id": connection_id, "requested_at": requested_at,
+            "frame": {"odai": "木", "is_fin": is_fin, "img_id": "0" if is_fin else "hoge"}, "img_b64": drawings()[0],
+        }),
+        "attributes": {"SentTimestamp": str(requested_at), "ApproximateFirstReceiveTimestamp": str(requested_at)},
+    }
+
+
+def test_rapid_strokes_score_only_newest_frame_and_fin(aws: Any) -> None:
+    # 素早く描いたプレイヤー(a)の途中経過が同じバッチに溜まっていても, 推論するのは最新の途中経過と最終フレームだけ
+    model = FakeModel()
+    predict = load_handler("predict", model, {"MODEL_PREWARM": "0"})
+    aws.dynamodb.Table("dyn-user-cdk").put_item(Item={"user_id": "a", "skey": "info", "room_id": "room", "user_name": "a"})
+    now = int(time.time() * 1000)
+    # SQS(標準キュー)は順番を保証しないので, 受信時刻の新しい途中経過(m-3)はバッチの途中に置く
+    records = [
+        record("m-0", "a", now - 400),
+        record("m-1", "a", now - 300),
+        record("m-3", "a", now - 50),
+        record("m-2", "a", now - 200),
+        record("m-4", "a", now - 100, is_fin=True),
+        record("m-5", "b", now - 250),
+    ]
+    kept = predict.coalesce([predict.Frame.from_record(r) for r in records])
+    assert [frame.message_id for frame in kept] == ["m-3", "m-4", "m-5"]
+    assert predict.coalesce_counter == {"received": 6, "skipped": 3, "duplicated": 0, "shed": 0}
+
+    assert predict.lambda_handler({"Records": records}, None) == {"batchItemFailures": []}
+    assert model.frames == 3
+    assert [data["command"] for data in aws.apigw.sent["a"]] == ["predict", "img_save"]
+    assert predict.coalesce_counter["received"] == 12 and predict.coalesce_counter["skipped"] == 6
+
+
+def test_coalesce_logs_only_when_frames_are_skipped(aws: Any, caplog: pytest.LogCaptureFixture) -> None:
+    # 何も落とさない呼び出しのたびにINFOを1行出さない
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+    now = int(time.time() * 1000)
+    with caplog.at_level(logging.INFO):
+        predict.coalesce([predict.Frame.from_record(record("m-0", "a", now)), predict.Frame.from_record(record("m-1", "b", now))])
+        assert not any("coalesce" in r.getMessage() for r in caplog.records)
+        predict.coalesce([predict.Frame.from_record(record("m-2", "a", now - 100)), predict.Frame.from_record(record("m-3", "a", now))])
+        assert any("coalesce" in r.getMessage() for r in caplog.records)
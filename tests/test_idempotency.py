@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import json
+import time
+from decimal import Decimal
+from typing import Any
+
+import pytest
+
+from conftest import drawings
+from local_aws import FakeModel, load_handler
+
+
+def fin_record(message_id: str, connection_id: str, img_id: str = "0", receive_count: int = 1) -> dict[str, Any]:
+    now = int(time.time() * 1000)
+    return {
+        "messageId": message_id,
+        "body": json.dumps({
+            "v": 1, "connection_id": connection_id, "requested_at": now,
+            "frame": {"odai": "木", "is_fin": True, "img_id": img_id}, "img_b64": drawings()[0],
+        }),
+        "attributes": {
+            "SentTimestamp": str(now), "ApproximateFirstReceiveTimestamp": str(now), "ApproximateReceiveCount": str(receive_count),
+        },
+    }
+
+
+def enter(aws: Any, connection_id: str, room_id: str = "room") -> None:
+    aws.dynamodb.Table("dyn-user-cdk").put_item(
+        Item={"user_id": connection_id, "skey": "info", "room_id": room_id, "user_name": connection_id},
+    )
+
+
+def leaderboard(aws: Any, room_id: str = "room") -> dict[str, Any]:
+    return aws.dynamodb.Table("dyn-game-cdk").get_item(Key={"room_id": room_id, "skey": "leaderboard"})["Item"]
+
+
+def test_redelivered_fin_is_counted_once(aws: Any) -> None:
+    # SQSが同じメッセージをもう一度届けても, 点数の加算・保存・推論は1回だけ
+    model = FakeModel()
+    predict = load_handler("predict", model, {"MODEL_PREWARM": "0"})
+    enter(aws, "a")
+    assert predict.lambda_handler({"Records": [fin_record("m-0", "a")]}, None) == {"batchItemFailures": []}
+    score = leaderboard(aws)["score#a"]
+    assert predict.lambda_handler({"Records": [fin_record("m-0", "a", receive_count=2)]}, None) == {"batchItemFailures": []}
+    board = leaderboard(aws)
+    assert (board["score#a"], board["rounds#a"], board["counted#a"]) == (score, 1, {"0"})
+    assert model.frames == 1
+    assert list(aws.s3.objects) == [("s3s-result-cdk", "result/a/0.png")]
+    assert aws.dynamodb.Table("dyn-user-cdk").get_item(Key={"user_id": "a", "skey": "0"})["Item"]["message_id"] == "m-0"
+    assert predict.coalesce_counter["duplicated"] == 1
+
+
+def test_redelivery_after_failed_ledger_write_is_not_double_counted(aws: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    # 加算の後に処理済みの印(PutItem)の書き込みが失敗すると, メッセージはSQSに戻って最初からやり直される
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+    monkeypatch.setattr(predict.time, "sleep", lambda _: None)
+    enter(aws, "a")
+    table = aws.dynamodb.Table("dyn-user-cdk")
+    put_item = table.put_item
+    failures = {"left": predict.PERSIST_RETRY}
+
+    def flaky_put_item(Item: dict[str, Any], **kwargs) -> dict[str, Any]:
+        if "message_id" in Item and failures["left"] > 0:
+            failures["left"] -= 1
+            raise RuntimeError("ProvisionedThroughputExceeded")
+        return put_item(Item=Item, **kwargs)
+
+    monkeypatch.setattr(table, "put_item", flaky_put_item)
+    assert predict.lambda_handler({"Records": [fin_record("m-0", "a")]}, None) == {"batchItemFailures": [{"itemIdentifier": "m-0"}]}
+    score = leaderboard(aws)["score#a"]
+    assert ("a", "0") not in table.items
+    # 再配信では推論からやり直すが, 加算は条件付きなので増えない
+    assert predict.lambda_handler({"Records": [fin_record("m-0", "a", receive_count=2)]}, None) == {"batchItemFailures": []}
+    board = leaderboard(aws)
+    assert (board["score#a"], board["rounds#a"]) == (score, 1)
+    assert table.items[("a", "0")]["message_id"] == "m-0"
+
+
+def test_each_player_and_round_is_counted(aws: Any) -> None:
+    # 重複の判定は接続とimg_id(ラウンド)ごと. 別のプレイヤーや別のラウンドは加算される
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+    enter(aws, "a")
+    enter(aws, "b")
+    records = [fin_record("m-0", "a", "0"), fin_record("m-1", "b", "0"), fin_record("m-2", "a", "1")]
+    assert predict.lambda_handler({"Records": records}, None) == {"batchItemFailures": []}
+    redelivered = [fin_record("m-0", "a", "0", 2), fin_record("m-1", "b", "0", 2), fin_record("m-2", "a", "1", 2)]
+    assert predict.lambda_handler({"Records": redelivered}, None) == {"batchItemFailures": []}
+    board = leaderboard(aws)
+    assert (board["rounds#a"], board["rounds#b"]) == (2, 1)
+    assert (board["counted#a"], board["counted#b"]) == ({"0", "1"}, {"0"})
+    assert isinstance(board["score#a"], Decimal)
+
+
+def test_ledger_is_read_only_for_redelivered_fin(aws: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    # 初めて受け取った最終フレームでは処理済みかどうかを読まない
+    model = FakeModel()
+    predict = load_handler("predict", model, {"MODEL_PREWARM": "0"})
+    enter(aws, "a")
+    table = aws.dynamodb.Table("dyn-user-cdk")
+    get_item = table.get_item
+    reads = []
+
+    def counting_get_item(Key: dict[str, Any], **kwargs) -> dict[str, Any]:
+        reads.append(Key["skey"])
+        return get_item(Key=Key, **kwargs)
+
+    monkeypatch.setattr(table, "get_item", counting_get_item)
+    assert predict.lambda_handler({"Records": [fin_record("m-0", "a")]}, None) == {"batchItemFailures": []}
+    assert reads == ["info"]
+    reads.clear()
+    assert predict.lambda_handler({"Records": [fin_record("m-0", "a", receive_count=2)]}, None) == {"batchItemFailures": []}
+    assert reads == ["0"] and model.frames == 1
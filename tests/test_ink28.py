@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import io
+import os
+import json
+import base64
+import shutil
+import subprocess
+from typing import Any
+
+import numpy as np
+import pytest
+
+from conftest import ROOT, drawings
+
+cv2 = pytest.importorskip("cv2")
+PIL = pytest.importorskip("PIL.Image")
+pytestmark = pytest.mark.skipif(shutil.which("node") is None, reason="node is not installed")
+
+INK28_JS = os.path.join(ROOT, "static", "ink28.js")
+# cv2は環境(SIMDの有無)によって縦方向の丸め方が変わるので, 1階調のずれまでは許す
+TOLERANCE = 1
+
+NODE_SCRIPT = """
+const { resize_linear, ink28 } = require(process.argv[1])
+const cases = JSON.parse(require("fs").readFileSync(0, "utf8"))
+const b64 = (a) => a === null ? null : Buffer.from(a).toString("base64")
+console.log(JSON.stringify(cases.map(c => c.dst
+    ? b64(resize_linear(Buffer.from(c.src, "base64"), c.width, c.height, c.dst[0], c.dst[1]))
+    : b64(ink28(Buffer.from(c.src, "base64"), c.width, c.height)))))
+"""
+
+
+def run_node(cases: list[dict[str, Any]]) -> list[np.ndarray | None]:
+    for case in cases:
+        case["src"] = base64.b64encode(case["src"].tobytes()).decode()
+    out = subprocess.run(
+        ["node", "-e", NODE_SCRIPT, INK28_JS], input=json.dumps(cases), capture_output=True, text=True, check=True,
+    ).stdout
+    return [None if b64 is None else np.frombuffer(base64.b64decode(b64), np.uint8) for b64 in json.loads(out)]
+
+
+def test_resize_linear_matches_cv2() -> None:
+    rng = np.random.default_rng(0)
+    cases = []
+    for _ in range(200):
+        height, width = rng.integers(1, 300, 2)
+        dst = (int(rng.integers(1, 27)), int(rng.integers(1, 27)))
+        cases.append({"src": rng.integers(0, 256, (height, width), np.uint8), "width": int(width), "height": int(height), "dst": dst})
+    expected = [cv2.resize(case["src"], case["dst"]) for case in cases]
+    for case, ink, exp in zip(cases, run_node(cases), expected):
+        diff = np.abs(ink.reshape(exp.shape).astype(int) - exp)
+        assert diff.max() <= TOLERANCE, (case["width"], case["height"], case["dst"])
+
+
+def test_ink28_matches_server_preprocessing(predict: Any) -> None:
+    # ブラウザで作った途中経過と, 同じ描画をPNGで送ったときのサーバーの前処理が一致する
+    urls = drawings()
+    alphas = [np.array(PIL.open(io.BytesIO(base64.b64decode(url.split(",")[1]))).convert("RGBA"))[:, :, 3] for url in urls]
+    cases = [{"src": alpha, "width": alpha.shape[1], "height": alpha.shape[0]} for alpha in alphas]
+    for url, ink in zip(urls, run_node(cases)):
+        expected = predict.preprocessing(predict.FrameImage.from_data_url(url)) * 255
+        assert np.abs(ink.reshape(28, 28) - expected).max() <= TOLERANCE + 1e-3
+
+
+def test_ink28_empty_canvas() -> None:
+    assert run_node([{"src": np.zeros((10, 10), np.uint8), "width": 10, "height": 10}]) == [None]
@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+import pytest
+from boto3.dynamodb.conditions import Attr, Key
+
+from local_aws import ConditionalCheckFailedException, LocalDynamoDB
+
+
+@pytest.fixture
+def table():
+    return LocalDynamoDB({"t": ("pk", "sk")}).Table("t")
+
+
+def test_conditions(table) -> None:
+    # ハンドラーが使う条件は実際のDynamoDBと同じく評価する
+    table.put_item(Item={"pk": "a", "sk": "1", "n": 1, "s": {"x"}})
+    table.put_item(Item={"pk": "a", "sk": "2"}, ConditionExpression=Attr("pk").not_exists())
+    with pytest.raises(ConditionalCheckFailedException):
+        table.put_item(Item={"pk": "a", "sk": "1"}, ConditionExpression=Attr("pk").not_exists())
+    with pytest.raises(ConditionalCheckFailedException):
+        table.update_item(
+            Key={"pk": "a", "sk": "1"}, UpdateExpression="ADD #s :s",
+            ExpressionAttributeNames={"#s": "s"}, ExpressionAttributeValues={":s": {"x"}},
+            ConditionExpression=~Attr("s").contains("x"),
+        )
+    table.update_item(
+        Key={"pk": "a", "sk": "1"}, UpdateExpression="ADD #n :one SET #m = :m",
+        ExpressionAttributeNames={"#n": "n", "#m": "m"}, ExpressionAttributeValues={":one": 1, ":m": "y"},
+        ConditionExpression=Attr("n").eq(1) | Attr("n").not_exists(),
+    )
+    assert table.get_item(Key={"pk": "a", "sk": "1"})["Item"] == {"pk": "a", "sk": "1", "n": 2, "s": {"x"}, "m": "y"}
+    assert len(table.query(KeyConditionExpression=Key("pk").eq("a"))["Items"]) == 2
+
+
+def test_unsupported_operator_is_named(table) -> None:
+    # 対応していない条件は黙って通さず, 演算子の名前を出して失敗する
+    with pytest.raises(ValueError, match="begins_with"):
+        table.query(KeyConditionExpression=Key("pk").begins_with("a"))
+    with pytest.raises(ValueError, match=">"):
+        table.put_item(Item={"pk": "a", "sk": "1"}, ConditionExpression=Attr("n").gt(1))
+    with pytest.raises(ValueError, match="key attribute"):
+        table.update_item(
+            Key={"pk": "a", "sk": "1"}, UpdateExpression="SET #pk = :pk",
+            ExpressionAttributeNames={"#pk": "pk"}, ExpressionAttributeValues={":pk": "b"},
+        )
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import io
+import json
+import time
+from typing import Any
+
+import pytest
+
+from conftest import FakeModel, drawings, load_module
+from local_aws import load_handler
+
+metrics = load_module("predict", "metrics")
+
+
+class FakeClock:
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_stage_timer() -> None:
+    clock = FakeClock()
+    timer = metrics.StageTimer(clock)
+    with timer.stage("Decode"):
+        clock.now += 0.002
+    # 同じ段階は積算する
+    with timer.stage("Decode"):
+        clock.now += 0.003
+    with pytest.raises(RuntimeError):
+        with timer.stage("Inference"):
+            clock.now += 0.010
+            raise RuntimeError
+    assert timer.stages == pytest.approx({"Decode": 5.0, "Inference": 10.0})
+
+
+@pytest.mark.parametrize("sent_at, first_received_at, expected", [
+    (1000, 1200, {"QueueAge": 500.0, "QueueWait": 200.0}),
+    (1000, 0, {"QueueAge": 500.0}),
+    # SentTimestampがない(直接呼び出した)ときは出さない
+    (0, 0, {}),
+])
+def test_queue_metrics(sent_at: int, first_received_at: int, expected: dict[str, float]) -> None:
+    assert metrics.queue_metrics(sent_at, first_received_at, 1500) == expected
+
+
+def test_emf_record() -> None:
+    record = metrics.emf_record(
+        metrics={"QueueAge": 500.0, "Inference": 12.5},
+        dimensions={"Service": "predict", "Command": "predict"},
+        properties={"ColdStart": True},
+        now_ms=1234,
+    )
+    assert record == {
+        "_aws": {
+            "Timestamp": 1234,
+            "CloudWatchMetrics": [{
+                "Namespace": metrics.NAMESPACE,
+                "Dimensions": [["Service", "Command"]],
+                "Metrics": [{"Name": "QueueAge", "Unit": "Milliseconds"}, {"Name": "Inference", "Unit": "Milliseconds"}],
+            }],
+        },
+        "Service": "predict",
+        "Command": "predict",
+        "ColdStart": True,
+        "QueueAge": 500.0,
+        "Inference": 12.5,
+    }
+    stream = io.StringIO()
+    metrics.emit(record, stream)
+    # EMFは1行が1つのJSON
+    assert stream.getvalue().count("\n") == 1 and json.loads(stream.getvalue()) == record
+
+
+def test_predict_emits_batch_record_once_and_one_record_per_frame(aws: Any, capsys: pytest.CaptureFixture) -> None:
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+    now = int(time.time() * 1000)
+    records = [
+        {
+            "messageId": f"m-{i}",
+            "body": json.dumps({
+                "v": 1, "connection_id": f"c-{i}", "requested_at": now,
+                "frame": {"odai": "木", "is_fin": False, "img_id": "hoge"}, "img_b64": url,
+            }),
+            "attributes": {"SentTimestamp": str(now), "ApproximateFirstReceiveTimestamp": str(now + 10)},
+        }
+        for i, url in enumerate(drawings()[:3])
+    ]
+    capsys.readouterr()
+    assert predict.lambda_handler({"Records": records}, None) == {"batchItemFailures": []}
+    emitted = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"')]
+    # バッチ全体の段階は呼び出しごとに1回だけ, フレームごとの記録には載せない
+    batch, frames = emitted[0], emitted[1:]
+    assert (batch["Command"], batch["Records"], batch["BatchSize"]) == ("batch", 3, 3)
+    assert [metric["Name"] for metric in batch["_aws"]["CloudWatchMetrics"][0]["Metrics"]] == ["Parse", "Shed", "Dedup", "Inference"]
+    assert [record["MessageId"] for record in frames] == ["m-0", "m-1", "m-2"]
+    for record in frames:
+        names = [metric["Name"] for metric in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]]
+        assert {"QueueWait", "Decode", "Preprocessing"} <= set(names)
+        assert not {"Parse", "Shed", "Dedup", "Inference"} & set(names)
+        assert record["QueueWait"] == 10.0
+        assert (record["Command"], record["BatchSize"], record["ModelBackend"]) == ("predict", 3, "fake")
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import json
+import time
+from typing import Any
+
+import pytest
+
+from conftest import drawings
+from local_aws import FakeModel, load_handler
+
+
+def record(message_id: str, connection_id: str, is_fin: bool, img_b64: str | None = None) -> dict[str, Any]:
+    now = int(time.time() * 1000)
+    return {
+        "messageId": message_id,
+        "body": json.dumps({
+            "v": 1, "connection_id": connection_id, "requested_at": now,
+            "frame": {"odai": "木", "is_fin": is_fin, "img_id": "0"}, "img_b64": img_b64 or drawings()[0],
+        }),
+        "attributes": {"SentTimestamp": str(now), "ApproximateFirstReceiveTimestamp": str(now)},
+    }
+
+
+def test_frames_to_gone_connection_are_not_retried(aws: Any) -> None:
+    # 切断済みの接続には何度受け取り直しても返せないので, SQSに戻さない
+    aws.apigw.gone.add("gone")
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+    records = [record("m-0", "gone", False), record("m-1", "gone", True), record("m-2", "alive", False)]
+    assert predict.lambda_handler({"Records": records}, None) == {"batchItemFailures": []}
+    assert [data["command"] for data in aws.apigw.sent["alive"]] == ["predict"]
+
+
+def test_transient_post_failure_is_retried(aws: Any, monkeypatch: Any) -> None:
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+
+    def throttled(**kwargs) -> None:
+        raise RuntimeError("TooManyRequestsException")
+
+    monkeypatch.setattr(aws.apigw, "post_to_connection", throttled)
+    assert predict.lambda_handler({"Records": [record("m-0", "a", False)]}, None) == {"batchItemFailures": [{"itemIdentifier": "m-0"}]}
+
+
+@pytest.mark.parametrize("post_fails", ["gone", "throttled"])
+def test_final_frame_is_saved_even_if_reply_fails(aws: Any, monkeypatch: Any, post_fails: str) -> None:
+    # 返信できなくても得点と画像は保存し, 保存できたのでSQSには戻さない
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+    aws.dynamodb.Table("dyn-user-cdk").put_item(Item={"user_id": "a", "skey": "info", "room_id": "room", "user_name": "a"})
+    if post_fails == "gone":
+        aws.apigw.gone.add("a")
+    else:
+        def throttled(**kwargs) -> None:
+            raise RuntimeError("TooManyRequestsException")
+
+        monkeypatch.setattr(aws.apigw, "post_to_connection", throttled)
+    assert predict.lambda_handler({"Records": [record("m-0", "a", True)]}, None) == {"batchItemFailures": []}
+    assert [key for _, key in aws.s3.objects] == ["result/a/0.png"]
+    assert aws.dynamodb.Table("dyn-user-cdk").get_item(Key={"user_id": "a", "skey": "0"})["Item"]["message_id"] == "m-0"
+    assert aws.dynamodb.Table("dyn-game-cdk").get_item(Key={"room_id": "room", "skey": "leaderboard"})["Item"]["rounds#a"] == 1
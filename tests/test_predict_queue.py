@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import json
+import logging
+from typing import Any
+
+import pytest
+
+from local_aws import load_handler
+
+
+def event(connection_id: str) -> dict[str, Any]:
+    return {
+        "requestContext": {"connectionId": connection_id, "requestTimeEpoch": 1000},
+        "body": json.dumps({"action": "predict", "odai": "木", "is_fin": True, "img_id": "0", "img_b64": "data:,"}),
+    }
+
+
+def test_envelope(aws: Any) -> None:
+    predict_queue = load_handler("predict_queue")
+    assert predict_queue.lambda_handler(event("a"), None) == {"statusCode": 200}
+    (message,) = aws.sqs.messages
+    assert json.loads(message["MessageBody"]) == {
+        "v": 1,
+        "connection_id": "a",
+        "requested_at": 1000,
+        "frame": {"odai": "木", "is_fin": True, "img_id": "0"},
+        "img_b64": "data:,",
+    }
+    assert message["MessageAttributes"]["is_fin"]["StringValue"] == "true"
+
+
+@pytest.mark.parametrize("sample_rate, logged", [("0", False), ("1", True)])
+def test_envelope_is_logged_only_when_sampled(
+    aws: Any, caplog: pytest.LogCaptureFixture, monkeypatch: pytest.MonkeyPatch, sample_rate: str, logged: bool,
+) -> None:
+    # LOG_LEVELがINFOならエンベロープを出さず, LOG_SAMPLE_RATEで選ばれた接続だけ出す
+    monkeypatch.setenv("LOG_SAMPLE_RATE", sample_rate)
+    predict_queue = load_handler("predict_queue")
+    with caplog.at_level(logging.INFO):
+        predict_queue.lambda_handler(event("a"), None)
+    assert any("envelope" in record.getMessage() for record in caplog.records) == logged
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import json
+import base64
+
+import numpy as np
+import pytest
+
+import baseline
+from conftest import drawings
+
+
+@pytest.mark.parametrize("img_b64", drawings())
+def test_matches_baseline(predict, img_b64):
+    # モデルにはfloat32で渡るので, baselineの出力(float64)もfloat32にしてから比べる
+    expected = baseline.preprocessing(img_b64).astype(np.float32)
+    actual = predict.preprocessing(predict.FrameImage.from_data_url(img_b64))
+    assert actual.dtype == np.float32
+    assert actual.shape == (28, 28)
+    assert np.array_equal(actual, expected)
+
+
+@pytest.mark.parametrize("img_b64", drawings())
+def test_ink28_matches_baseline(predict, img_b64):
+    # 切り抜き・縮小済みの筆跡(x-ink28)で送っても同じ入力になる
+    expected = baseline.preprocessing(img_b64)
+    ink = np.round(expected * 255).astype(np.uint8).tobytes()
+    image = predict.FrameImage.from_data_url(f"{predict.INK28_HEADER},{base64.b64encode(ink).decode()}")
+    assert np.array_equal(predict.preprocessing(image), expected.astype(np.float32))
+
+
+@pytest.mark.parametrize("img_b64", ["iVBORw0KGgo", "data:image/png;base64,iVBORw0KG", "data:image/png;base64,あ"])
+def test_invalid_data_url_is_dropped_without_retry(predict, img_b64):
+    # カンマのないものや壊れたbase64は何度受け取り直しても読めないので, SQSに戻さずに捨てる
+    with pytest.raises(predict.InvalidFrameException):
+        predict.FrameImage.from_data_url(img_b64)
+    envelope = {
+        "v": 1,
+        "connection_id": "c1",
+        "requested_at": 0,
+        "frame": {"odai": "空母", "is_fin": False, "img_id": "0"},
+        "img_b64": img_b64,
+    }
+    assert predict.lambda_handler({"Records": [{"messageId": "m1", "body": json.dumps(envelope)}]}, None) == {"batchItemFailures": []}
+
+
+def envelope_record(img_b64: str) -> dict:
+    envelope = {
+        "v": 1,
+        "connection_id": "c1",
+        "requested_at": 0,
+        "frame": {"odai": "空母", "is_fin": False, "img_id": "0"},
+        "img_b64": img_b64,
+    }
+    return {"messageId": "m1", "body": json.dumps(envelope)}
+
+
+@pytest.mark.parametrize("size", [0, 28 * 28 - 1, 28 * 28 + 1])
+def test_ink28_of_wrong_size_is_dropped_without_retry(predict, size):
+    img_b64 = f"{predict.INK28_HEADER},{base64.b64encode(bytes(size)).decode()}"
+    with pytest.raises(predict.InvalidFrameException):
+        predict.FrameImage.from_data_url(img_b64)
+    assert predict.lambda_handler({"Records": [envelope_record(img_b64)]}, None) == {"batchItemFailures": []}
+
+
+def undecodable_images() -> list[str]:
+    png = base64.b64decode(drawings()[0].split(",")[1])
+    return [
+        "data:image/png;base64," + base64.b64encode(b"not an image").decode(),
+        # ヘッダーだけは読める途中で切れたPNG
+        "data:image/png;base64," + base64.b64encode(png[:len(png) // 2]).decode(),
+    ]
+
+
+@pytest.mark.parametrize("img_b64", undecodable_images())
+def test_undecodable_image_is_dropped_without_retry(predict, img_b64):
+    image = predict.FrameImage.from_data_url(img_b64)
+    with pytest.raises(predict.InvalidFrameException):
+        predict.preprocessing(image)
+    assert predict.lambda_handler({"Records": [envelope_record(img_b64)]}, None) == {"batchItemFailures": []}
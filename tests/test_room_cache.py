@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import json
+from typing import Any
+
+import pytest
+
+from conftest import load_module
+from local_aws import load_handler
+
+room_cache = load_module("start_game", "room_cache")
+
+
+class FakeClock:
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_room_cache() -> None:
+    clock = FakeClock()
+    cache = room_cache.RoomCache(ttl_sec=60, max_rooms=2, clock=clock)
+    assert cache.get("r1", 0) is None
+    cache.put("r1", 0, ["a"])
+    assert cache.get("r1", 0) == ["a"]
+    # メンバーのバージョンが変われば使わない
+    assert cache.get("r1", 1) is None
+    # TTLが切れても使わない
+    clock.now = 60
+    assert cache.get("r1", 0) is None
+    cache.put("r1", 0, ["a"])
+    cache.put("r2", 0, ["b"])
+    cache.get("r1", 0)
+    # 一番長く使われていない部屋から捨てる
+    cache.put("r3", 0, ["c"])
+    assert list(cache.entries) == ["r1", "r3"]
+    cache.invalidate("r1")
+    assert cache.get("r1", 0) is None
+    assert cache.stats() == {"hits": 2, "misses": 4, "hit_rate": 2 / 6, "rooms": 1}
+
+
+def enter(enter_room: Any, connection_id: str) -> None:
+    res = enter_room.lambda_handler({
+        "requestContext": {"connectionId": connection_id},
+        "body": json.dumps({"action": "enter_room", "room_id": "room", "user_name": connection_id}),
+    }, None)
+    assert res["statusCode"] == 200
+
+
+def commands(aws: Any, connection_id: str) -> list[str]:
+    return [m["command"] for m in aws.apigw.sent.get(connection_id, [])]
+
+
+def test_join_during_game_is_not_missed(aws: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    enter_room = load_handler("enter_room")
+    start_game = load_handler("start_game")
+    room_table = aws.dynamodb.Table("dyn-room-cdk")
+    queries = []
+    query = room_table.query
+    monkeypatch.setattr(room_table, "query", lambda **kwargs: queries.append(kwargs) or query(**kwargs))
+
+    # ゲーム開始前の入室ではround行がないのでバージョンを上げない(行を作らない)
+    enter(enter_room, "a")
+    enter(enter_room, "b")
+    assert ("room", "round") not in aws.dynamodb.Table("dyn-game-cdk").items
+
+    now = 0
+    start_game.service("a", start_game.BodySchema("room", 4, 10), now)
+    del queries[:]
+
+    # 最初のtickでキャッシュし, round_endとround_startの2回の送信でqueryは1回
+    now += 10**6
+    start_game.tick(start_game.TickSchema("room", 0), now)
+    assert len(queries) == 1
+    # メンバーが変わらなければ次のtickはqueryしない
+    now += 10**6
+    start_game.tick(start_game.TickSchema("room", 1), now)
+    assert len(queries) == 1
+    assert commands(aws, "b") == ["room_state", "game_start", "round_end", "round_start", "round_end", "round_start"]
+
+    # ゲーム中に入室した人にはキャッシュがあっても次のtickから届く
+    enter(enter_room, "c")
+    assert start_game.get_state("room").members_version == 1
+    del queries[:]
+    now += 10**6
+    start_game.tick(start_game.TickSchema("room", 2), now)
+    assert len(queries) == 1
+    assert commands(aws, "c")[-2:] == ["round_end", "round_start"]
+    # 状態を進めてもバージョンは消えない
+    assert start_game.get_state("room").members_version == 1
+
+    # 退室した接続は送ったときにGoneExceptionになり, キャッシュを捨てて次の送信で読み直す
+    aws.apigw.gone.add("b")
+    now += 10**6
+    start_game.tick(start_game.TickSchema("room", 3), now)
+    assert ("room", "b") not in room_table.items
+    assert start_game.room_cache.entries["room"].connection_ids == ["a", "c"]
+    assert commands(aws, "c")[-1] == "game_end"
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import json
+from decimal import Decimal
+from typing import Any
+
+import pytest
+
+from conftest import load_module
+from local_aws import load_handler
+
+round_engine = load_module("start_game", "round_engine")
+RoundState = round_engine.RoundState
+
+
+def state(now: int = 0, n_odai: int = 3, n_time_sec: int = 10, fin_window_ms: int = 3000) -> Any:
+    return RoundState.start("room", [f"odai{i}" for i in range(n_odai)], n_time_sec, fin_window_ms, now)
+
+
+def test_next() -> None:
+    s = state(now=1000)
+    assert (s.index, s.started_at, s.deadline, s.announced) == (0, 1000, 11000, True)
+    # 最終フレームの受付時間が過ぎてから次のお題を始める
+    n = s.next(11000)
+    assert (n.index, n.started_at, n.deadline, n.announced) == (1, 14000, 24000, False)
+    assert n.previous().index == 0 and n.previous().odai == s.odai
+    assert not n.finished
+    assert s.next(0).next(0).next(0).finished
+
+
+@pytest.mark.parametrize("now, expected", [
+    (0, 10),
+    (1, 10),
+    # 切り上げるので締め切りより前には起きない
+    (999, 10),
+    (1000, 9),
+    (10000, 0),
+    (20000, 0),
+])
+def test_delay_sec(now: int, expected: int) -> None:
+    assert state().delay_sec(now) == expected
+
+
+def test_delay_sec_is_capped() -> None:
+    # SQSのDelaySecondsの上限を超える場合は途中で一度起きる
+    assert state(n_time_sec=3600).delay_sec(0) == round_engine.MAX_DELAY_SEC
+
+
+@pytest.mark.parametrize("fin_window_ms, expected", [(0, 2), (3000, 5), (3001, 6)])
+def test_leaderboard_delay_sec(fin_window_ms: int, expected: int) -> None:
+    assert state(fin_window_ms=fin_window_ms).leaderboard_delay_sec() == expected
+
+
+def test_from_db() -> None:
+    s = state().next(10000)
+    item = {k: Decimal(v) if isinstance(v, int) and not isinstance(v, bool) else v for k, v in s.to_db().items()}
+    assert RoundState.from_db(item) == s
+    # 送信済みかを持たない古い行は送信済みとみなす
+    del item["announced"]
+    assert RoundState.from_db(item).announced
+
+
+def tick_event(message_id: str, room_id: str, index: int) -> dict[str, Any]:
+    return {"Records": [{"messageId": message_id, "body": json.dumps({"room_id": room_id, "index": index})}]}
+
+
+def test_tick_redelivery_after_partial_failure(aws: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    start_game = load_handler("start_game")
+    for connection_id in ("a", "b"):
+        aws.dynamodb.Table("dyn-room-cdk").put_item(Item={"room_id": "room", "user_id": connection_id})
+    start_game.service("a", start_game.BodySchema("room", 2, 10), 0)
+    assert [m["command"] for m in aws.apigw.sent["a"]] == ["game_start"]
+
+    # 状態を進めて(put_state)round_endを送った後, tickの送信に失敗する
+    def fail(**kwargs) -> None:
+        raise RuntimeError("send_message")
+
+    send_message = aws.sqs.send_message
+    monkeypatch.setattr(aws.sqs, "send_message", fail)
+    monkeypatch.setattr(start_game, "now_ms", lambda: 10000)
+    res = start_game.tick_handler(tick_event("m1", "room", 0), None)
+    assert res == {"batchItemFailures": [{"itemIdentifier": "m1"}]}
+    assert start_game.get_state("room").index == 1
+    assert not start_game.get_state("room").announced
+
+    # 再配信されたtick(可視性タイムアウトの後)は状態を進め直さず, 次のお題の開始と締め切りを今から数え直して送信だけやり直す
+    monkeypatch.setattr(aws.sqs, "send_message", send_message)
+    monkeypatch.setattr(start_game, "now_ms", lambda: 70000)
+    n_messages = len(aws.sqs.messages)
+    res = start_game.tick_handler(tick_event("m1", "room", 0), None)
+    assert res == {"batchItemFailures": []}
+    state = start_game.get_state("room")
+    assert state.index == 1 and state.announced
+    assert (state.started_at, state.deadline) == (73000, 83000)
+    # 最初のround_endは受け取り済みのクライアントもいる(index.jsは同じお題のround_endを無視する)
+    assert [m["command"] for m in aws.apigw.sent["b"]] == ["game_start", "round_end", "round_end", "round_start"]
+    assert aws.apigw.sent["b"][-1]["starts_in_ms"] == 3000
+    ticks = [(json.loads(m["MessageBody"]), m["DelaySeconds"]) for m in aws.sqs.messages[n_messages:]]
+    assert ticks == [
+        ({"room_id": "room", "index": 0, "command": "leaderboard"}, 5),
+        ({"room_id": "room", "index": 1, "command": "round"}, 13),
+    ]
+
+    # 送信を終えた後にもう一度届いても何もしない
+    n_messages = len(aws.sqs.messages)
+    assert start_game.tick_handler(tick_event("m1", "room", 0), None) == {"batchItemFailures": []}
+    assert len(aws.sqs.messages) == n_messages
+    assert len(aws.apigw.sent["b"]) == 4
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import os
+import sys
+import threading
+import subprocess
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+
+from conftest import FakeModel, load_module
+from cdk_env import local_env
+from local_aws import SRC_DIR, load_handler
+
+runtime = load_module("predict", "runtime")
+
+
+def test_per_thread() -> None:
+    created = []
+
+    def factory() -> Any:
+        created.append(threading.get_ident())
+        return SimpleNamespace(value=len(created))
+
+    proxy = runtime.PerThread(factory)
+    # 同じスレッドでは使い回し, 別のスレッドでは別に作る
+    values = [proxy.value, proxy.value]
+    thread = threading.Thread(target=lambda: values.append(proxy.value))
+    thread.start()
+    thread.join()
+    assert values == [1, 1, 2] and created[0] != created[1]
+
+
+def test_table_is_per_thread(aws: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    resources = []
+    resource = aws.resource
+
+    def new_resource(*args, **kwargs) -> Any:
+        resources.append(threading.get_ident())
+        return resource(*args, **kwargs)
+
+    monkeypatch.setattr(aws, "resource", new_resource)
+    runtime = load_module("predict", "runtime")
+    table = runtime.table("dyn-user-cdk")
+    table.put_item(Item={"user_id": "a", "skey": "info"})
+    thread = threading.Thread(target=lambda: table.get_item(Key={"user_id": "a", "skey": "info"}))
+    thread.start()
+    thread.join()
+    table.get_item(Key={"user_id": "a", "skey": "info"})
+    assert len(resources) == 2
+
+
+def test_client_is_shared_only_with_same_config(aws: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    created = []
+
+    def new_client(service_name: str, *args, **kwargs) -> Any:
+        created.append((service_name, kwargs["config"].connect_timeout))
+        return SimpleNamespace(name=f"client-{len(created)}")
+
+    monkeypatch.setattr(aws, "client", new_client)
+    runtime = load_module("predict", "runtime")
+    default, same = runtime.client("s3"), runtime.client("s3")
+    fast = runtime.client("s3", config={"connect_timeout": 1})
+    # Configが違えば先に作ったクライアントを使い回さない
+    assert (default.name, same.name, fast.name) == ("client-1", "client-1", "client-2")
+    assert runtime.client("s3", config={"connect_timeout": 1}).name == "client-2"
+    assert created == [("s3", 60), ("s3", 1)]
+
+
+def test_with_retry(monkeypatch: pytest.MonkeyPatch) -> None:
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+    monkeypatch.setattr(predict.time, "sleep", lambda _: None)
+    calls = []
+
+    def flaky(n_failures: int, exception: type[Exception]) -> str:
+        calls.append(1)
+        if len(calls) <= n_failures:
+            raise exception
+        return "ok"
+
+    assert predict.with_retry(flaky, predict.PERSIST_RETRY - 1, predict.RetryableException) == "ok"
+    calls.clear()
+    with pytest.raises(predict.RetryableException):
+        predict.with_retry(flaky, predict.PERSIST_RETRY, predict.RetryableException)
+    assert len(calls) == predict.PERSIST_RETRY
+    # やり直しても成功しない失敗はすぐに諦める
+    calls.clear()
+    with pytest.raises(predict.DoNotRetryException):
+        predict.with_retry(flaky, 1, predict.DoNotRetryException)
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize("handler", ["on_connect", "enter_room", "dis_connect", "predict_queue", "predict", "start_game"])
+def test_handler_import_does_not_load_boto3(handler: str) -> None:
+    # boto3/botocoreは最初にAWSを使うときまで読み込まない(コールドスタートの初期化を軽くする)
+    env, _ = local_env()
+    code = "import sys, lambda_function; print(sorted(m for m in sys.modules if m.split('.')[0] in ('boto3', 'botocore')))"
+    res = subprocess.run(
+        [sys.executable, "-c", code], cwd=os.path.join(SRC_DIR, handler),
+        env={**os.environ, **env, "MODEL_PREWARM": "0"}, capture_output=True, text=True, check=True,
+    )
+    assert res.stdout.strip() == "[]"
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import json
+import base64
+import time
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+
+from conftest import load_module
+from local_aws import FakeModel, load_handler
+
+shedding = load_module("predict", "shedding")
+
+
+def frame(connection_id: str, requested_at: int, sent_at: int, is_fin: bool = False) -> Any:
+    return SimpleNamespace(connection_id=connection_id, requested_at=requested_at, sent_at=sent_at, body=SimpleNamespace(is_fin=is_fin))
+
+
+def test_frame_age_shorter_than_queue_age_is_rejected() -> None:
+    # 短いと, キューが遅れているときは途中経過がすべて落ちる
+    with pytest.raises(ValueError, match="SHED_FRAME_AGE_MS"):
+        shedding.SheddingConfig.from_env("2000", "1000", "busy")
+    with pytest.raises(ValueError, match="SHED_MODE"):
+        shedding.SheddingConfig.from_env("2000", "2000", "drop")
+    assert shedding.SheddingConfig.from_env("2000", "2000", "skip") == (2000, 2000, "skip")
+
+
+def test_shed_drops_only_frames_past_frame_age() -> None:
+    config = shedding.SheddingConfig(2000, 2000, "busy")
+    now = 10000
+    # 遅れていなければ何も落とさない
+    fresh = [frame("a", now - 2500, now - 1500)]
+    assert shedding.shed(fresh, now, config) == (fresh, [])
+    # 遅れていればframe_age_msを過ぎた途中経過だけを落とし, 最終フレームは残す
+    old, recent, fin = frame("a", now - 2600, now - 2500), frame("b", now - 1900, now - 1800), frame("c", now - 3000, now - 2900, True)
+    assert shedding.shed([old, recent, fin], now, config) == ([recent, fin], [old])
+
+
+def test_busy_is_not_repeated_within_retry_after() -> None:
+    busy_until: dict[str, int] = {}
+    assert shedding.busy_targets([frame("a", 0, 0), frame("a", 0, 0), frame("b", 0, 0)], 1000, busy_until, 2000) == ["a", "b"]
+    assert shedding.busy_targets([frame("a", 0, 0), frame("c", 0, 0)], 2000, busy_until, 2000) == ["c"]
+    # 期限が過ぎたら返し直し, 古い接続は忘れる
+    assert shedding.busy_targets([frame("a", 0, 0)], 3000, busy_until, 2000) == ["a"]
+    assert busy_until == {"a": 5000, "c": 4000}
+
+
+def test_lagging_queue_sheds_and_replies_busy(aws: Any) -> None:
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+    now = int(time.time() * 1000)
+
+    def record(message_id: str, connection_id: str, requested_at: int) -> dict[str, Any]:
+        body = {
+            "v": 1, "connection_id": connection_id, "requested_at": requested_at,
+            "frame": {"odai": "木", "is_fin": False, "img_id": "hoge"},
+            "img_b64": predict.INK28_HEADER + "," + base64.b64encode(bytes(28 * 28)).decode(),
+        }
+        return {"messageId": message_id, "body": json.dumps(body), "attributes": {"SentTimestamp": str(requested_at + 100)}}
+
+    records = [record("m-0", "a", now - 5000), record("m-1", "b", now - 500)]
+    assert predict.lambda_handler({"Records": records}, None) == {"batchItemFailures": []}
+    assert aws.apigw.sent["a"] == [{"command": "busy", "retry_after_ms": 2000}]
+    assert [data["command"] for data in aws.apigw.sent["b"]] == ["predict"]
+    # 続けて落としてもbusyは返し直さない
+    predict.lambda_handler({"Records": [record("m-2", "a", now - 4500)]}, None)
+    assert len(aws.apigw.sent["a"]) == 1
+    assert predict.coalesce_counter["shed"] == 2
@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+import json
+
+import numpy as np
+import pytest
+
+
+def record(n_top):
+    envelope = {
+        "v": 1,
+        "connection_id": "c1",
+        "requested_at": 0,
+        "frame": {"odai": "空母", "is_fin": False, "img_id": "0", "n_top": n_top},
+        "img_b64": "",
+    }
+    return {"messageId": "m1", "body": json.dumps(envelope)}
+
+
+def test_top_k_matches_full_sort(predict):
+    result = np.random.default_rng(0).random(len(predict.labels.names)).astype(np.float32)
+    # 同点はindex順
+    result[[3, 7]] = result.max() + 1
+    order = sorted(range(len(result)), key=lambda i: (-result[i], i))[:5]
+    assert [score["key"] for score in predict.top_k(result, 5)] == [predict.labels.names[i] for i in order]
+
+
+@pytest.mark.parametrize("n_top, expected", [("3", 3), (0, 1), (-5, 1), (10**9, None)])
+def test_n_top_is_clamped(predict, n_top, expected):
+    body = predict.Frame.from_record(record(n_top)).body
+    assert body.n_top == (expected or len(predict.labels.names))
+
+
+@pytest.mark.parametrize("n_top", ["abc", None, [5]])
+def test_invalid_n_top_is_dropped_without_retry(predict, n_top):
+    with pytest.raises(predict.InvalidFrameException):
+        predict.Frame.from_record(record(n_top))
+    # SQSに戻す(batchItemFailures)と3回受け取り直してからDLQに入るだけなので捨てる
+    assert predict.lambda_handler({"Records": [record(n_top)]}, None) == {"batchItemFailures": []}
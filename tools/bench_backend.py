@@ -0,0 +1,108 @@
+"""predictのモデルのバックエンド(tflite/keras)ごとのコールドスタートとメモリを測る
+
+バックエンドごとに新しいプロセスで, 読み込み(import + モデルのロード), 最初の推論, 10枚のバッチの推論の
+時間とピークRSSを測る. src/predict/model.h5がなければ同じ入出力の形の代わりのモデルを作って測る
+(ランタイムの読み込みにかかる時間とメモリはモデルの中身によらない).
+
+    python tools/bench_backend.py
+    python tools/bench_backend.py --model path/to/model.h5
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+from cdk_env import ROOT
+
+PREDICT_DIR = os.path.join(ROOT, "src", "predict")
+
+MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+import numpy as np
+from backend import BACKENDS
+model = BACKENDS[sys.argv[1]](sys.argv[2])
+loaded = time.perf_counter()
+imgs = np.random.default_rng(0).random((10, 28, 28), dtype=np.float32)
+model.predict(imgs[:1])
+first = time.perf_counter()
+for _ in range(20):
+    model.predict(imgs)
+steady = time.perf_counter()
+print(json.dumps({
+    "load_ms": (loaded - start) * 1000,
+    "first_predict_ms": (first - loaded) * 1000,
+    "batch10_ms": (steady - first) * 1000 / 20,
+    # ru_maxrssはexecの前の(TensorFlowを読み込んだ)親プロセスの値を引き継ぐのでVmHWMを読む
+    "max_rss_mb": int(next(l for l in open("/proc/self/status") if l.startswith("VmHWM")).split()[1]) / 1024,
+}))
+"""
+
+
+def build_stand_in_model(path: str) -> None:
+    # 28x28の描画を270クラスに分類する, 元のモデルと同じ入出力の小さなCNN
+    import tensorflow as tf
+    tf.keras.utils.set_random_seed(0)
+    model = tf.keras.Sequential([
+        tf.keras.layers.Input((28, 28)),
+        tf.keras.layers.Reshape((28, 28, 1)),
+        tf.keras.layers.Conv2D(32, 3, activation="relu"),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Conv2D(64, 3, activation="relu"),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(128, activation="relu"),
+        tf.keras.layers.Dense(270, activation="softmax"),
+    ])
+    model.save(path)
+
+
+def prepare(model: str | None, directory: str) -> tuple[str, str]:
+    # model.h5(なければ代わりのモデル)をexport_model.pyでtfliteに変換する
+    sys.path.insert(0, PREDICT_DIR)
+    from export_model import export
+    h5 = model or os.path.join(PREDICT_DIR, "model.h5")
+    if not os.path.exists(h5):
+        h5 = os.path.join(directory, "model.h5")
+        build_stand_in_model(h5)
+    tflite = os.path.join(directory, "model.tflite")
+    export(h5, tflite)
+    return h5, tflite
+
+
+def measure(backend: str, path: str, python: str) -> dict[str, float]:
+    res = subprocess.run(
+        [python, "-c", MEASURE, backend, path],
+        cwd=PREDICT_DIR,
+        env={**os.environ, "TF_CPP_MIN_LOG_LEVEL": "3"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(res.stdout.splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", help="model.h5のパス(省略時はsrc/predict/model.h5, なければ代わりのモデル)")
+    parser.add_argument("--python", default=sys.executable, help="計測に使うPython(Lambdaと同じバージョンにする)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        h5, tflite = prepare(args.model, directory)
+        results = {"keras": measure("keras", h5, args.python), "tflite": measure("tflite", tflite, args.python)}
+    print(f"model         : {h5 if args.model or h5.startswith(PREDICT_DIR) else 'stand-in CNN'}")
+    print(f"{'':<8}{'load':>10}{'first':>10}{'batch10':>10}{'peak RSS':>11}")
+    for name, result in results.items():
+        print(
+            f"{name:<8}{result['load_ms']:>8.0f}ms{result['first_predict_ms']:>8.1f}ms"
+            f"{result['batch10_ms']:>8.2f}ms{result['max_rss_mb']:>8.0f} MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
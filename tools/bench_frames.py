@@ -0,0 +1,347 @@
+"""predictの1フレームあたりの処理(前処理など)を単体で測るベンチマーク
+
+static/*.pngを描画として使う.
+
+    # 最適化前の実装(tests/baseline.py)と今の実装のスループット
+    python tools/bench_frames.py preprocessing --frames 2000
+    # 推論の後(全クラスのソートとtop_k, 返信のJSON)にかかる1フレームあたりの時間
+    python tools/bench_frames.py topk --frames 20000
+    # 途中経過をJPEG/PNGで送る場合と軽量フォーマット(x-ink28)で送る場合のペイロードの大きさと前処理の時間
+    python tools/bench_frames.py ink28 --frames 2000
+    # predict_queueがSQSに送るメッセージ(API Gatewayのイベント全体とエンベロープ)の大きさとpredictでの読み込み時間
+    python tools/bench_frames.py envelope --frames 20000
+    # data-URLのデコードで一時的に確保されるメモリ(tracemalloc)と時間
+    python tools/bench_frames.py decode --frames 2000
+    # ログの出し方(最適化前, LOG_LEVELごと)によるpredictのハンドラー1回あたりの時間
+    python tools/bench_frames.py logging --batches 200 --batch-size 10
+    # 最終フレームの結果が返るまでの時間(保存してから返す最適化前と, 返してから保存する今の実装)
+    python tools/bench_frames.py reply --frames 50 --s3-ms 30 --db-ms 10 --post-ms 20
+"""
+from __future__ import annotations
+
+import io
+import os
+import sys
+import time
+import json
+import base64
+import logging
+import argparse
+import contextlib
+import tracemalloc
+from typing import Any, Callable
+from unittest import mock
+
+from cdk_env import ROOT, local_env
+from local_aws import SRC_DIR, FakeModel, LocalSession, load_handler
+
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+from conftest import drawings  # noqa: E402
+
+
+def throughput(fn: Callable[[Any], Any], inputs: list[Any], n_frames: int) -> float:
+    start = time.perf_counter()
+    for i in range(n_frames):
+        fn(inputs[i % len(inputs)])
+    return n_frames / (time.perf_counter() - start)
+
+
+def bench_preprocessing(args: argparse.Namespace) -> None:
+    import baseline
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+    urls = drawings()
+    results = {
+        "baseline": throughput(baseline.preprocessing, urls, args.frames),
+        "current": throughput(lambda url: predict.preprocessing(predict.FrameImage.from_data_url(url)), urls, args.frames),
+    }
+    for name, fps in results.items():
+        print(f"{name:<14}: {fps:.0f} frames/s")
+    print(f"speedup       : {results['current'] / results['baseline']:.2f}x")
+
+
+def bench_topk(args: argparse.Namespace) -> None:
+    import numpy as np
+    import baseline
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+    odai = predict.labels.names[0]
+    results = [predict.reconstructed_model.get().predict(np.zeros((1, 28, 28))) for _ in range(100)]
+
+    # お題の得点と返信するJSONを作るまで
+    def before(result: Any) -> tuple[float, bytes]:
+        # 最適化前: 全クラスを辞書にしてソートし, 返信するときに上位5件に切り詰める
+        label_score_map, scores = baseline.scores(result)
+        return label_score_map[odai], json.dumps({"command": "predict", "scores": scores[:5]}).encode()
+
+    def after(result: Any) -> tuple[float, bytes]:
+        result = result[0] * 10000
+        score = float(result[predict.labels.label_index_map[odai]])
+        return score, json.dumps({"command": "predict", "scores": predict.top_k(result, 5)}).encode()
+
+    # baselineはlabel.csvを相対パスで読む
+    os.chdir(os.path.join(SRC_DIR, "predict"))
+    index_label_map = baseline.get_index_label_map()
+    with mock.patch.object(baseline, "get_index_label_map", lambda: index_label_map):
+        cached = throughput(before, results, args.frames)
+    rows = {
+        "baseline": throughput(before, results, args.frames),
+        "baseline (labels cached)": cached,
+        "top_k": throughput(after, results, args.frames),
+    }
+    print(f"{'':<26}{'us/frame':>10}")
+    for name, fps in rows.items():
+        print(f"{name:<26}{1e6 / fps:>10.1f}")
+
+
+def to_jpeg_url(url: str) -> str:
+    # ブラウザのcanvas.toDataURL("image/jpeg")と同じく白背景のJPEGにする
+    from PIL import Image
+    img = Image.open(io.BytesIO(base64.b64decode(url.split(",")[1]))).convert("RGBA")
+    back = Image.new("RGB", img.size, "white")
+    back.paste(img, mask=img.getchannel("A"))
+    buf = io.BytesIO()
+    back.save(buf, "JPEG", quality=92)
+    return "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode()
+
+
+def bench_ink28(args: argparse.Namespace) -> None:
+    import numpy as np
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+    pngs = drawings()
+    # ブラウザ(static/ink28.js)が作るものと同じ28x28をサーバーの前処理から作る
+    inks = [
+        predict.INK28_HEADER + "," + base64.b64encode(
+            np.rint(predict.preprocessing(predict.FrameImage.from_data_url(url)) * 255).astype(np.uint8).tobytes()
+        ).decode()
+        for url in pngs
+    ]
+    print(f"{'':<8}{'bytes/frame':>12}{'frames/s':>10}{'ms/frame':>10}")
+    for name, urls in (("jpeg", [to_jpeg_url(url) for url in pngs]), ("png", pngs), ("ink28", inks)):
+        fps = throughput(lambda url: predict.preprocessing(predict.FrameImage.from_data_url(url)), urls, args.frames)
+        size = sum(len(url) for url in urls) / len(urls)
+        print(f"{name:<8}{size:>12.0f}{fps:>10.0f}{1000 / fps:>10.3f}")
+
+
+def ws_event(connection_id: str, body: dict[str, Any]) -> dict[str, Any]:
+    # API GatewayのWebSocketが$request.body.actionで振り分けたときのイベント(値は実物から取った例)
+    now = int(time.time() * 1000)
+    return {
+        "requestContext": {
+            "routeKey": "predict",
+            "messageId": "Zr6ZVdnsNjMCJ0g=",
+            "eventType": "MESSAGE",
+            "extendedRequestId": "Zr6ZVEfXtjMFoVg=",
+            "requestTime": "18/Oct/2026:00:00:00 +0000",
+            "messageDirection": "IN",
+            "stage": "prod",
+            "connectedAt": now - 60000,
+            "requestTimeEpoch": now,
+            "identity": {"sourceIp": "203.0.113.10"},
+            "requestId": "Zr6ZVEfXtjMFoVg=",
+            "domainName": "pu2msqmfgk.execute-api.ap-northeast-1.amazonaws.com",
+            "connectionId": connection_id,
+            "apiId": "pu2msqmfgk",
+        },
+        "body": json.dumps(body),
+        "isBase64Encoded": False,
+    }
+
+
+def bench_envelope(args: argparse.Namespace) -> None:
+    predict_queue = load_handler("predict_queue")
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+    pngs = drawings()
+    ink = predict.INK28_HEADER + "," + base64.b64encode(bytes(28 * 28)).decode()
+    print(f"{'':<16}{'bytes/message':>14}{'us/parse':>10}")
+    for img_name, img_b64 in (("png", pngs[0]), ("ink28", ink)):
+        event = ws_event("Zr6ZVdnsNjMCJ0g=", {"action": "predict", "odai": "空母", "is_fin": False, "img_id": "hoge", "img_b64": img_b64})
+        for name, body in (("event", json.dumps(event)), ("envelope", json.dumps(predict_queue.to_envelope(event)))):
+            record = {"messageId": "m", "body": body, "attributes": {"SentTimestamp": "0"}}
+            fps = throughput(predict.Frame.from_record, [record], args.frames)
+            print(f"{img_name + ' ' + name:<16}{len(body):>14}{1e6 / fps:>10.2f}")
+
+
+def peak_bytes(fn: Callable[[str], Any], url: str) -> int:
+    # 戻り値も含めて, 1回の呼び出しの間に確保されたメモリの最大値
+    tracemalloc.start()
+    result = fn(url)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak
+
+
+def bench_decode(args: argparse.Namespace) -> None:
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+    # 最終フレームはJPEGで送られる
+    urls = [to_jpeg_url(url) for url in drawings()]
+    decoders = {
+        # 最適化前: split(",")で分けてからbase64.b64decode
+        "split": lambda url: base64.b64decode(url.split(",")[1]),
+        "from_data_url": predict.FrameImage.from_data_url,
+    }
+    payload = sum(len(url) for url in urls) / len(urls)
+    raw = sum(len(predict.FrameImage.from_data_url(url).raw) for url in urls) / len(urls)
+    print(f"payload       : {payload:.0f} chars/frame, decoded {raw:.0f} bytes/frame")
+    print(f"{'':<14}{'peak bytes':>12}{'x payload':>10}{'us/frame':>10}")
+    for name, fn in decoders.items():
+        peak = sum(peak_bytes(fn, url) for url in urls) / len(urls)
+        fps = throughput(fn, urls, args.frames)
+        print(f"{name:<14}{peak:>12.0f}{peak / payload:>10.2f}{1e6 / fps:>10.1f}")
+
+
+def old_debug(logger: logging.Logger, msg: str, obj: Any, connection_id: str | None = None) -> None:
+    # 最適化前: イベント全体(画像のbase64も含む)をindent=2で整形し, 返信する得点も毎回INFOで出していた
+    logger.info(json.dumps(obj, indent=2) if msg == "event" else obj)
+
+
+def bench_logging(args: argparse.Namespace) -> None:
+    # Lambdaと同じくルートロガーにハンドラーを付け, 出力する行は実際に整形して書き出す(書き出し先は/dev/null)
+    devnull = open(os.devnull, "w")
+    root = logging.getLogger()
+    root.addHandler(logging.StreamHandler(devnull))
+    pngs = drawings()
+
+    def event() -> dict[str, Any]:
+        now = int(time.time() * 1000)
+        return {"Records": [
+            {
+                "messageId": f"m-{i}",
+                "body": json.dumps({
+                    "v": 1, "connection_id": f"c-{i}", "requested_at": now,
+                    "frame": {"odai": "木", "is_fin": False, "img_id": "hoge"}, "img_b64": pngs[i % len(pngs)],
+                }),
+                "attributes": {"SentTimestamp": str(now)},
+            }
+            for i in range(args.batch_size)
+        ]}
+
+    configs = {
+        "before": ("INFO", mock.patch("log_util.debug", old_debug)),
+        "off(WARNING)": ("WARNING", contextlib.nullcontext()),
+        "INFO": ("INFO", contextlib.nullcontext()),
+        "DEBUG": ("DEBUG", contextlib.nullcontext()),
+    }
+    results: dict[str, float] = {}
+    for _ in range(args.rounds):
+        for name, (level, patch) in configs.items():
+            # EMFのメトリクスは標準出力に書くので, ログの違いだけを比べられるよう捨てる
+            with mock.patch("boto3.Session", return_value=LocalSession()), contextlib.redirect_stdout(devnull):
+                # 測っている間にフレームが古くなっても落とさない
+                env = {"LOG_LEVEL": level, "MODEL_PREWARM": "0", "SHED_QUEUE_AGE_MS": "600000", "SHED_FRAME_AGE_MS": "600000"}
+                predict = load_handler("predict", FakeModel(), env)
+                # 前処理(1フレーム数ms)はログと関係なく同じだけかかるので, 固定の入力を返してハンドラー自体の時間を測る
+                blank = predict.np.zeros((28, 28, 1), dtype="float32")
+                events = [event() for _ in range(args.batches)]
+                with patch, mock.patch.object(predict, "preprocessing", lambda image: blank):
+                    start = time.perf_counter()
+                    for e in events:
+                        assert predict.lambda_handler(e, None) == {"batchItemFailures": []}
+                    us = (time.perf_counter() - start) * 1e6 / (args.batches * args.batch_size)
+                assert predict.coalesce_counter["shed"] == 0
+            results[name] = min(results.get(name, us), us)
+    print(f"{'':<14}{'us/frame':>10}{'vs off':>9}")
+    for name, us in results.items():
+        print(f"{name:<14}{us:>10.1f}{us / results['off(WARNING)']:>8.2f}x")
+
+
+def slow_session(args: argparse.Namespace, replied_at: dict[str, float]) -> LocalSession:
+    # S3, DynamoDB, API Gatewayの1回の呼び出しに--s3-ms, --db-ms, --post-msかける. 返信した時刻を接続ごとに記録する
+    session = LocalSession()
+
+    def slow(fn: Callable[..., Any], ms: float, on_done: Callable[..., None] = lambda **kwargs: None) -> Callable[..., Any]:
+        def call(*a, **kwargs) -> Any:
+            time.sleep(ms / 1000)
+            res = fn(*a, **kwargs)
+            on_done(**kwargs)
+            return res
+        return call
+
+    session.s3.put_object = slow(session.s3.put_object, args.s3_ms)
+    for table in session.dynamodb.tables.values():
+        for name in ("get_item", "put_item", "update_item"):
+            setattr(table, name, slow(getattr(table, name), args.db_ms))
+    session.apigw.post_to_connection = slow(
+        session.apigw.post_to_connection, args.post_ms,
+        lambda ConnectionId, **kwargs: replied_at.setdefault(ConnectionId, time.perf_counter()),
+    )
+    return session
+
+
+def bench_reply(args: argparse.Namespace) -> None:
+    replied_at: dict[str, float] = {}
+    session = slow_session(args, replied_at)
+    # クライアントは最初に使うときに作るので, 測り終わるまでSessionを差し替えておく
+    with mock.patch("boto3.Session", return_value=session):
+        run_reply(args, session, replied_at)
+
+
+def run_reply(args: argparse.Namespace, session: LocalSession, replied_at: dict[str, float]) -> None:
+    import numpy as np
+    predict = load_handler("predict", FakeModel(), {"MODEL_PREWARM": "0"})
+    env = local_env()[0]
+    url = drawings()[0]
+    odai = predict.labels.names[0]
+
+    def before(connection_id: str, body: Any, image: Any, result: Any) -> None:
+        # 最適化前: 画像と得点を保存し終わってから結果を返す
+        scores = predict.top_k(result, body.n_top)
+        predict.persist(connection_id, "m", body, image, float(result[predict.labels.label_index_map[odai]]), predict.StageTimer())
+        predict.post_result(connection_id, scores, "img_save")
+
+    def after(connection_id: str, body: Any, image: Any, result: Any) -> None:
+        predict.service(connection_id, "m", body, image, result, predict.StageTimer()).result()
+
+    print(f"S3: {args.s3_ms} ms, DynamoDB: {args.db_ms} ms, post_to_connection: {args.post_ms} ms")
+    print(f"{'':<8}{'reply ms':>10}{'done ms':>10}")
+    for name, fn in (("before", before), ("after", after)):
+        reply, done = [], []
+        for i in range(args.frames):
+            connection_id = f"{name}-{i}"
+            session.dynamodb.tables[env["USER_TABLE_NAME"]].put_item(
+                Item={env["USER_TABLE_PKEY"]: connection_id, env["USER_TABLE_SKEY"]: "info", "room_id": "bench", "user_name": connection_id},
+            )
+            body = predict.BodySchema(odai=odai, is_fin=True, img_id=str(i), img_b64=url)
+            image = predict.FrameImage.from_data_url(url)
+            result = predict.reconstructed_model.get().predict(np.zeros((1, 28, 28)))[0] * 10000
+            start = time.perf_counter()
+            fn(connection_id, body, image, result)
+            done.append((time.perf_counter() - start) * 1000)
+            reply.append((replied_at[connection_id] - start) * 1000)
+        print(f"{name:<8}{np.median(reply):>10.1f}{np.median(done):>10.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    preprocessing = subparsers.add_parser("preprocessing", help="data-URLから28x28のモデル入力を作るまで")
+    preprocessing.add_argument("--frames", type=int, default=2000)
+    preprocessing.set_defaults(fn=bench_preprocessing)
+    topk = subparsers.add_parser("topk", help="推論の後の得点の整形")
+    topk.add_argument("--frames", type=int, default=20000)
+    topk.set_defaults(fn=bench_topk)
+    ink28 = subparsers.add_parser("ink28", help="途中経過のフォーマットごとの大きさと前処理")
+    ink28.add_argument("--frames", type=int, default=2000)
+    ink28.set_defaults(fn=bench_ink28)
+    envelope = subparsers.add_parser("envelope", help="SQSのメッセージの大きさと読み込み")
+    envelope.add_argument("--frames", type=int, default=20000)
+    envelope.set_defaults(fn=bench_envelope)
+    decode = subparsers.add_parser("decode", help="data-URLのデコードのメモリと時間")
+    decode.add_argument("--frames", type=int, default=2000)
+    decode.set_defaults(fn=bench_decode)
+    log = subparsers.add_parser("logging", help="ログの出し方ごとのハンドラーの時間")
+    log.add_argument("--batches", type=int, default=200)
+    log.add_argument("--batch-size", type=int, default=10)
+    log.add_argument("--rounds", type=int, default=5, help="この回数測って最小値を取る")
+    log.set_defaults(fn=bench_logging)
+    reply = subparsers.add_parser("reply", help="最終フレームの結果が返るまでの時間")
+    reply.add_argument("--frames", type=int, default=50)
+    reply.add_argument("--s3-ms", type=float, default=30, help="S3のPutObjectの1回にかかる時間")
+    reply.add_argument("--db-ms", type=float, default=10, help="DynamoDBの1回の読み書きにかかる時間")
+    reply.add_argument("--post-ms", type=float, default=20, help="post_to_connectionの1回にかかる時間")
+    reply.set_defaults(fn=bench_reply)
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()
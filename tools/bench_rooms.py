@@ -0,0 +1,166 @@
+"""部屋の人数ごとのブロードキャストや入室の時間を, API Gateway(1回の送信に--post-msかかる)と
+DynamoDB(1回の読み書きに--db-msかかる)の代わりに対して測るベンチマーク
+
+    # 1人ずつ順に送る(最適化前のpost_room)場合, 呼び出しごとにスレッドプールを作る場合, broadcast.pyで並列に送る場合
+    python tools/bench_rooms.py broadcast --sizes 2 5 10 20 50 --post-ms 20
+    # 入室したときのメッセージ数, DynamoDBの読み込み回数, 時間(最適化前のenter_roomと今のenter_room)
+    python tools/bench_rooms.py roster --sizes 2 5 10 20 50 --post-ms 20 --db-ms 5
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+from unittest import mock
+
+from cdk_env import ROOT, local_env
+from local_aws import LocalSession, RecordingApiGateway, load_handler
+
+sys.path.insert(0, os.path.join(ROOT, "src", "start_game"))
+import broadcast  # noqa: E402
+
+
+class SlowApiGateway(RecordingApiGateway):
+    # post_to_connectionの1回にpost_msかかる(API Gatewayまでの往復の代わり)
+    def __init__(self, post_ms: float) -> None:
+        super().__init__()
+        self.post_ms = post_ms
+
+    def post_to_connection(self, Data: bytes, ConnectionId: str, **kwargs) -> dict[str, Any]:
+        time.sleep(self.post_ms / 1000)
+        return super().post_to_connection(Data=Data, ConnectionId=ConnectionId, **kwargs)
+
+
+def serial(apigw: Any, connection_ids: list[str], data: dict[str, Any]) -> None:
+    # 最適化前: 1人ずつ順に, 送るたびにシリアライズする
+    for connection_id in connection_ids:
+        apigw.post_to_connection(Data=json.dumps(data).encode(), ConnectionId=connection_id)
+
+
+def pool_per_call(apigw: Any, connection_ids: list[str], data: dict[str, Any]) -> None:
+    # 呼び出しごとにスレッドプールを作って捨てる(モジュールで1つを使い回す前のbroadcast)
+    data_bin = json.dumps(data).encode()
+    with ThreadPoolExecutor(max_workers=min(broadcast.MAX_WORKERS, len(connection_ids))) as executor:
+        list(executor.map(lambda connection_id: broadcast.post(apigw, connection_id, data_bin), connection_ids))
+
+
+def elapsed_ms(fn: Callable[[], Any], repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def bench_broadcast(args: argparse.Namespace) -> None:
+    data = {"command": "round_start", "round": 0, "odai": "空母", "starts_in_ms": 3000}
+    print(f"post_to_connection: {args.post_ms} ms, max workers: {broadcast.MAX_WORKERS}")
+    print(f"{'members':>8}{'serial':>12}{'pool/call':>12}{'broadcast':>12}{'speedup':>9}")
+    for size in args.sizes:
+        apigw = SlowApiGateway(args.post_ms)
+        connection_ids = [f"c-{i}" for i in range(size)]
+        before = elapsed_ms(lambda: serial(apigw, connection_ids, data), args.repeat)
+        per_call = elapsed_ms(lambda: pool_per_call(apigw, connection_ids, data), args.repeat)
+        after = elapsed_ms(lambda: broadcast.broadcast(apigw, connection_ids, data), args.repeat)
+        assert all(len(sent) == args.repeat * 3 for sent in apigw.sent.values())
+        print(f"{size:>8}{before:>10.1f}ms{per_call:>10.1f}ms{after:>10.1f}ms{before / after:>8.1f}x")
+
+
+def slow_session(post_ms: float, db_ms: float) -> tuple[LocalSession, Counter[str]]:
+    # DynamoDBの呼び出しを種類ごとに数え, 1回ごとにdb_msかける
+    session = LocalSession()
+    session.apigw = SlowApiGateway(post_ms)
+    calls: Counter[str] = Counter()
+    for table in session.dynamodb.tables.values():
+        for name in ("get_item", "query", "put_item", "update_item", "delete_item"):
+            def call(*args, _fn=getattr(table, name), _name=name, **kwargs) -> Any:
+                calls[_name] += 1
+                time.sleep(db_ms / 1000)
+                return _fn(*args, **kwargs)
+            setattr(table, name, call)
+    return session, calls
+
+
+def enter_before(session: LocalSession, env: dict[str, str], connection_id: str, room_id: str, user_name: str) -> None:
+    # 最適化前のenter_room: 入室者にはメンバーごとにget_itemで名前を読んで1通ずつ送り, 他のメンバーにも1人ずつ順に送る
+    from boto3.dynamodb.conditions import Key
+    user_table, room_table = session.dynamodb.Table(env["USER_TABLE_NAME"]), session.dynamodb.Table(env["ROOM_TABLE_NAME"])
+    user_table.put_item(Item={env["USER_TABLE_PKEY"]: connection_id, env["USER_TABLE_SKEY"]: "info", "room_id": room_id, "user_name": user_name})
+    room_table.put_item(Item={env["ROOM_TABLE_PKEY"]: room_id, env["ROOM_TABLE_SKEY"]: connection_id})
+    items = room_table.query(KeyConditionExpression=Key(env["ROOM_TABLE_PKEY"]).eq(room_id))["Items"]
+    connection_ids = [item[env["ROOM_TABLE_SKEY"]] for item in items]
+    for member in connection_ids:
+        if member == connection_id:
+            for other in connection_ids:
+                res = user_table.get_item(Key={env["USER_TABLE_PKEY"]: other, env["USER_TABLE_SKEY"]: "info"})
+                data = {"command": "enter_room", "name": res["Item"]["user_name"]}
+                session.apigw.post_to_connection(Data=json.dumps(data).encode(), ConnectionId=connection_id)
+        else:
+            data = {"command": "enter_room", "name": user_name}
+            session.apigw.post_to_connection(Data=json.dumps(data).encode(), ConnectionId=member)
+
+
+def seed_room(session: LocalSession, env: dict[str, str], room_id: str, n_members: int) -> None:
+    # 入室者より前にいるメンバー(今のenter_roomと同じくroomテーブルの行にも名前を持たせる)
+    for i in range(n_members):
+        session.dynamodb.tables[env["USER_TABLE_NAME"]].put_item(
+            Item={env["USER_TABLE_PKEY"]: f"c-{i}", env["USER_TABLE_SKEY"]: "info", "room_id": room_id, "user_name": f"c-{i}"},
+        )
+        session.dynamodb.tables[env["ROOM_TABLE_NAME"]].put_item(
+            Item={env["ROOM_TABLE_PKEY"]: room_id, env["ROOM_TABLE_SKEY"]: f"c-{i}", "user_name": f"c-{i}"},
+        )
+
+
+def bench_roster(args: argparse.Namespace) -> None:
+    env, _ = local_env()
+    event = {
+        "requestContext": {"connectionId": "new"},
+        "body": json.dumps({"action": "enter_room", "room_id": "bench", "user_name": "new"}),
+    }
+    print(f"post_to_connection: {args.post_ms} ms, DynamoDB: {args.db_ms} ms")
+    print(f"{'':>8}{'messages':>20}{'reads':>16}{'time':>22}")
+    print(f"{'members':>8}{'before':>10}{'after':>10}{'before':>8}{'after':>8}{'before':>11}{'after':>11}")
+    for size in args.sizes:
+        rows = {}
+        for name in ("before", "after"):
+            session, calls = slow_session(args.post_ms, args.db_ms)
+            seed_room(session, env, "bench", size - 1)
+            with mock.patch("boto3.Session", return_value=session):
+                if name == "after":
+                    enter_room = load_handler("enter_room")
+                start = time.perf_counter()
+                if name == "before":
+                    enter_before(session, env, "new", "bench", "new")
+                else:
+                    assert enter_room.lambda_handler(event, None) == {"statusCode": 200}
+                elapsed = (time.perf_counter() - start) * 1000
+            assert len(session.apigw.sent["new"]) == (size if name == "before" else 1)
+            messages = sum(len(sent) for sent in session.apigw.sent.values())
+            rows[name] = (messages, calls["get_item"] + calls["query"], elapsed)
+        (m0, r0, t0), (m1, r1, t1) = rows["before"], rows["after"]
+        print(f"{size:>8}{m0:>10}{m1:>10}{r0:>8}{r1:>8}{t0:>9.1f}ms{t1:>9.1f}ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench = subparsers.add_parser("broadcast", help="部屋の全員への送信")
+    bench.add_argument("--sizes", type=int, nargs="+", default=[2, 5, 10, 20, 50], help="部屋の人数")
+    bench.add_argument("--post-ms", type=float, default=20, help="post_to_connectionの1回にかかる時間")
+    bench.add_argument("--repeat", type=int, default=5)
+    bench.set_defaults(fn=bench_broadcast)
+    roster = subparsers.add_parser("roster", help="入室したときのメンバー一覧の配信")
+    roster.add_argument("--sizes", type=int, nargs="+", default=[2, 5, 10, 20, 50], help="入室後の部屋の人数")
+    roster.add_argument("--post-ms", type=float, default=20, help="post_to_connectionの1回にかかる時間")
+    roster.add_argument("--db-ms", type=float, default=5, help="DynamoDBの1回の読み書きにかかる時間")
+    roster.set_defaults(fn=bench_roster)
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""cdk.jsonのcontextからLambdaの環境変数を組み立てる(tools/のスクリプトで共有する)"""
+from __future__ import annotations
+
+import os
+import json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def local_env() -> tuple[dict[str, str], dict[str, tuple[str, str]]]:
+    # cdk/construct.pyが各関数に設定する環境変数をcdk.jsonのcontextから組み立てる
+    # (テーブル名とそのキー, キューはlocal://<id>のURLにする)
+    with open(os.path.join(ROOT, "cdk.json"), "r", encoding="utf-8") as f:
+        context = json.load(f)["context"]
+    env: dict[str, str] = {"ENDPOINT_URL": "http://localhost"}
+    schemas = {}
+    for name, value in context.items():
+        if name.startswith("env_fn_"):
+            env.update(value)
+        elif name.startswith("env_db_"):
+            id = name[len("env_db_"):]
+            table_name = f"dyn-{id}-cdk"
+            env[f"{id.upper()}_TABLE_NAME"] = table_name
+            env[f"{id.upper()}_TABLE_PKEY"] = value["pkey"]
+            env[f"{id.upper()}_TABLE_SKEY"] = value["skey"]
+            schemas[table_name] = (value["pkey"], value["skey"])
+        elif name.startswith("env_s3_"):
+            id = name[len("env_s3_"):]
+            env[f"{id.upper()}_BUCKET_NAME"] = f"s3s-{id.replace('_', '-').lower()}-cdk"
+            env[f"{id.upper()}_BUCKET_KEY"] = value["key"]
+    for queue in ("predict_queue", "round_queue"):
+        env[f"{queue.upper()}_URL"] = f"local://{queue}"
+    return env, schemas
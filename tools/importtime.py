@@ -0,0 +1,98 @@
+"""ハンドラーごとのimport時間(コールドスタートの初期化コスト)を測るレポート
+
+src/<handler>でcdk.jsonから組み立てた環境変数を設定して `python -X importtime -c "import lambda_function"`
+を実行し, lambda_functionの読み込みにかかった合計時間と, 時間のかかったモジュールの上位を表示する.
+AWSのクライアントは最初に使うときまで作られないので, 認証情報がなくても測れる.
+
+    python tools/importtime.py
+    python tools/importtime.py predict --top 20
+    python tools/importtime.py --json > importtime.json
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from typing import Any
+
+from cdk_env import ROOT, local_env
+
+SRC_DIR = os.path.join(ROOT, "src")
+HANDLERS = ["on_connect", "enter_room", "dis_connect", "predict_queue", "predict", "start_game"]
+
+
+def parse(stderr: str) -> list[dict[str, Any]]:
+    # "import time:      self [us] |  cumulative | imported package" の形式の行だけを読む
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append({
+            "module": name.strip(),
+            # 先頭の空白の数が入れ子の深さ(1段あたり2文字)
+            "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000,
+        })
+    return imports
+
+
+def profile(handler: str, python: str) -> dict[str, Any]:
+    env, _ = local_env()
+    # モデルの読み込みは別スレッドで行われ計測がぶれるので止める
+    env = {**os.environ, **env, "MODEL_PREWARM": "0"}
+    res = subprocess.run(
+        [python, "-X", "importtime", "-c", "import lambda_function"],
+        cwd=os.path.join(SRC_DIR, handler),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    imports = parse(res.stderr)
+    # 子のモジュールは親より先に出力されるので, lambda_functionの行から直前の深さ0の行までがその中身
+    end = next((n for n, i in enumerate(imports) if i["module"] == "lambda_function"), None)
+    start = end
+    while start and imports[start - 1]["depth"] > 0:
+        start -= 1
+    total = imports[end]["cumulative_ms"] if end is not None else None
+    children = imports[start:end] if end is not None else []
+    return {
+        "handler": handler,
+        "ok": res.returncode == 0,
+        "total_ms": total,
+        # lambda_functionから直接読み込まれたモジュール(depth 1)のうち遅いもの
+        "modules": sorted(
+            [i for i in children if i["depth"] == 1],
+            key=lambda i: i["cumulative_ms"],
+            reverse=True,
+        ),
+        "error": res.stderr.splitlines()[-1] if res.returncode != 0 and res.stderr else None,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("handlers", nargs="*", default=HANDLERS, help="計測するハンドラー(省略時はすべて)")
+    parser.add_argument("--top", type=int, default=10, help="表示する遅いモジュールの数")
+    parser.add_argument("--python", default=sys.executable, help="計測に使うPython(Lambdaと同じバージョンにする)")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する(推移の記録用)")
+    args = parser.parse_args()
+
+    reports = [profile(handler, args.python) for handler in args.handlers]
+    if args.json:
+        print(json.dumps([{**report, "modules": report["modules"][:args.top]} for report in reports], ensure_ascii=False, indent=2))
+        return
+    for report in reports:
+        if not report["ok"]:
+            print(f"{report['handler']:<14}: failed ({report['error']})")
+            continue
+        print(f"{report['handler']:<14}: {report['total_ms']:.1f} ms")
+        for module in report["modules"][:args.top]:
+            print(f"  {module['module']:<40} {module['cumulative_ms']:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""AWSなしでハンドラーを動かすための部品(tools/とtests/で共有する)
+
+src/<handler>/lambda_function.py をLambdaと同じ環境変数・カレントディレクトリで読み込むload_handlerと,
+ハンドラーが使う範囲だけを実装したメモリ上のDynamoDB, S3.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import copy
+import threading
+import importlib.util
+from types import SimpleNamespace
+from typing import Any
+
+from cdk_env import ROOT, local_env
+
+SRC_DIR = os.path.join(ROOT, "src")
+
+
+class ConditionalCheckFailedException(Exception):
+    ...
+
+
+class ProvisionedThroughputExceededException(Exception):
+    ...
+
+
+def condition_values(condition: Any) -> tuple[str, Any]:
+    # boto3のKey(...).eq(...)/Attr(...).eq(...)だけを扱う
+    expression = condition.get_expression()
+    if expression["operator"] != "=":
+        raise ValueError(f"unsupported key condition operator: {expression['operator']}")
+    attr, value = expression["values"]
+    return attr.name, value
+
+
+def matches(condition: Any, item: dict[str, Any]) -> bool:
+    # ハンドラーが使う条件(eq, ne, attribute_exists, attribute_not_exists, contains, NOT, OR)だけを評価する
+    expression = condition.get_expression()
+    operator, values = expression["operator"], expression["values"]
+    if operator == "NOT":
+        return not matches(values[0], item)
+    if operator == "OR":
+        return any(matches(value, item) for value in values)
+    if operator == "attribute_not_exists":
+        return values[0].name not in item
+    if operator == "attribute_exists":
+        return values[0].name in item
+    if operator == "contains":
+        return values[1] in item.get(values[0].name, ())
+    if operator in ("=", "<>"):
+        equal = values[0].name in item and item[values[0].name] == values[1]
+        return equal if operator == "=" else values[0].name in item and not equal
+    raise ValueError(f"unsupported condition operator: {operator}")
+
+
+class LocalTable:
+
+    def __init__(self, name: str, pkey: str, skey: str, client: LocalDynamoDBClient) -> None:
+        self.name = name
+        self.pkey = pkey
+        self.skey = skey
+        self.items: dict[tuple[Any, Any], dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        self.meta = SimpleNamespace(client=client)
+
+    def _key(self, item: dict[str, Any]) -> tuple[Any, Any]:
+        return (item[self.pkey], item[self.skey])
+
+    def put_item(self, Item: dict[str, Any], ConditionExpression: Any = None, **kwargs) -> dict[str, Any]:
+        with self.lock:
+            if ConditionExpression is not None and not matches(ConditionExpression, self.items.get(self._key(Item), {})):
+                raise ConditionalCheckFailedException(self.name)
+            self.items[self._key(Item)] = copy.deepcopy(Item)
+        return {}
+
+    def get_item(self, Key: dict[str, Any], **kwargs) -> dict[str, Any]:
+        with self.lock:
+            item = self.items.get(self._key(Key))
+            return {"Item": copy.deepcopy(item)} if item is not None else {}
+
+    def delete_item(self, Key: dict[str, Any], **kwargs) -> dict[str, Any]:
+        with self.lock:
+            self.items.pop(self._key(Key), None)
+        return {}
+
+    def query(self, KeyConditionExpression: Any, **kwargs) -> dict[str, Any]:
+        _, value = condition_values(KeyConditionExpression)
+        with self.lock:
+            items = [copy.deepcopy(item) for key, item in sorted(self.items.items(), key=lambda x: str(x[0])) if key[0] == value]
+        return {"Items": items}
+
+    def update_item(
+        self,
+        Key: dict[str, Any],
+        UpdateExpression: str,
+        ExpressionAttributeNames: dict[str, str] = {},
+        ExpressionAttributeValues: dict[str, Any] = {},
+        ConditionExpression: Any = None,
+        **kwargs,
+    ) -> dict[str, Any]:
+        # "ADD #a :x, #b :y SET #c = :z" の形だけを扱う
+        with self.lock:
+            if ConditionExpression is not None and not matches(ConditionExpression, self.items.get(self._key(Key), {})):
+                raise ConditionalCheckFailedException(self.name)
+            item = self.items.setdefault(self._key(Key), dict(Key))
+            action = None
+            for token in UpdateExpression.replace(",", " , ").split():
+                if token in ("ADD", "SET"):
+                    action, operands = token, []
+                    continue
+                if token in (",", "="):
+                    continue
+                operands.append(token)
+                if len(operands) < 2:
+                    continue
+                name = ExpressionAttributeNames.get(operands[0], operands[0])
+                value = ExpressionAttributeValues[operands[1]]
+                if name in (self.pkey, self.skey):
+                    # DynamoDBと同じくキーは書き換えられない
+                    raise ValueError(f"{self.name}: cannot update key attribute {name}")
+                if action == "SET":
+                    item[name] = value
+                elif isinstance(value, set):
+                    item[name] = item.get(name, set()) | value
+                else:
+                    item[name] = item.get(name, 0) + value
+                operands = []
+        return {}
+
+    def batch_writer(self) -> LocalBatchWriter:
+        return LocalBatchWriter(self)
+
+
+class LocalBatchWriter:
+
+    def __init__(self, table: LocalTable) -> None:
+        self.table = table
+
+    def __enter__(self) -> LocalBatchWriter:
+        return self
+
+    def __exit__(self, *args) -> None:
+        ...
+
+    def put_item(self, Item: dict[str, Any]) -> None:
+        self.table.put_item(Item=Item)
+
+    def delete_item(self, Key: dict[str, Any]) -> None:
+        self.table.delete_item(Key=Key)
+
+
+class LocalDynamoDBClient:
+    exceptions = SimpleNamespace(
+        ConditionalCheckFailedException=ConditionalCheckFailedException,
+        ProvisionedThroughputExceededException=ProvisionedThroughputExceededException,
+    )
+
+    def __init__(self, resource: LocalDynamoDB) -> None:
+        self.resource = resource
+
+    def batch_write_item(self, RequestItems: dict[str, list[dict[str, Any]]]) -> dict[str, Any]:
+        for table_name, requests in RequestItems.items():
+            table = self.resource.Table(table_name)
+            for request in requests:
+                if "DeleteRequest" in request:
+                    table.delete_item(Key=request["DeleteRequest"]["Key"])
+                if "PutRequest" in request:
+                    table.put_item(Item=request["PutRequest"]["Item"])
+        return {"UnprocessedItems": {}}
+
+
+class LocalDynamoDB:
+
+    def __init__(self, schemas: dict[str, tuple[str, str]]) -> None:
+        self.meta = SimpleNamespace(client=LocalDynamoDBClient(self))
+        self.tables = {name: LocalTable(name, pkey, skey, self.meta.client) for name, (pkey, skey) in schemas.items()}
+
+    def Table(self, name: str) -> LocalTable:
+        return self.tables[name]
+
+
+class LocalS3:
+
+    def __init__(self) -> None:
+        self.objects: dict[tuple[str, str], bytes] = {}
+
+    def put_object(self, Body: bytes, Bucket: str, Key: str, **kwargs) -> dict[str, Any]:
+        self.objects[(Bucket, Key)] = Body
+        return {}
+
+
+class RecordingApiGateway:
+    # post_to_connectionで送ったメッセージを接続ごとに記録する. goneの接続には切断済み(GoneException)を返す
+    def __init__(self, gone: set[str] | None = None) -> None:
+        self.gone = gone or set()
+        self.sent: dict[str, list[dict[str, Any]]] = {}
+        self.lock = threading.Lock()
+
+    def post_to_connection(self, Data: bytes, ConnectionId: str, **kwargs) -> dict[str, Any]:
+        from botocore.exceptions import ClientError
+        if ConnectionId in self.gone:
+            raise ClientError({"Error": {"Code": "GoneException", "Message": ConnectionId}}, "PostToConnection")
+        with self.lock:
+            self.sent.setdefault(ConnectionId, []).append(json.loads(Data))
+        return {}
+
+
+class RecordingSqs:
+    # send_messageしたメッセージを記録するだけで配信はしない
+    def __init__(self) -> None:
+        self.messages: list[dict[str, Any]] = []
+
+    def send_message(self, **kwargs) -> dict[str, Any]:
+        self.messages.append(kwargs)
+        return {"MessageId": str(len(self.messages))}
+
+
+class LocalSession:
+    # boto3.Sessionの代わりにruntime.pyへ渡す. 同じSessionから作ったクライアントは同じ代替を共有する
+    def __init__(self, gone: set[str] | None = None) -> None:
+        _, schemas = local_env()
+        self.dynamodb = LocalDynamoDB(schemas)
+        self.s3 = LocalS3()
+        self.sqs = RecordingSqs()
+        self.apigw = RecordingApiGateway(gone)
+
+    def client(self, service_name: str, *args, **kwargs) -> Any:
+        return {"apigatewaymanagementapi": self.apigw, "sqs": self.sqs, "s3": self.s3}[service_name]
+
+    def resource(self, service_name: str, *args, **kwargs) -> Any:
+        return self.dynamodb
+
+
+class FakeModel:
+    # モデルファイルがなくても動かせるよう乱数の確率を返す. 呼ばれた回数(推論したフレーム数)を数える
+    name = "fake"
+
+    def __init__(self) -> None:
+        self.frames = 0
+
+    def predict(self, imgs: Any) -> Any:
+        import numpy as np
+        self.frames += len(imgs)
+        scores = np.random.random((len(imgs), 270)).astype(np.float32)
+        return scores / scores.sum(axis=1, keepdims=True)
+
+
+def load_handler(name: str, model: Any = None, env: dict[str, str] | None = None) -> Any:
+    # 各ディレクトリのlog_util.pyやroom_cache.pyは同じ名前なので, 前に読み込んだハンドラーのものを捨ててから読み込む
+    directory = os.path.join(SRC_DIR, name)
+    for key, module in list(sys.modules.items()):
+        if (getattr(module, "__file__", None) or "").startswith(SRC_DIR + os.sep):
+            del sys.modules[key]
+    sys.path[:] = [path for path in sys.path if not path.startswith(SRC_DIR + os.sep)]
+    sys.path.insert(0, directory)
+    os.environ.update({**local_env()[0], **(env or {})})
+    # label.csvやモデルは相対パスで読むので, 読み込む間はLambdaと同じく関数のディレクトリに移動する
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        if model is not None:
+            import backend
+            backend.load_backend = lambda _: model
+        spec = importlib.util.spec_from_file_location(f"{name}_lambda_function", os.path.join(directory, "lambda_function.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        if name == "predict":
+            # モデルの読み込みも移動している間に終えておく
+            module.reconstructed_model.get()
+        return module
+    finally:
+        os.chdir(cwd)
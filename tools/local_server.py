@@ -0,0 +1,203 @@
+"""全ハンドラーを1プロセスで動かすローカルのゲームサーバー
+
+src/*/lambda_function.py をすべて読み込み, cdk/stack.pyと同じく $request.body.action で振り分ける
+asyncioのWebSocketサーバーの裏に置く. DynamoDB, S3, SQS, API Gatewayの管理APIはメモリ上の代替に差し替え,
+predict_queue/round_queueはプロセス内のキューでpredict/start_gameを呼び出す.
+
+    python tools/local_server.py --port 8765 --fake-model
+    python tools/swarm.py --url ws://localhost:8765 --rooms 10 --players 4
+"""
+from __future__ import annotations
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import logging
+import threading
+from typing import Any
+from unittest import mock
+
+import websockets
+from botocore.exceptions import ClientError
+
+from cdk_env import local_env
+from local_aws import FakeModel, LocalDynamoDB, LocalS3, load_handler
+
+HANDLERS = ["on_connect", "enter_room", "dis_connect", "predict_queue", "predict", "start_game"]
+# SQSで配信に失敗したメッセージを捨てるまでの受信回数(DLQの代わり)
+MAX_RECEIVE_COUNT = 3
+
+logger = logging.getLogger("local_server")
+
+
+class LocalQueue:
+    # SQSのイベントソースと同じく, バッチサイズかバッチウィンドウに達したらまとめてハンドラーを呼ぶ
+    def __init__(self, server: LocalServer, handler: str, batch_size: int, window_sec: float) -> None:
+        self.server = server
+        self.handler = handler
+        self.batch_size = batch_size
+        self.window_sec = window_sec
+        self.queue: asyncio.Queue[dict[str, Any]] = asyncio.Queue()
+
+    def send_message(self, MessageBody: str, DelaySeconds: int = 0, **kwargs) -> dict[str, Any]:
+        # ハンドラーのスレッドから呼ばれるのでイベントループに渡して積む
+        message = {
+            "messageId": str(uuid.uuid4()),
+            "body": MessageBody,
+            "sent_at": int(time.time() * 1000),
+            "first_received_at": 0,
+            "receive_count": 0,
+        }
+        self.server.loop.call_soon_threadsafe(self.server.loop.call_later, DelaySeconds, self.queue.put_nowait, message)
+        return {"MessageId": message["messageId"]}
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window_sec
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            now = int(time.time() * 1000)
+            for message in batch:
+                message["receive_count"] += 1
+                message["first_received_at"] = message["first_received_at"] or now
+            event = {"Records": [
+                {
+                    "messageId": message["messageId"],
+                    "body": message["body"],
+                    "attributes": {
+                        "SentTimestamp": str(message["sent_at"]),
+                        "ApproximateFirstReceiveTimestamp": str(message["first_received_at"]),
+                    },
+                }
+                for message in batch
+            ]}
+            res = await self.server.invoke(self.handler, event)
+            failures = {failure["itemIdentifier"] for failure in (res or {}).get("batchItemFailures", [])}
+            for message in batch:
+                if message["messageId"] in failures and message["receive_count"] < MAX_RECEIVE_COUNT:
+                    self.queue.put_nowait(message)
+
+
+class LocalSqs:
+
+    def __init__(self) -> None:
+        self.queues: dict[str, LocalQueue] = {}
+
+    def send_message(self, QueueUrl: str, **kwargs) -> dict[str, Any]:
+        return self.queues[QueueUrl].send_message(**kwargs)
+
+
+class LocalApiGateway:
+
+    def __init__(self, server: LocalServer) -> None:
+        self.server = server
+
+    def post_to_connection(self, Data: bytes, ConnectionId: str, **kwargs) -> dict[str, Any]:
+        ws = self.server.connections.get(ConnectionId)
+        if ws is None:
+            raise ClientError({"Error": {"Code": "GoneException", "Message": ConnectionId}}, "PostToConnection")
+        self.server.messages_sent += 1
+        asyncio.run_coroutine_threadsafe(ws.send(Data.decode()), self.server.loop).result(timeout=10)
+        return {}
+
+
+class LocalServer:
+
+    def __init__(self, fake_model: bool, batch_size: int, window_sec: float) -> None:
+        env, schemas = local_env()
+        os.environ.update(env)
+        self.loop = asyncio.get_running_loop()
+        self.connections: dict[str, Any] = {}
+        self.messages_sent = 0
+        self.dynamodb = LocalDynamoDB(schemas)
+        self.s3 = LocalS3()
+        self.sqs = LocalSqs()
+        self.apigw = LocalApiGateway(self)
+        self.sqs.queues[env["PREDICT_QUEUE_URL"]] = LocalQueue(self, "predict", batch_size, window_sec)
+        self.sqs.queues[env["ROUND_QUEUE_URL"]] = LocalQueue(self, "start_game", 10, 0)
+        # runtime.pyは最初に使うときにSessionを作るので, 差し替えたままにしておく
+        mock.patch("boto3.Session", return_value=self).start()
+        self.modules = {name: load_handler(name, FakeModel() if fake_model and name == "predict" else None) for name in HANDLERS}
+        # Lambdaと同じく1つの関数(コンテナ)は同時に1つの呼び出ししか処理しない
+        self.locks = {name: threading.Lock() for name in HANDLERS}
+
+    def client(self, service_name: str, *args, **kwargs) -> Any:
+        return {"apigatewaymanagementapi": self.apigw, "sqs": self.sqs, "s3": self.s3}[service_name]
+
+    def resource(self, service_name: str, *args, **kwargs) -> Any:
+        return self.dynamodb
+
+    def _invoke(self, name: str, event: dict[str, Any]) -> Any:
+        with self.locks[name]:
+            return self.modules[name].lambda_handler(event, None)
+
+    async def invoke(self, name: str, event: dict[str, Any]) -> Any:
+        try:
+            return await self.loop.run_in_executor(None, self._invoke, name, event)
+        except Exception:
+            logger.exception(name)
+
+    def ws_event(self, connection_id: str, route_key: str, body: str | None = None) -> dict[str, Any]:
+        return {
+            "requestContext": {
+                "connectionId": connection_id,
+                "routeKey": route_key,
+                "requestTimeEpoch": int(time.time() * 1000),
+            },
+            "body": body,
+        }
+
+    async def handle(self, ws: Any, path: str | None = None) -> None:
+        connection_id = str(uuid.uuid4())
+        await self.invoke("on_connect", self.ws_event(connection_id, "$connect"))
+        self.connections[connection_id] = ws
+        try:
+            async for body in ws:
+                # API Gatewayのroute_selection_expression="$request.body.action"と同じ振り分け
+                try:
+                    action = json.loads(body).get("action")
+                except ValueError:
+                    continue
+                route = {"enter_room": "enter_room", "predict": "predict_queue", "start_game": "start_game"}.get(action)
+                if route is not None:
+                    asyncio.ensure_future(self.invoke(route, self.ws_event(connection_id, action, body)))
+        except websockets.ConnectionClosed:
+            ...
+        finally:
+            self.connections.pop(connection_id, None)
+            await self.invoke("dis_connect", self.ws_event(connection_id, "$disconnect"))
+
+    async def serve(self, host: str, port: int) -> None:
+        for queue in self.sqs.queues.values():
+            asyncio.ensure_future(queue.run())
+        async with websockets.serve(self.handle, host, port, max_size=None):
+            logger.warning(f"listening on ws://{host}:{port}")
+            await asyncio.Future()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fake-model", action="store_true", help="モデルを読み込まず乱数のスコアを返す")
+    parser.add_argument("--batch-size", type=int, default=10, help="predict_queueのバッチサイズ")
+    parser.add_argument("--batch-window", type=float, default=1.0, help="predict_queueのバッチウィンドウ(秒)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    server = LocalServer(args.fake_model, args.batch_size, args.batch_window)
+    await server.serve(args.host, args.port)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,241 @@
+"""predictのワーカーをAWSなしで動かして性能を測るベンチマーク
+
+S3, DynamoDB, API Gatewayのクライアントをtools/local_aws.pyのメモリ上の代替に差し替えてsrc/predict/lambda_function.pyを読み込み,
+記録したSQSイベント(JSON)またはstatic/*.pngから合成した描画をlambda_handlerに流して,
+スループット, レイテンシ(p50/p95/p99), ピークRSSを表示する. batchItemFailuresが返ったフレームがあればエラーで終わる.
+
+    python tools/replay_predict.py --frames 500 --batch-size 10
+    python tools/replay_predict.py --fake-model            # モデルがなくても推論以外の処理を測れる
+    # レコードごとに推論する(バッチサイズ1)場合とSQSのバッチをまとめて推論する場合のスループット
+    python tools/replay_predict.py --stand-in-model --batch-size 1 10
+    python tools/replay_predict.py --events recorded/ --workers 4
+    python tools/replay_predict.py --tracemalloc
+    python tools/replay_predict.py --duplicate-ratio 0.5   # 再配信された最終フレームが推論されないことを確かめる
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import glob
+import base64
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import multiprocessing
+from typing import Any
+from unittest import mock
+
+from cdk_env import ROOT, local_env
+from local_aws import SRC_DIR, FakeModel, LocalSession, load_handler
+
+STATIC_DIR = os.path.join(ROOT, "static")
+
+
+def connection_ids(events: list[dict[str, Any]]) -> set[str]:
+    # エンベロープ(v1)と以前のAPI Gatewayのイベントのどちらからも接続IDを取り出す
+    ids = set()
+    for event in events:
+        for record in event["Records"]:
+            message = json.loads(record["body"])
+            ids.add(message["connection_id"] if message.get("v") == 1 else message["requestContext"]["connectionId"])
+    return ids
+
+
+def enter(session: LocalSession, ids: set[str]) -> None:
+    # 最終フレームの保存で読むユーザー情報(enter_roomが書く行)を用意する
+    env, _ = local_env()
+    table = session.dynamodb.Table(env["USER_TABLE_NAME"])
+    for connection_id in ids:
+        table.put_item(Item={
+            env["USER_TABLE_PKEY"]: connection_id,
+            env["USER_TABLE_SKEY"]: "info",
+            "room_id": "bench",
+            "user_name": connection_id,
+        })
+
+
+def synthesize_events(n_frames: int, batch_size: int, fin_ratio: float, duplicate_ratio: float) -> list[dict[str, Any]]:
+    # static/*.pngを描画に見立てて, predict_queueと同じエンベロープのSQSイベントを作る
+    imgs = []
+    for path in sorted(glob.glob(os.path.join(STATIC_DIR, "*.png"))):
+        with open(path, "rb") as f:
+            imgs.append("data:image/png;base64," + base64.b64encode(f.read()).decode())
+    now = int(time.time() * 1000)
+    records = []
+    for i in range(n_frames):
+        is_fin = fin_ratio > 0 and i % max(1, round(1 / fin_ratio)) == 0
+        envelope = {
+            "v": 1,
+            # 途中経過のフレームが間引かれないよう接続IDはフレームごとに変える
+            "connection_id": f"bench-{i}",
+            "requested_at": now + i,
+            "frame": {"odai": "空母", "is_fin": is_fin, "img_id": str(i)},
+            "img_b64": imgs[i % len(imgs)],
+        }
+        records.append({
+            "messageId": f"m-{i}",
+            "body": json.dumps(envelope),
+            "attributes": {"SentTimestamp": str(now), "ApproximateFirstReceiveTimestamp": str(now), "ApproximateReceiveCount": "1"},
+        })
+    # SQSの再配信: 最終フレームの一部を同じmessageIdのまま, 受信回数を増やして後ろのバッチでもう一度届ける
+    fins = [record for record in records if json.loads(record["body"])["frame"]["is_fin"]]
+    records += [
+        {**record, "attributes": {**record["attributes"], "ApproximateReceiveCount": "2"}}
+        for record in fins[:round(len(fins) * duplicate_ratio)]
+    ]
+    return [{"Records": records[i:i+batch_size]} for i in range(0, len(records), batch_size)]
+
+
+def load_events(path: str) -> list[dict[str, Any]]:
+    files = sorted(glob.glob(os.path.join(path, "*.json"))) if os.path.isdir(path) else [path]
+    events = []
+    for file in files:
+        with open(file, "r", encoding="utf-8") as f:
+            events.append(json.load(f))
+    return events
+
+
+def restamp(event: dict[str, Any]) -> dict[str, Any]:
+    # 合成したときや記録したときの時刻のままだとキューが遅れているように見えて途中経過が負荷制御で落とされるので,
+    # 流す直前にSQSが送った時刻を付け直す
+    now = str(int(time.time() * 1000))
+    return {
+        **event,
+        "Records": [
+            {**record, "attributes": {**record.get("attributes", {}), "SentTimestamp": now, "ApproximateFirstReceiveTimestamp": now}}
+            for record in event["Records"]
+        ],
+    }
+
+
+def load_model(backend: str, path: str) -> Any:
+    sys.path.insert(0, os.path.join(SRC_DIR, "predict"))
+    from backend import BACKENDS
+    return BACKENDS[backend](path)
+
+
+def replay(args: tuple[list[dict[str, Any]], str, bool, str | None, bool]) -> dict[str, Any]:
+    events, backend, fake_model, model_path, trace = args
+    # EMFの出力でベンチマークの結果が埋もれないよう捨てる
+    sys.stdout = open(os.devnull, "w")
+    # クライアントは最初に使うときに作られるので, 差し替えたままにしておく
+    session = LocalSession()
+    mock.patch("boto3.Session", return_value=session).start()
+    enter(session, connection_ids(events))
+    model = FakeModel() if fake_model else load_model(backend, model_path) if model_path else None
+    module = load_handler("predict", model, {"LOG_LEVEL": "WARNING", "MODEL_BACKEND": backend, "MODEL_PREWARM": "0"})
+    latencies = []
+    failures = []
+    n_frames = 0
+    allocations = 0
+    allocated = 0
+    start = time.perf_counter()
+    for event in events:
+        event = restamp(event)
+        if trace:
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+        t = time.perf_counter()
+        response = module.lambda_handler(event, None)
+        latencies.append((time.perf_counter() - t) * 1000)
+        if trace:
+            # 呼び出し後も残っているブロック数と, 呼び出し中に確保されたメモリのピークを数える
+            stats = tracemalloc.take_snapshot().compare_to(before, "filename")
+            allocations += sum(max(0, stat.count_diff) for stat in stats)
+            allocated += tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        n_frames += len(event["Records"])
+        failures += [failure["itemIdentifier"] for failure in response["batchItemFailures"]]
+    elapsed = time.perf_counter() - start
+    sys.stdout = sys.__stdout__
+    return {
+        "latencies": latencies,
+        "frames": n_frames,
+        "failures": failures,
+        "elapsed": elapsed,
+        "allocations": allocations,
+        "allocated": allocated,
+        "duplicated": module.coalesce_counter["duplicated"],
+        "shed": module.coalesce_counter["shed"],
+        # Linuxではru_maxrssはKB
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def report(results: list[dict[str, Any]], args: argparse.Namespace) -> float:
+    latencies = [latency for result in results for latency in result["latencies"]]
+    frames = sum(result["frames"] for result in results)
+    elapsed = max(result["elapsed"] for result in results)
+    print(f"workers       : {args.workers}")
+    print(f"invocations   : {len(latencies)}")
+    print(f"frames        : {frames}")
+    print(f"throughput    : {frames / elapsed:.1f} frames/s")
+    for p in (50, 95, 99):
+        print(f"p{p} latency   : {percentile(latencies, p):.1f} ms/invocation")
+    print(f"duplicated    : {sum(result['duplicated'] for result in results)} frames skipped as already processed")
+    print(f"shed          : {sum(result['shed'] for result in results)} frames dropped by load shedding")
+    print(f"peak RSS      : {max(result['max_rss_mb'] for result in results):.1f} MB/worker")
+    if args.tracemalloc:
+        print(f"allocations   : {sum(result['allocations'] for result in results) / frames:.0f} blocks/frame (live after call)")
+        print(f"peak traced   : {sum(result['allocated'] for result in results) / frames / 1024:.1f} KB/frame")
+    return frames / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", help="記録したSQSイベントのJSONファイルまたはディレクトリ")
+    parser.add_argument("--frames", type=int, default=200, help="合成するフレーム数")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[10], help="合成するSQSイベントのバッチサイズ(複数なら順に測って比べる)")
+    parser.add_argument("--fin-ratio", type=float, default=0.1, help="合成するフレームのうちis_finの割合")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0, help="最終フレームのうち再配信する割合")
+    parser.add_argument("--workers", type=int, default=1, help="並列に動かすワーカープロセス数")
+    parser.add_argument("--backend", default=local_env()[0]["MODEL_BACKEND"], help="MODEL_BACKEND(tflite/keras)")
+    parser.add_argument("--fake-model", action="store_true", help="モデルを読み込まず乱数のスコアを返す(推論以外の処理だけを測る)")
+    parser.add_argument("--model", help="--backendで読み込むモデルファイル(.h5/.tflite, 省略時はsrc/predictのもの)")
+    parser.add_argument("--stand-in-model", action="store_true", help="元のモデルと同じ入出力の代わりのCNNを作って使う(tools/bench_backend.py)")
+    parser.add_argument("--tracemalloc", action="store_true", help="フレームあたりのメモリ確保量を測る(遅くなる)")
+    args = parser.parse_args()
+
+    if args.events and len(args.batch_size) > 1:
+        parser.error("--batch-size takes one value with --events (recorded events keep their batches)")
+
+    with tempfile.TemporaryDirectory() as directory:
+        model_path = args.model
+        if args.stand_in_model:
+            from bench_backend import prepare
+            h5, tflite = prepare(None, directory)
+            model_path = tflite if args.backend == "tflite" else h5
+        throughputs = {}
+        for batch_size in args.batch_size:
+            events = load_events(args.events) if args.events else synthesize_events(args.frames, batch_size, args.fin_ratio, args.duplicate_ratio)
+            # ワーカーごとに同じコーパスを流す(同時実行数Nのときの1コンテナあたりの性能を見る)
+            # 代わりのモデルを作るときに読み込んだTensorFlowをforkで引き継ぐと子プロセスが止まるのでspawnで起動する
+            with multiprocessing.get_context("spawn").Pool(args.workers) as pool:
+                results = pool.map(replay, [(events, args.backend, args.fake_model, model_path, args.tracemalloc)] * args.workers)
+
+            # 失敗したフレームは推論されていないので, スループットやレイテンシを出しても意味がない
+            failures = [message_id for result in results for message_id in result["failures"]]
+            if failures:
+                sys.exit(
+                    f"{len(failures)} of {sum(result['frames'] for result in results)} frames failed (batchItemFailures, e.g. {failures[:3]}). "
+                    "Check the worker log above, or run with --fake-model if there is no model."
+                )
+            if len(args.batch_size) > 1:
+                print(f"--- batch size {batch_size}")
+            throughputs[batch_size] = report(results, args)
+    if len(throughputs) > 1:
+        base = args.batch_size[0]
+        print("---")
+        for batch_size, fps in throughputs.items():
+            print(f"batch size {batch_size:<3}: {fps:.1f} frames/s ({fps / throughputs[base]:.2f}x batch size {base})")
+
+if __name__ == "__main__":
+    main()
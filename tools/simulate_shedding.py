@@ -0,0 +1,132 @@
+"""predictの負荷制御(src/predict/shedding.py)を過負荷の状態でシミュレーションする
+
+プレイヤーが一定間隔で途中経過を送り続けるpredict_queueを, 推論の処理能力を超える到着率で
+1つのワーカーが処理したときの遅れを, 負荷制御なしとありで比べる. 負荷制御ありではキューの遅れが
+SHED_QUEUE_AGE_MS付近で頭打ちになり, 最終フレーム(is_fin)は落とされずにすべて推論されることを確かめる.
+busyを受けたプレイヤーはブラウザ(static/index.js)と同じくretry_after_msの間は途中経過を送らない(held).
+
+    python tools/simulate_shedding.py
+    python tools/simulate_shedding.py --players 200 --interval-ms 300 --per-frame-ms 15
+"""
+from __future__ import annotations
+
+import os
+import sys
+import random
+import argparse
+from collections import deque
+from types import SimpleNamespace
+from typing import Any, NamedTuple
+
+from cdk_env import ROOT, local_env
+
+sys.path.insert(0, os.path.join(ROOT, "src", "predict"))
+from shedding import SheddingConfig, busy_targets, queue_lag, shed  # noqa: E402
+
+
+class SimFrame(NamedTuple):
+    connection_id: str
+    requested_at: int
+    sent_at: int
+    body: Any
+
+
+def arrivals(args: argparse.Namespace) -> list[SimFrame]:
+    # 各プレイヤーが少しずつずれた間隔で途中経過を送り, fin_ratioの割合で最終フレームが混ざる
+    rng = random.Random(args.seed)
+    frames = []
+    for player in range(args.players):
+        t = rng.randrange(args.interval_ms)
+        while t < args.duration_ms:
+            body = SimpleNamespace(is_fin=rng.random() < args.fin_ratio)
+            frames.append(SimFrame(f"player-{player}", t, t, body))
+            t += args.interval_ms
+    return sorted(frames, key=lambda frame: frame.sent_at)
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def simulate(frames: list[SimFrame], config: SheddingConfig | None, args: argparse.Namespace) -> dict[str, Any]:
+    queue = deque(frames)
+    now = 0
+    latencies, fin_latencies, lags = [], [], []
+    n_shed = n_fin = n_held = 0
+    # プレイヤーがbusyを受けた時刻と送るのを再開する時刻, predictがbusyを返し直さない期限(接続ごと)
+    backoff: dict[str, tuple[int, int]] = {}
+    busy_until: dict[str, int] = {}
+    while queue:
+        now = max(now, queue[0].sent_at)
+        batch = []
+        while queue and queue[0].sent_at <= now and len(batch) < args.batch_size:
+            frame = queue.popleft()
+            held_from, held_until = backoff.get(frame.connection_id, (0, 0))
+            if not frame.body.is_fin and held_from <= frame.sent_at < held_until:
+                n_held += 1
+                continue
+            batch.append(frame)
+        if not batch:
+            continue
+        lags.append(queue_lag(batch, now))
+        kept, dropped = shed(batch, now, config) if config else (batch, [])
+        n_shed += len(dropped)
+        busy = busy_targets(dropped, now, busy_until, config.frame_age_ms) if config and config.mode == "busy" else []
+        # すべて落としたバッチでは推論しない(lambda_handlerと同じ)ので, 呼び出し自体の時間だけかかる
+        now += args.invoke_ms + (args.batch_overhead_ms + args.per_frame_ms * len(kept) if kept else 0) + args.busy_reply_ms * len(busy)
+        for connection_id in busy:
+            backoff[connection_id] = (now, now + config.frame_age_ms)
+        for frame in kept:
+            latencies.append(now - frame.requested_at)
+            if frame.body.is_fin:
+                fin_latencies.append(now - frame.requested_at)
+        n_fin += sum(frame.body.is_fin for frame in batch)
+    return {
+        "scored": len(latencies),
+        "shed": n_shed,
+        "held": n_held,
+        "fin": f"{len(fin_latencies)}/{n_fin}",
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "max": max(latencies, default=0),
+        "max_lag": max(lags, default=0),
+        "final_lag": lags[-1] if lags else 0,
+    }
+
+
+def main() -> None:
+    env, _ = local_env()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=100)
+    parser.add_argument("--interval-ms", type=int, default=500, help="1人が途中経過を送る間隔")
+    parser.add_argument("--fin-ratio", type=float, default=0.02, help="最終フレームの割合")
+    parser.add_argument("--duration-ms", type=int, default=60000)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--invoke-ms", type=int, default=2, help="1回の呼び出し(SQSからの受け取りと前後の処理)にかかる時間")
+    parser.add_argument("--batch-overhead-ms", type=int, default=18, help="1回の推論にかかる固定の時間")
+    parser.add_argument("--per-frame-ms", type=int, default=8, help="1フレームの前処理と推論にかかる時間")
+    parser.add_argument("--busy-reply-ms", type=int, default=2, help="busyを1回返すのにかかる時間")
+    parser.add_argument("--queue-age-ms", default=env["SHED_QUEUE_AGE_MS"])
+    parser.add_argument("--frame-age-ms", default=env["SHED_FRAME_AGE_MS"])
+    parser.add_argument("--mode", default=env["SHED_MODE"])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    frames = arrivals(args)
+    config = SheddingConfig.from_env(args.queue_age_ms, args.frame_age_ms, args.mode)
+    offered = len(frames) / (args.duration_ms / 1000)
+    capacity = 1000 * args.batch_size / (args.invoke_ms + args.batch_overhead_ms + args.per_frame_ms * args.batch_size)
+    print(f"offered load  : {offered:.0f} frames/s (capacity {capacity:.0f} frames/s)")
+    print(f"config        : {config}")
+    print(f"{'':<10}{'scored':>8}{'shed':>8}{'held':>8}{'fin':>10}{'p50':>10}{'p95':>10}{'max':>10}{'max lag':>10}{'final lag':>11}")
+    for name, result in (("no shed", simulate(frames, None, args)), ("shed", simulate(frames, config, args))):
+        print(
+            f"{name:<10}{result['scored']:>8}{result['shed']:>8}{result['held']:>8}{result['fin']:>10}"
+            f"{result['p50']:>8.0f}ms{result['p95']:>8.0f}ms{result['max']:>8.0f}ms"
+            f"{result['max_lag']:>8.0f}ms{result['final_lag']:>9.0f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""ローカルのゲームサーバー(tools/local_server.py)に大勢で接続して負荷をかけるクライアント
+
+部屋ごとに全員がenter_roomし, 最初の1人がstart_gameを送る. ゲーム中は各プレイヤーが一定間隔で
+28x28の筆跡(x-ink28)を送り, round_endを受けたらfin_window_ms内に最終フレームを送る.
+最後に受信したメッセージ数/秒と, predictの返信までのレイテンシ(p50/p95/p99)を表示する.
+
+    python tools/swarm.py --url ws://localhost:8765 --rooms 10 --players 4 --duration 60
+"""
+from __future__ import annotations
+
+import json
+import time
+import random
+import base64
+import asyncio
+import argparse
+from collections import Counter
+from typing import Any
+
+import websockets
+
+INK28_HEADER = "data:application/x-ink28;base64"
+
+
+def ink28() -> str:
+    # 適当な線を1本引いた28x28の筆跡
+    ink = bytearray(28 * 28)
+    y = random.randrange(4, 24)
+    for x in range(4, 24):
+        ink[y * 28 + x] = 255
+    return f"{INK28_HEADER},{base64.b64encode(bytes(ink)).decode()}"
+
+
+class Stats:
+
+    def __init__(self) -> None:
+        self.received: Counter[str] = Counter()
+        self.latencies: list[float] = []
+
+
+async def player(url: str, room_id: str, index: int, args: argparse.Namespace, stats: Stats, deadline: float) -> None:
+    async with websockets.connect(url, max_size=None) as ws:
+        await ws.send(json.dumps({"action": "enter_room", "room_id": room_id, "user_name": f"{room_id}-{index}"}))
+        if index == 0:
+            # 全員の入室を待ってから始める
+            await asyncio.sleep(1)
+            await ws.send(json.dumps({"action": "start_game", "room_id": room_id, "n_odai": args.n_odai, "n_time_sec": args.n_time_sec}))
+
+        state = {"drawing": False, "odai": "", "round": 0, "sent_at": 0.0, "busy_until": 0.0}
+
+        async def draw() -> None:
+            while True:
+                await asyncio.sleep(args.interval)
+                # ブラウザと同じく, busyを受けたらしばらく途中経過を送らない
+                if state["drawing"] and time.perf_counter() >= state["busy_until"]:
+                    state["sent_at"] = time.perf_counter()
+                    await ws.send(json.dumps({
+                        "action": "predict",
+                        "odai": state["odai"],
+                        "is_fin": False,
+                        "img_id": "hoge",
+                        "img_b64": ink28(),
+                    }))
+
+        async def start_round(data: dict[str, Any]) -> None:
+            # 受信ループを止めないよう, 次のお題の開始までは別のタスクで待つ
+            await asyncio.sleep(data["starts_in_ms"] / 1000)
+            state.update(drawing=True, odai=data["odai"])
+
+        async def fin(data: dict[str, Any]) -> None:
+            await asyncio.sleep(random.random() * data["fin_window_ms"] / 2000)
+            await ws.send(json.dumps({
+                "action": "predict",
+                "odai": data["odai"],
+                "is_fin": True,
+                "img_id": str(data["round"]),
+                "img_b64": ink28(),
+            }))
+
+        drawer = asyncio.ensure_future(draw())
+        try:
+            while True:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    data = json.loads(await asyncio.wait_for(ws.recv(), timeout))
+                except (asyncio.TimeoutError, websockets.ConnectionClosed):
+                    break
+                command = data.get("command")
+                stats.received[command] += 1
+                if command == "predict" and state["sent_at"]:
+                    # 途中経過は間引かれるので, 最後に送ったフレームからの時間を測る
+                    stats.latencies.append((time.perf_counter() - state["sent_at"]) * 1000)
+                elif command == "busy":
+                    state["busy_until"] = time.perf_counter() + data["retry_after_ms"] / 1000
+                elif command == "game_start":
+                    state.update(drawing=True, odai=data["odai"][data["round"]])
+                elif command == "round_start":
+                    asyncio.ensure_future(start_round(data))
+                elif command == "round_end":
+                    state["drawing"] = False
+                    asyncio.ensure_future(fin(data))
+                elif command == "game_end":
+                    break
+        finally:
+            drawer.cancel()
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="ws://localhost:8765")
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--players", type=int, default=4, help="1部屋あたりの人数")
+    parser.add_argument("--interval", type=float, default=0.5, help="途中経過を送る間隔(秒)")
+    parser.add_argument("--n-odai", type=int, default=3)
+    parser.add_argument("--n-time-sec", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=60, help="打ち切るまでの秒数")
+    args = parser.parse_args()
+
+    stats = Stats()
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*[
+        player(args.url, f"swarm-{room}", index, args, stats, deadline)
+        for room in range(args.rooms) for index in range(args.players)
+    ])
+    elapsed = time.perf_counter() - start
+
+    total = sum(stats.received.values())
+    print(f"clients       : {args.rooms * args.players}")
+    print(f"elapsed       : {elapsed:.1f} s")
+    print(f"messages      : {total} ({total / elapsed:.1f} messages/s)")
+    for command, count in sorted(stats.received.items(), key=lambda x: str(x[0])):
+        print(f"  {command:<12}: {count}")
+    for p in (50, 95, 99):
+        print(f"p{p} latency   : {percentile(stats.latencies, p):.1f} ms/predict")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())